@@ -1,127 +1,347 @@
 """\
 This is a combination of a publisher and subscriber, modeling handling ML workload on the endpoint itself.
-"""
 
-import PIL.Image as Image
+Images flow through a pipeline of stages, each running in its own process(es):
+- read: 1 process generating raw JPEG bytes on schedule
+- decode: DECODE_WORKERS processes decoding and resizing images into shared memory slots
+- infer: INFER_WORKERS processes classifying the images in the slots, or the number of
+  processes picked by calibration (see common/calibrate.py)
+- report: 1 process recording metrics and printing results
+Stages are connected by bounded queues. Decoded images are not pickled between stages,
+only the index of their shared memory slot is.
+"""
 
-import tflite_runtime.interpreter as tflite
 import numpy as np
 import os
 import time
 import multiprocessing
+from multiprocessing import shared_memory
+
+import calibrate
+from metrics import AllocationCounter, Metrics, memory_usage, sampled
+import model
+from preprocess import Preprocessor
+from schedule import Schedule
+from variants import MODELS
 
 CPU_THREADS = int(os.environ["CPU_THREADS"])
 FREQUENCY = int(os.environ["FREQUENCY"])
+RESAMPLE = os.environ.get("RESAMPLE", "bicubic")
+PREPROCESS_CACHE = int(os.environ.get("PREPROCESS_CACHE", 0))
+ARRIVAL = os.environ.get("ARRIVAL", "constant")
+LOG_SAMPLE = int(os.environ.get("LOG_SAMPLE", 0))
+MODEL = os.environ.get("MODEL", model.REFERENCE)
+DECODE_WORKERS = int(os.environ.get("DECODE_WORKERS", 1))
+INFER_WORKERS = int(os.environ.get("INFER_WORKERS", CPU_THREADS))
+INFER_THREADS = int(
+    os.environ.get("INFER_THREADS", max(1, CPU_THREADS // INFER_WORKERS))
+)
+WARMUP = int(os.environ.get("WARMUP", 5))
+QUEUE_SIZE = int(os.environ.get("QUEUE_SIZE", 2 * (DECODE_WORKERS + INFER_WORKERS)))
+SHARED_MODEL = os.environ.get("SHARED_MODEL", "False")
+PIN_CPUS = os.environ.get("PIN_CPUS", "False")
+CALIBRATE = os.environ.get("CALIBRATE", "off")
+CALIBRATE_TIME = float(os.environ.get("CALIBRATE_TIME", 2))
+ALLOC_TRACE = os.environ.get("ALLOC_TRACE", "False")
 
 # Set how many imgs to send, and how often
 DURATION = 300
 SEC_PER_FRAME = float(1 / FREQUENCY)
 MAX_IMGS = FREQUENCY * DURATION
 
+# Start of the container, startup times are reported relative to this
+START_TIME = time.time_ns()
+
+
+class ImageSlots:
+    """Fixed-size slots in shared memory holding decoded images, passed between the
+    decode and infer stages by index. Free slot indices are kept in a queue: taking a slot
+    blocks if all slots are in use, which limits the number of images in the pipeline.
+    """
+
+    def __init__(self, slots, shape):
+        """Initialize the object
+
+        Args:
+            slots (int): Number of slots
+            shape (tuple(int)): Shape of one decoded image (height, width, channels)
+        """
+        self.shape = (slots,) + tuple(shape)
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=int(np.prod(self.shape))
+        )
+        self.free = multiprocessing.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def view(self):
+        """Get a numpy view on the slots, call in each process that uses them
+
+        Returns:
+            np.ndarray: Array of slots, indexed by slot number
+        """
+        return np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+
+    def close(self):
+        """Release the shared memory segment"""
+        self.shm.close()
+        self.shm.unlink()
 
-def generate(queue):
+
+def generate(decode_queue):
+    """Read stage: generate raw images on schedule
+
+    Args:
+        decode_queue (multiprocessing.Queue): Queue to the decode stage
+    """
     print("Start generating")
 
-    # Loop over the dataset of 60 images
+    # Load the dataset of 60 images once, so generating a frame does not touch the disk
     files = []
-    for file in os.listdir("images"):
+    for file in sorted(os.listdir("images")):
         if file.endswith(".JPEG"):
-            files.append(file)
+            with open("images/" + file, "rb") as f:
+                files.append(f.read())
 
+    # Generate frames on a fixed schedule, independent of how long generating takes
+    metrics = Metrics("generated", ["lateness"])
+    schedule = Schedule(FREQUENCY, ARRIVAL)
     for i in range(MAX_IMGS):
-        start_time = time.time_ns()
-        image = Image.open("images/" + files[i % len(files)])
-        queue.put([start_time, image])
-
-        # Try to keep a frame rate of X
-        sec_frame = time.time_ns() - start_time
-        sec_frame = float(sec_frame) / 10**9
-
-        if sec_frame < SEC_PER_FRAME:
-            # Wait until next frame should happen
-            frame = 0.1 * (SEC_PER_FRAME - sec_frame)
-            while sec_frame < SEC_PER_FRAME:
-                time.sleep(frame)
-                sec_frame = float(time.time_ns() - start_time) / 10**9
-        else:
+        t_intended, lateness = schedule.wait()
+        metrics.add(lateness)
+        if sampled(i, LOG_SAMPLE):
+            print("Send lateness (ns): %i" % (lateness))
+
+        if lateness > SEC_PER_FRAME * 10**9:
             print(
-                "Can't keep up with %f seconds per frame: Took %f"
-                % (SEC_PER_FRAME, sec_frame)
+                "Can't keep up with %f seconds per frame: %f seconds late"
+                % (SEC_PER_FRAME, lateness / 10**9)
             )
 
+        # Latency is measured from the intended generation time of the frame
+        decode_queue.put([i, t_intended, files[i % len(files)]])
+
+    metrics.flush()
+
+
+def decode(decode_queue, infer_queue, slots, iw, ih):
+    """Decode stage: decode and resize raw images into free shared memory slots
+
+    Args:
+        decode_queue (multiprocessing.Queue): Queue from the read stage
+        infer_queue (multiprocessing.Queue): Queue to the infer stage
+        slots (ImageSlots): Shared memory slots for decoded images
+        iw (int): Model input width
+        ih (int): Model input height
+    """
+    preprocessor = Preprocessor(iw, ih, RESAMPLE, PREPROCESS_CACHE)
+    images = slots.view()
+
+    while True:
+        item = decode_queue.get(block=True)
+        if item is None:
+            break
+
+        start_time = time.time_ns()
+        seq, t_intended, data = item
+
+        image, decode_time = preprocessor(data)
+        slot = slots.free.get(block=True)
+        images[slot] = image
+
+        infer_queue.put([seq, t_intended, start_time, decode_time, slot])
 
-def process(queue):
-    # Load the labels
-    with open("labels.txt", "r") as f:
-        labels = [line.strip() for line in f.readlines()]
 
+def infer(infer_queue, report_queue, slots, ready, content, threads, cpus):
+    """Infer stage: classify decoded images
+
+    Args:
+        infer_queue (multiprocessing.Queue): Queue from the decode stage
+        report_queue (multiprocessing.Queue): Queue to the report stage
+        slots (ImageSlots): Shared memory slots for decoded images
+        ready (multiprocessing.Barrier): Passed once every model is loaded and warmed up
+        content (bytes): Model read once by the main process and shared by all infer
+            processes, None to load the model file in each process
+        threads (int): Number of interpreter threads
+        cpus (set(int)): CPUs to pin this process to, None to not pin
+    """
     # Load the model
-    interpreter = tflite.Interpreter(model_path="model.tflite", num_threads=CPU_THREADS)
-    interpreter.allocate_tensors()
+    calibrate.pin(cpus)
+    interpreter = model.load(MODEL, threads, content)
+    loaded = time.time_ns() - START_TIME
+
+    # Run synthetic images through the model, so real images never pay for warm-up
+    model.warm_up(interpreter, WARMUP)
+    warm = time.time_ns() - START_TIME
 
-    # Get model input details and resize image
     input_details = interpreter.get_input_details()
-    floating_model = input_details[0]["dtype"] == np.float32
+    output_details = interpreter.get_output_details()
+    input_tensor = interpreter.tensor(input_details[0]["index"])
+    output_tensor = interpreter.tensor(output_details[0]["index"])
+    images = slots.view()
+    allocations = AllocationCounter(ALLOC_TRACE == "True")
 
-    iw = input_details[0]["shape"][2]
-    ih = input_details[0]["shape"][1]
+    ready.wait()
 
-    while True:
-        # Get item from queue
-        print("Get item")
-        item = queue.get(block=True)
-        start_process_time = time.time_ns()
-        start_time = item[0]
-        image = item[1]
+    startup_metrics = Metrics("startup", ["loaded", "warm", "ready"])
+    startup_metrics.add(loaded, warm, time.time_ns() - START_TIME)
+    startup_metrics.flush()
 
-        # Resize image and prepare data/model
-        image = image.resize((iw, ih)).convert(mode="RGB")
-        input_data = np.expand_dims(image, axis=0)
+    while True:
+        item = infer_queue.get(block=True)
+        if item is None:
+            break
 
-        if floating_model:
-            input_data = (np.float32(input_data) - 127.5) / 127.5
+        seq, t_intended, start_time, decode_time, slot = item
+        start_infer_time = time.time_ns()
+        allocations.start()
 
-        interpreter.set_tensor(input_details[0]["index"], input_data)
+        # The image is converted into the input tensor, so the slot can be reused right after
+        model.write_input(images[slot], input_details[0], input_tensor()[0])
+        slots.free.put(slot)
 
-        # Do inference, parse and print output
+        # Do inference
         interpreter.invoke()
+        end_time = time.time_ns()
+        alloc = allocations.stop()
+
+        # Only pass the top-5 to the report stage if it is going to be printed
+        top_k = None
+        if sampled(seq, LOG_SAMPLE):
+            scores = model.to_scores(output_tensor()[0], output_details[0])
+            top_k = [(int(i), float(scores[i])) for i in model.top_k(scores)]
 
-        output_details = interpreter.get_output_details()
-        output_data = interpreter.get_tensor(output_details[0]["index"])
-        results = np.squeeze(output_data)
-
-        top_k = results.argsort()[-5:][::-1]
-        for i in top_k:
-            if floating_model:
-                print("\t{:08.6f} - {}".format(float(results[i]), labels[i]))
-            else:
-                print("\t{:08.6f} - {}".format(float(results[i] / 255.0), labels[i]))
-
-        # Time it took
-        now = time.time_ns()
-        print(
-            "Preparation, preprocessing and processing (ns): %i"
-            % (now - start_process_time)
+        report_queue.put(
+            [
+                seq,
+                start_time,
+                end_time,
+                end_time - t_intended,
+                decode_time,
+                decode_time + end_time - start_infer_time,
+                alloc,
+                top_k,
+            ]
         )
-        print("Latency (ns): %i" % (now - start_time))
+
+    # Memory of this process, while its model is loaded
+    memory_metrics = Metrics("memory", ["rss", "pss"])
+    memory_metrics.add(*memory_usage())
+    memory_metrics.flush()
+
+
+def report(report_queue):
+    """Report stage: record metrics, and print sampled results
+
+    Args:
+        report_queue (multiprocessing.Queue): Queue from the infer stage
+    """
+    labels = model.labels(MODEL)
+
+    metrics = Metrics(
+        "frames", ["start", "end", "latency", "decode", "processing", "alloc"]
+    )
+    processed = 0
+    while True:
+        item = report_queue.get(block=True)
+        if item is None:
+            break
+
+        seq, start, end, latency, decode_time, processing, alloc, top_k = item
+        metrics.add(start, end, latency, decode_time, processing, alloc)
+        processed += 1
+
+        if top_k is not None:
+            print("Decode (ns): %i" % (decode_time))
+            for i, score in top_k:
+                print("\t{:08.6f} - {}".format(score, labels[i]))
+
+            print("Preparation, preprocessing and processing (ns): %i" % (processing))
+            print("Latency (ns): %i" % (latency))
+
+    metrics.flush()
+
+    # Final counters, so the framework can tell a complete run from a cut-off one
+    done = Metrics("done", ["generated", "processed"])
+    done.add(MAX_IMGS, processed)
+    done.flush()
 
 
 def main():
-    # Start threads
-    queue = multiprocessing.Queue()
-    p2 = multiprocessing.Process(target=process, args=(queue,))
-    p2.start()
+    iw = ih = MODELS[MODEL]["size"]
+
+    # Infer processes are forked, so a model read here is shared by all of them
+    content = model.read(MODEL) if SHARED_MODEL == "True" else None
+
+    # Pick the layout of the infer stage before starting any stage
+    processes, threads, pinned = INFER_WORKERS, INFER_THREADS, PIN_CPUS == "True"
+    if CALIBRATE != "off":
+        processes, threads, pinned = calibrate.calibrate(
+            MODEL, CPU_THREADS, CALIBRATE, CALIBRATE_TIME, content
+        )
+
+    calibrate.report(processes, threads, pinned)
+
+    # Every decoded image in the pipeline needs a slot: queued, or held by a worker
+    slots = ImageSlots(QUEUE_SIZE + DECODE_WORKERS + processes, (ih, iw, 3))
+    decode_queue = multiprocessing.Queue(QUEUE_SIZE)
+    infer_queue = multiprocessing.Queue(QUEUE_SIZE)
+    report_queue = multiprocessing.Queue()
+    ready = multiprocessing.Barrier(processes + 1)
+
+    print(
+        "Pipeline: %i decode workers, %i infer workers with %i threads each"
+        % (DECODE_WORKERS, processes, threads)
+    )
+
+    # Start all stages, and only start generating once every model is loaded and warm
+    reporter = multiprocessing.Process(target=report, args=(report_queue,))
+    reporter.start()
+
+    inferers = []
+    for cpus in (
+        calibrate.cpu_sets(processes, threads) if pinned else [None] * processes
+    ):
+        p = multiprocessing.Process(
+            target=infer,
+            args=(infer_queue, report_queue, slots, ready, content, threads, cpus),
+        )
+        p.start()
+        inferers.append(p)
+
+    decoders = []
+    for _ in range(DECODE_WORKERS):
+        p = multiprocessing.Process(
+            target=decode, args=(decode_queue, infer_queue, slots, iw, ih)
+        )
+        p.start()
+        decoders.append(p)
+
+    ready.wait()
+    generator = multiprocessing.Process(target=generate, args=(decode_queue,))
+    generator.start()
+
+    # Stop the stages in order: each stage has received all its items once
+    # every worker of the stage before it has finished
+    generator.join()
+    for stage, workers in [(decode_queue, decoders), (infer_queue, inferers)]:
+        for _ in workers:
+            stage.put(None)
+
+        for p in workers:
+            p.join()
 
-    time.sleep(3)
-    p1 = multiprocessing.Process(target=generate, args=(queue,))
-    p1.start()
+    report_queue.put(None)
+    reporter.join()
+    slots.close()
 
-    # Wait for the generator to finish, then wait until the work queue is empty
-    p1.join()
-    while not queue.empty():
-        time.sleep(5)
+    # Report the accuracy cost of the model variant, after all timing-sensitive work
+    if MODEL != model.REFERENCE:
+        agreement = Metrics("agreement", ["top1", "top5"])
+        for top1, top5 in model.agreement(MODEL, "images", RESAMPLE):
+            agreement.add(top1, top5)
 
-    p2.terminate()
+        agreement.flush()
 
     print("Finished, processed %i images" % (MAX_IMGS))
 
@@ -0,0 +1,194 @@
+"""\
+Startup calibration of the inference layout shared by the applications that run inference.
+A layout is a number of inference processes, the number of interpreter threads per process,
+and whether each process is pinned to its own CPUs. Each candidate layout classifies the
+bundled images for a short time, and the layout with the best throughput or latency is used.
+The best layout depends on the CPU quota of the machine, which is why it is measured.
+"""
+
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from metrics import Metrics
+import model
+from preprocess import Preprocessor
+from variants import MODELS
+
+# What to optimize the layout for, "off" disables calibration
+OBJECTIVES = ["off", "throughput", "latency"]
+
+
+def layouts(cpus):
+    """Get the candidate layouts for a number of CPUs: every split of the CPUs over
+    processes and threads, with and without pinning processes to CPUs
+
+    Args:
+        cpus (int): Number of CPUs to use
+
+    Returns:
+        list(tuple(int, int, bool)): Processes, threads per process, and pinned per layout
+    """
+    candidates = []
+    for processes in range(1, cpus + 1):
+        if cpus % processes == 0:
+            for pinned in [False, True]:
+                candidates.append((processes, cpus // processes, pinned))
+
+    return candidates
+
+
+def cpu_sets(processes, threads):
+    """Split the CPUs this process can run on over a number of processes.
+    If there are fewer CPUs than needed, CPUs are shared round-robin.
+
+    Args:
+        processes (int): Number of processes
+        threads (int): Number of CPUs per process
+
+    Returns:
+        list(set(int)): CPUs per process
+    """
+    available = sorted(os.sched_getaffinity(0))
+    return [
+        {available[(i * threads + j) % len(available)] for j in range(threads)}
+        for i in range(processes)
+    ]
+
+
+def pin(cpus):
+    """Pin the calling process to a set of CPUs, threads started afterwards inherit this
+
+    Args:
+        cpus (set(int)): CPUs to run on, None to leave the affinity unchanged
+    """
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+
+
+def measure(name, content, threads, cpus, images, seconds, start, results):
+    """Classify images as fast as possible for a number of seconds, in a calibration process
+
+    Args:
+        name (str): Name of the model variant, see MODELS
+        content (bytes): Model read with model.read(), None to load the model file
+        threads (int): Number of interpreter threads
+        cpus (set(int)): CPUs to pin this process to, None to not pin
+        images (list(np.ndarray)): Decoded images of the model input size
+        seconds (float): Time to measure for
+        start (multiprocessing.Barrier): Passed by all processes of the layout at once
+        results (multiprocessing.Queue): Queue to put the latency of each invocation on
+    """
+    pin(cpus)
+    interpreter = model.load(name, threads, content)
+    input_details = interpreter.get_input_details()[0]
+    inputs = [model.to_input(np.expand_dims(i, 0), input_details) for i in images]
+
+    # Warm up outside of the measurement
+    interpreter.set_tensor(input_details["index"], inputs[0])
+    interpreter.invoke()
+
+    start.wait()
+    latencies = []
+    end_time = time.time_ns() + int(seconds * 10**9)
+    while time.time_ns() < end_time:
+        start_time = time.time_ns()
+        interpreter.set_tensor(
+            input_details["index"], inputs[len(latencies) % len(inputs)]
+        )
+        interpreter.invoke()
+        latencies.append(time.time_ns() - start_time)
+
+    results.put(latencies)
+
+
+def calibrate(name, cpus, objective, seconds=2, content=None, image_dir="images"):
+    """Measure all candidate layouts, and pick the best one
+
+    Args:
+        name (str): Name of the model variant, see MODELS
+        cpus (int): Number of CPUs to use
+        objective (str): Optimize for "throughput" (images per second of all processes)
+            or "latency" (average time per image)
+        seconds (float, optional): Time to measure each layout for. Defaults to 2.
+        content (bytes, optional): Model read with model.read(), shared by the
+            calibration processes. Defaults to None.
+        image_dir (str, optional): Folder with the JPEG images to classify. Defaults to "images".
+
+    Returns:
+        tuple(int, int, bool): Processes, threads per process, and pinned of the best layout
+    """
+    if objective not in OBJECTIVES[1:]:
+        raise ValueError("Unknown calibration objective %s" % (objective))
+
+    size = MODELS[name]["size"]
+    preprocessor = Preprocessor(size, size)
+    images = []
+    for file in sorted(os.listdir(image_dir)):
+        if file.endswith(".JPEG"):
+            with open(os.path.join(image_dir, file), "rb") as f:
+                images.append(preprocessor(f.read())[0])
+
+    # Throughput in images per 1000 seconds, as metrics are integers
+    metrics = Metrics(
+        "calibration", ["processes", "threads", "pinned", "throughput", "latency"]
+    )
+    best, best_score = None, None
+    for processes, threads, pinned in layouts(cpus):
+        sets = cpu_sets(processes, threads) if pinned else [None] * processes
+        start = multiprocessing.Barrier(processes)
+        results = multiprocessing.Queue()
+
+        workers = [
+            multiprocessing.Process(
+                target=measure,
+                args=(name, content, threads, cpu_set, images, seconds, start, results),
+            )
+            for cpu_set in sets
+        ]
+        for p in workers:
+            p.start()
+
+        latencies = [latency for _ in workers for latency in results.get()]
+        for p in workers:
+            p.join()
+
+        throughput = len(latencies) / seconds
+        latency = int(np.mean(latencies))
+        metrics.add(processes, threads, int(pinned), int(throughput * 1000), latency)
+        print(
+            "Layout %i x %i threads%s: %.2f images/s, %.2f ms/image"
+            % (
+                processes,
+                threads,
+                " (pinned)" if pinned else "",
+                throughput,
+                latency / 10**6,
+            )
+        )
+
+        score = throughput if objective == "throughput" else -latency
+        if best_score is None or score > best_score:
+            best, best_score = (processes, threads, pinned), score
+
+    metrics.flush()
+    return best
+
+
+def report(processes, threads, pinned):
+    """Report the layout that is used, calibrated or not
+
+    Args:
+        processes (int): Number of inference processes
+        threads (int): Number of interpreter threads per process
+        pinned (bool): Processes are pinned to their own CPUs
+    """
+    print(
+        "Inference layout: %i processes with %i threads each%s"
+        % (processes, threads, ", pinned" if pinned else "")
+    )
+    metrics = Metrics("layout", ["processes", "threads", "pinned"])
+    metrics.add(processes, threads, int(pinned))
+    metrics.flush()
@@ -0,0 +1,81 @@
+"""\
+Binary frame header shared by the publisher and subscriber.
+Every payload starts with this header, followed by the encoded image or the ready model
+input (if any).
+Workers echo the header back to the endpoint as reply, so the endpoint can
+correlate replies with sent frames and detect reordering and loss.
+"""
+
+import socket
+import struct
+
+VERSION = 1
+
+# Frame types
+FRAME = 0  # Header followed by an image
+DONE = 1  # Endpoint finished sending, no image follows
+DROPPED = 2  # Reply from a worker that dropped the frame instead of processing it
+TENSOR = 3  # Header followed by a ready model input: uint8 RGB, height x width x 3
+
+# Version, type, endpoint id, sequence number, send time (ns), reply IPv4 address, reply port
+HEADER = struct.Struct("!BBHIQ4sH")
+HEADER_SIZE = HEADER.size
+
+
+def pack_header(kind, endpoint_id, seq, t_send, ip, port=1883):
+    """Create a frame header
+
+    Args:
+        kind (int): Frame type, FRAME, DONE, DROPPED or TENSOR
+        endpoint_id (int): ID of the sending endpoint
+        seq (int): Sequence number of the frame on this endpoint
+        t_send (int): Send time in ns
+        ip (str): IPv4 address to send the reply to
+        port (int, optional): Port to send the reply to. Defaults to 1883.
+
+    Returns:
+        bytes: Packed header
+    """
+    return HEADER.pack(
+        VERSION, kind, endpoint_id, seq, t_send, socket.inet_aton(ip), port
+    )
+
+
+def pack_header_into(buffer, kind, endpoint_id, seq, t_send, ip, port=1883):
+    """Write a frame header to the start of an existing buffer, in place
+
+    Args:
+        buffer (bytearray): Payload to write the header to
+        kind (int): Frame type, FRAME, DONE, DROPPED or TENSOR
+        endpoint_id (int): ID of the sending endpoint
+        seq (int): Sequence number of the frame on this endpoint
+        t_send (int): Send time in ns
+        ip (str): IPv4 address to send the reply to
+        port (int, optional): Port to send the reply to. Defaults to 1883.
+    """
+    HEADER.pack_into(
+        buffer, 0, VERSION, kind, endpoint_id, seq, t_send, socket.inet_aton(ip), port
+    )
+
+
+def unpack_header(data):
+    """Parse the frame header at the start of a payload
+
+    Args:
+        data (bytes): Received payload
+
+    Raises:
+        ValueError: The payload is too short or uses another header version
+
+    Returns:
+        int, int, int, int, str, int: Frame type, endpoint id, sequence number,
+            send time in ns, reply IPv4 address and reply port
+    """
+    if len(data) < HEADER_SIZE:
+        raise ValueError("Payload of %i bytes is too short for a header" % (len(data)))
+
+    version, kind, endpoint_id, seq, t_send, ip, port = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError("Unsupported frame header version %i" % (version))
+
+    return kind, endpoint_id, seq, t_send, socket.inet_ntoa(ip), port
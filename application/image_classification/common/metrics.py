@@ -0,0 +1,126 @@
+"""\
+Low-overhead metric recording shared by the applications.
+Per-frame metrics are kept in compact integer arrays, and written out in chunks:
+a single "Metrics <name>: <json>" line per chunk instead of several lines per frame.
+"""
+
+import json
+import tracemalloc
+from array import array
+
+
+class Metrics:
+    def __init__(self, name, fields, chunk=200):
+        """Initialize the object
+
+        Args:
+            name (str): Name of this set of metrics, e.g. "frames"
+            fields (list(str)): Name of each value recorded per frame
+            chunk (int, optional): Write out the metrics after this many frames. Keep chunks
+                below the 16 KB at which Docker and Kubernetes split log lines. Defaults to 200.
+        """
+        self.name = name
+        self.fields = fields
+        self.chunk = chunk
+        self.values = [array("q") for _ in fields]
+        self.count = 0
+
+    def add(self, *values):
+        """Record the metrics of one frame, in the order of the fields
+
+        Args:
+            values (int): Value per field
+        """
+        for column, value in zip(self.values, values):
+            column.append(value)
+
+        self.count += 1
+        if self.count >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        """Write out the recorded metrics as one JSON line, and start a new chunk"""
+        if self.count == 0:
+            return
+
+        chunk = {
+            field: column.tolist() for field, column in zip(self.fields, self.values)
+        }
+        # Write the line in one go, so lines of concurrent processes do not interleave
+        print(
+            "Metrics %s: %s\n" % (self.name, json.dumps(chunk, separators=(",", ":"))),
+            end="",
+        )
+
+        self.values = [array("q") for _ in self.fields]
+        self.count = 0
+
+
+class AllocationCounter:
+    """Measure the memory allocated while processing a frame, using tracemalloc.
+    Tracing slows down every allocation, so only enable this to find allocations in a hot loop.
+    """
+
+    def __init__(self, enabled):
+        """Initialize the object
+
+        Args:
+            enabled (bool): Trace allocations, or only return 0
+        """
+        self.enabled = enabled
+        if enabled:
+            tracemalloc.start()
+
+    def start(self):
+        """Start measuring a frame"""
+        if self.enabled:
+            tracemalloc.clear_traces()
+
+    def stop(self):
+        """Stop measuring a frame
+
+        Returns:
+            int: Peak memory in bytes allocated since start(), 0 if disabled
+        """
+        if not self.enabled:
+            return 0
+
+        return tracemalloc.get_traced_memory()[1]
+
+
+def memory_usage():
+    """Get the memory usage of the calling process.
+    RSS counts pages shared with other processes (e.g. a shared model) in full for every
+    process, PSS divides them over the processes sharing them.
+
+    Returns:
+        int, int: RSS and PSS in bytes, PSS is 0 if the kernel does not report it
+    """
+    usage = {"Rss:": 0, "Pss:": 0}
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                key, value = line.split()[:2]
+                if key in usage:
+                    usage[key] = int(value) * 1024
+    except OSError:
+        # Kernels before 4.14 only report RSS
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    usage["Rss:"] = int(line.split()[1]) * 1024
+
+    return usage["Rss:"], usage["Pss:"]
+
+
+def sampled(i, every):
+    """Check if frame i should be logged in human-readable form
+
+    Args:
+        i (int): Frame number
+        every (int): Log every n-th frame, 0 disables logging
+
+    Returns:
+        bool: Log this frame or not
+    """
+    return every > 0 and i % every == 0
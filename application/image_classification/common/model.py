@@ -0,0 +1,225 @@
+"""\
+Model helpers shared by the applications that run inference.
+Models are selected by name from the registry of variants in variants.py, which are placed
+in the model folder next to labels.txt. Images are always decoded to uint8 RGB, and converted to the input type
+of the chosen variant here.
+"""
+
+import tflite_runtime.interpreter as tflite
+import numpy as np
+import os
+
+from preprocess import Preprocessor
+from variants import MODELS, REFERENCE
+
+
+def read(name):
+    """Read the model file of a variant into memory. When read before forking inference
+    processes, all processes share these pages, and can create an interpreter on them.
+
+    Args:
+        name (str): Name of the variant, see MODELS
+
+    Returns:
+        bytes: Content of the model file
+    """
+    if name not in MODELS:
+        raise ValueError("Unknown model variant %s" % (name))
+
+    with open(MODELS[name]["file"], "rb") as f:
+        return f.read()
+
+
+def load(name, num_threads=1, content=None):
+    """Create an interpreter for a model variant, and allocate its tensors
+
+    Args:
+        name (str): Name of the variant, see MODELS
+        num_threads (int, optional): Number of threads used by the interpreter. Defaults to 1.
+        content (bytes, optional): Model read with read(), used instead of loading the
+            model file. Defaults to None.
+
+    Returns:
+        tflite.Interpreter: Interpreter with allocated tensors
+    """
+    if name not in MODELS:
+        raise ValueError("Unknown model variant %s" % (name))
+
+    if content is not None:
+        interpreter = tflite.Interpreter(model_content=content, num_threads=num_threads)
+    else:
+        interpreter = tflite.Interpreter(
+            model_path=MODELS[name]["file"], num_threads=num_threads
+        )
+
+    interpreter.allocate_tensors()
+    return interpreter
+
+
+def labels(name):
+    """Load the labels of a model variant, indexed by output class
+
+    Args:
+        name (str): Name of the variant, see MODELS
+
+    Returns:
+        list(str): Label per output class
+    """
+    with open("labels.txt", "r") as f:
+        lines = [line.strip() for line in f.readlines()]
+
+    return lines[MODELS[name]["labels_offset"] :]
+
+
+def to_input(images, input_details):
+    """Convert a batch of uint8 RGB images to the input type of a model
+
+    Args:
+        images (np.ndarray): Batch of images, uint8
+        input_details (dict): Input details of the interpreter
+
+    Returns:
+        np.ndarray: Model input
+    """
+    if input_details["dtype"] == np.float32:
+        return (np.float32(images) - 127.5) / 127.5
+    elif input_details["dtype"] == np.int8:
+        return (images.astype(np.int16) - 128).astype(np.int8)
+
+    return images
+
+
+def write_input(image, input_details, buffer):
+    """Convert a uint8 RGB image to the input type of a model, like to_input(), but write
+    the result straight into a buffer of the input type instead of allocating a new array.
+    The buffer is typically a view on the input tensor of the interpreter (interpreter.tensor()).
+
+    Args:
+        image (np.ndarray): Image, uint8 with shape (height, width, 3)
+        input_details (dict): Input details of the interpreter
+        buffer (np.ndarray): Buffer of the input type with the same shape as the image
+    """
+    if input_details["dtype"] == np.float32:
+        np.subtract(image, np.float32(127.5), out=buffer)
+        np.divide(buffer, np.float32(127.5), out=buffer)
+    elif input_details["dtype"] == np.int8:
+        # x - 128 as int8 has the same bits as x XOR 0x80 as uint8
+        np.bitwise_xor(image, np.uint8(0x80), out=buffer.view(np.uint8))
+    else:
+        buffer[...] = image
+
+
+def top_k(scores, k=5):
+    """Get the classes with the highest scores, without sorting all scores
+
+    Args:
+        scores (np.ndarray): Score per class
+        k (int, optional): Number of classes. Defaults to 5.
+
+    Returns:
+        np.ndarray: Index of the k best classes, best first
+    """
+    top = np.argpartition(scores, -k)[-k:]
+    return top[np.argsort(scores[top])[::-1]]
+
+
+def to_scores(output, output_details):
+    """Convert the output of a model to float scores
+
+    Args:
+        output (np.ndarray): Model output
+        output_details (dict): Output details of the interpreter
+
+    Returns:
+        np.ndarray: Scores between 0 and 1 per class
+    """
+    if output_details["dtype"] == np.float32:
+        return output
+
+    scale, zero_point = output_details["quantization"]
+    if scale == 0:
+        return output / 255.0
+
+    return (output.astype(np.float32) - zero_point) * scale
+
+
+def warm_up(interpreter, invocations):
+    """Invoke a freshly allocated interpreter on synthetic input, so lazy kernel setup
+    and cache warm-up happen before the first real image instead of during it.
+
+    Args:
+        interpreter (tflite.Interpreter): Interpreter with allocated tensors
+        invocations (int): Number of synthetic invocations, 0 disables warm-up
+    """
+    input_details = interpreter.get_input_details()[0]
+    data = np.zeros(input_details["shape"], dtype=input_details["dtype"])
+
+    for _ in range(invocations):
+        interpreter.set_tensor(input_details["index"], data)
+        interpreter.invoke()
+
+
+def predict(name, paths, resample="bicubic"):
+    """Get the top-5 labels of a model variant for a list of images
+
+    Args:
+        name (str): Name of the variant, see MODELS
+        paths (list(str)): Paths to JPEG images
+        resample (str, optional): Resampling filter, see preprocess.FILTERS. Defaults to "bicubic".
+
+    Returns:
+        list(list(str)): Top-5 labels per image, best first
+    """
+    interpreter = load(name)
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    names = labels(name)
+
+    preprocessor = Preprocessor(
+        input_details["shape"][2], input_details["shape"][1], resample
+    )
+
+    predictions = []
+    for path in paths:
+        with open(path, "rb") as f:
+            image, _ = preprocessor(f.read())
+
+        interpreter.set_tensor(
+            input_details["index"], to_input(np.expand_dims(image, 0), input_details)
+        )
+        interpreter.invoke()
+
+        scores = to_scores(
+            interpreter.get_tensor(output_details["index"])[0], output_details
+        )
+        predictions.append([names[i] for i in top_k(scores)])
+
+    return predictions
+
+
+def agreement(name, image_dir="images", resample="bicubic"):
+    """Compare the predictions of a model variant to the reference variant.
+    Top-1 agreement: both variants predict the same label.
+    Top-5 agreement: the label predicted by the reference is in the top-5 of the variant.
+
+    Args:
+        name (str): Name of the variant, see MODELS
+        image_dir (str, optional): Folder with the JPEG images to compare on. Defaults to "images".
+        resample (str, optional): Resampling filter, see preprocess.FILTERS. Defaults to "bicubic".
+
+    Returns:
+        list(list(int)): Top-1 and top-5 agreement (0 or 1) per image
+    """
+    paths = [
+        os.path.join(image_dir, file)
+        for file in sorted(os.listdir(image_dir))
+        if file.endswith(".JPEG")
+    ]
+
+    variant = predict(name, paths, resample)
+    reference = predict(REFERENCE, paths, resample)
+
+    return [
+        [int(top[0] == ref[0]), int(ref[0] in top)]
+        for top, ref in zip(variant, reference)
+    ]
@@ -0,0 +1,109 @@
+"""\
+Image preprocessing shared by the applications that do image classification.
+Decodes received JPEG images directly at (close to) the input size of the model,
+and optionally caches ready input images so repeated images are only decoded once.
+Endpoints can use the same steps to preprocess images before offloading them (see SPLITS).
+"""
+
+import PIL.Image as Image
+import numpy as np
+import io
+import time
+import hashlib
+from collections import OrderedDict
+
+# Resampling filters that can be selected for resizing images to the model input size
+FILTERS = {
+    "nearest": Image.NEAREST,
+    "box": Image.BOX,
+    "bilinear": Image.BILINEAR,
+    "hamming": Image.HAMMING,
+    "bicubic": Image.BICUBIC,
+    "lanczos": Image.LANCZOS,
+}
+
+# Stages an endpoint can preprocess images up to before offloading them:
+# - none: send the original JPEG image, the worker decodes and resizes it
+# - resize: decode and resize to the model input size, and send it re-encoded as JPEG
+# - tensor: send the model input image as raw uint8 RGB pixels, the worker only runs the model
+SPLITS = ["none", "resize", "tensor"]
+
+
+def encode(image, quality=90):
+    """Encode an RGB image as JPEG
+
+    Args:
+        image (numpy.ndarray): Image as uint8 array with shape (height, width, 3)
+        quality (int, optional): JPEG quality, between 1 and 95. Defaults to 90.
+
+    Returns:
+        bytes: Encoded image
+    """
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+class Preprocessor:
+    def __init__(self, width, height, resample="bicubic", cache_size=0):
+        """Initialize the object
+
+        Args:
+            width (int): Width of the model input
+            height (int): Height of the model input
+            resample (str, optional): Resampling filter, see FILTERS. Defaults to "bicubic".
+            cache_size (int, optional): Number of ready images to cache, 0 disables caching. Defaults to 0.
+        """
+        self.size = (width, height)
+        self.resample = FILTERS[resample]
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def decode(self, data):
+        """Decode a JPEG image to an RGB image of the model input size.
+        Let the JPEG decoder downscale in the DCT domain first (draft mode),
+        so the full resolution image is never decoded.
+
+        Args:
+            data (bytes): Encoded image
+
+        Returns:
+            numpy.ndarray: Image as uint8 array with shape (height, width, 3)
+        """
+        image = Image.open(io.BytesIO(data))
+        image.draft("RGB", self.size)
+        image = image.convert(mode="RGB").resize(self.size, resample=self.resample)
+        return np.asarray(image)
+
+    def __call__(self, data):
+        """Get the model input image for an encoded image, from cache if possible
+
+        Args:
+            data (bytes): Encoded image
+
+        Returns:
+            numpy.ndarray, int: Image as uint8 array, and time spent decoding in ns
+        """
+        start_time = time.time_ns()
+
+        if self.cache_size == 0:
+            return self.decode(data), time.time_ns() - start_time
+
+        key = hashlib.blake2b(data, digest_size=16).digest()
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key], time.time_ns() - start_time
+
+        self.misses += 1
+        image = self.decode(data)
+        image.flags.writeable = False
+
+        self.cache[key] = image
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return image, time.time_ns() - start_time
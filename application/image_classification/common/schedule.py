@@ -0,0 +1,56 @@
+"""\
+Open-loop frame scheduler shared by the applications that generate images.
+Frames are scheduled on absolute deadlines computed from the start of the run,
+so a frame that is sent late does not push back the frames after it.
+"""
+
+import random
+import time
+
+# Inter-arrival time distributions
+ARRIVALS = ["constant", "poisson"]
+
+
+class Schedule:
+    def __init__(self, frequency, arrival="constant"):
+        """Initialize the object
+
+        Args:
+            frequency (float): Average number of frames per second
+            arrival (str, optional): Inter-arrival distribution, see ARRIVALS. Defaults to "constant".
+        """
+        if arrival not in ARRIVALS:
+            raise ValueError("Unknown arrival distribution %s" % (arrival))
+
+        self.frequency = frequency
+        self.arrival = arrival
+        self.deadline = None
+
+    def interval(self):
+        """Get the time until the next frame should be sent
+
+        Returns:
+            int: Inter-arrival time in ns
+        """
+        if self.arrival == "poisson":
+            return int(random.expovariate(self.frequency) * 10**9)
+
+        return int(10**9 / self.frequency)
+
+    def wait(self):
+        """Wait until the next frame should be sent.
+        The first call starts the schedule and returns immediately.
+
+        Returns:
+            int, int: Intended send time of the frame in ns, and how late we are for it in ns
+        """
+        if self.deadline is None:
+            self.deadline = time.time_ns()
+        else:
+            self.deadline += self.interval()
+
+        remaining = self.deadline - time.time_ns()
+        if remaining > 0:
+            time.sleep(remaining / 10**9)
+
+        return self.deadline, max(time.time_ns() - self.deadline, 0)
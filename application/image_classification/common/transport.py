@@ -0,0 +1,194 @@
+"""\
+Transports between publisher and subscriber, and the framing of the direct (brokerless) ones.
+Each transport implements Sender on the endpoint (publisher) and Receiver on the worker
+(subscriber), which pick their implementation by name with select().
+- mqtt: images go through the MQTT broker of the worker, replies through the broker of the endpoint.
+- tcp: one connection per endpoint, every message is prefixed with its length.
+  Replies are sent back over the same connection.
+- udp: messages are split into datagrams of at most FRAGMENT_SIZE bytes, each prefixed with
+  a fragment header, and reassembled by the receiver. Replies are single datagrams sent to
+  the reply address in the frame header. Messages with a lost fragment are lost as a whole.
+"""
+
+import struct
+from collections import OrderedDict
+
+TRANSPORTS = ["mqtt", "tcp", "udp"]
+
+
+class Sender:
+    """Endpoint side of a transport: send messages to the worker.
+    Replies are passed to the reply handler of the publisher as they arrive.
+
+    Attributes:
+        port (int): Port the endpoint receives replies on, sent along in every frame header
+    """
+
+    port = 0
+
+    def send(self, seq, payload):
+        """Send a frame
+
+        Args:
+            seq (int): Sequence number of the frame
+            payload (bytearray): Frame header and image
+        """
+        raise NotImplementedError
+
+    def send_done(self, seq, payload):
+        """Send the finish message, making sure it arrives as far as the transport allows
+
+        Args:
+            seq (int): Sequence number of the message
+            payload (bytes): Frame header
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Stop sending, and stop receiving replies"""
+        raise NotImplementedError
+
+
+class Receiver:
+    """Worker side of a transport: receive messages from the endpoints, and send replies back.
+    Runs in the asyncio event loop of the subscriber.
+
+    Attributes:
+        paused (bool): Whether reading is paused, see pause_reading()
+        metrics (Metrics): Time to set up each connection to an endpoint
+    """
+
+    paused = False
+
+    async def listen(self, receive):
+        """Start receiving messages
+
+        Args:
+            receive (function): Called with every received message
+        """
+        raise NotImplementedError
+
+    def pause_reading(self):
+        """Stop reading messages, so the endpoints or the network hold them back"""
+        raise NotImplementedError
+
+    def resume_reading(self):
+        """Start reading messages again"""
+        raise NotImplementedError
+
+    async def publish(self, ip, port, payload):
+        """Send a reply to an endpoint
+
+        Args:
+            ip (str): IP of the endpoint, from the frame header
+            port (int): Reply port of the endpoint, from the frame header
+            payload (bytes): Reply to send
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Stop receiving messages, and close all connections"""
+        raise NotImplementedError
+
+
+def select(implementations, name):
+    """Get the implementation of a transport by name
+
+    Args:
+        implementations (dict): Implementation per transport name, Sender or Receiver classes
+        name (str): Name of the transport, one of TRANSPORTS
+
+    Raises:
+        ValueError: The transport is unknown
+
+    Returns:
+        class: Implementation of the transport
+    """
+    if name not in TRANSPORTS or name not in implementations:
+        raise ValueError("Unknown transport %s" % (name))
+
+    return implementations[name]
+
+
+# TCP: message length
+LENGTH = struct.Struct("!I")
+
+# UDP: message id, fragment index, number of fragments
+FRAGMENT = struct.Struct("!IHH")
+FRAGMENT_SIZE = 60000
+
+
+def fragments(message_id, payload):
+    """Split a message into UDP datagrams, without copying the payload
+
+    Args:
+        message_id (int): ID of the message, unique per sender for the messages in flight
+        payload (bytes): Message to split
+
+    Returns:
+        list(list): Fragment header and payload slice per datagram, to send with sendmsg()
+    """
+    view = memoryview(payload)
+    count = max(1, -(-len(payload) // FRAGMENT_SIZE))
+    return [
+        [
+            FRAGMENT.pack(message_id, i, count),
+            view[i * FRAGMENT_SIZE : (i + 1) * FRAGMENT_SIZE],
+        ]
+        for i in range(count)
+    ]
+
+
+class Reassembler:
+    """Reassemble messages from UDP datagrams created by fragments()"""
+
+    def __init__(self, max_partial=64):
+        """Initialize the object
+
+        Args:
+            max_partial (int, optional): Max number of incomplete messages to keep. Once exceeded,
+                the oldest incomplete message is considered lost. Defaults to 64.
+        """
+        self.max_partial = max_partial
+        self.partial = OrderedDict()
+        self.lost = 0
+
+    def add(self, addr, datagram):
+        """Add a received datagram
+
+        Args:
+            addr (tuple): Address of the sender
+            datagram (bytes): Received datagram
+
+        Raises:
+            ValueError: The datagram is too short or its fragment header is invalid
+
+        Returns:
+            bytes: The complete message if this was its last missing fragment, None otherwise
+        """
+        if len(datagram) < FRAGMENT.size:
+            raise ValueError("Datagram of %i bytes is too short" % (len(datagram)))
+
+        message_id, index, count = FRAGMENT.unpack_from(datagram)
+        if index >= count:
+            raise ValueError(
+                "Fragment %i of a message with %i fragments" % (index, count)
+            )
+
+        if count == 1:
+            return datagram[FRAGMENT.size :]
+
+        key = (addr, message_id)
+        if key not in self.partial:
+            self.partial[key] = [None] * count
+            if len(self.partial) > self.max_partial:
+                self.partial.popitem(last=False)
+                self.lost += 1
+
+        parts = self.partial[key]
+        parts[index] = datagram[FRAGMENT.size :]
+        if any(part is None for part in parts):
+            return None
+
+        del self.partial[key]
+        return b"".join(parts)
@@ -0,0 +1,34 @@
+"""\
+Registry of the model variants used for image classification.
+Kept apart from model.py, so applications without TFLite (the publisher) can look up
+the input size of a variant to prepare images for it.
+"""
+
+# Model variants: file in the model folder, input width and height, and the first line of
+# labels.txt used by the model (models without a background class skip the first label)
+MODELS = {
+    "mobilenet_v2": {"file": "model.tflite", "size": 224, "labels_offset": 0},
+    "mobilenet_v2_quant": {
+        "file": "mobilenet_v2_1.0_224_quant.tflite",
+        "size": 224,
+        "labels_offset": 0,
+    },
+    "mobilenet_v2_160": {
+        "file": "mobilenet_v2_1.0_160.tflite",
+        "size": 160,
+        "labels_offset": 0,
+    },
+    "mobilenet_v2_160_quant": {
+        "file": "mobilenet_v2_1.0_160_quant.tflite",
+        "size": 160,
+        "labels_offset": 0,
+    },
+    "efficientnet_lite0_int8": {
+        "file": "efficientnet_lite0_int8.tflite",
+        "size": 224,
+        "labels_offset": 1,
+    },
+}
+
+# Variant the accuracy of other variants is compared against
+REFERENCE = "mobilenet_v2"
@@ -1,4 +1,6 @@
 #!/bin/bash
 cp -r ../images src/
+cp ../common/* ./src/
 docker buildx build --platform linux/amd64,linux/arm64 -t redplanet00/kubeedge-applications:image_classification_publisher --push .
 rm -r src/images
+rm src/preprocess.py src/frame.py src/schedule.py src/metrics.py src/model.py src/transport.py src/variants.py src/calibrate.py
@@ -1,23 +1,65 @@
 """\
-This is a publisher, sending local images over MQTT to a subscriber for further processing.
+This is a publisher, sending local images to a subscriber for further processing.
+Images are sent over MQTT, or directly over TCP or UDP (see common/transport.py).
+Images can be preprocessed up to a chosen stage before sending (see common/preprocess.py SPLITS),
+so the worker skips the stages that were already done.
+With a latency target, the send rate is adapted to the reply latency (see RateController).
 """
 
 import paho.mqtt.client as mqtt
 import time
 import os
+import socket
+import threading
+
+import frame
+import transport
+from metrics import Metrics, sampled
+from preprocess import Preprocessor, SPLITS, encode
+from schedule import Schedule
+from variants import MODELS, REFERENCE
 
 MQTT_LOCAL_IP = os.environ["MQTT_LOCAL_IP"]
 MQTT_REMOTE_IP = os.environ["MQTT_REMOTE_IP"]
 MQTT_LOGS = os.environ["MQTT_LOGS"]
 FREQUENCY = int(os.environ["FREQUENCY"])
+ENDPOINT_ID = int(os.environ.get("ENDPOINT_ID", 0))
+ARRIVAL = os.environ.get("ARRIVAL", "constant")
+LOG_SAMPLE = int(os.environ.get("LOG_SAMPLE", 0))
+TRANSPORT = os.environ.get("TRANSPORT", "mqtt")
+TRANSPORT_PORT = int(os.environ.get("TRANSPORT_PORT", 5000))
+REPLY_TIMEOUT = float(os.environ.get("REPLY_TIMEOUT", 60))
+OFFLOAD_SPLIT = os.environ.get("OFFLOAD_SPLIT", "none")
+MODEL = os.environ.get("MODEL", REFERENCE)
+RESAMPLE = os.environ.get("RESAMPLE", "bicubic")
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", 90))
+LATENCY_TARGET = int(os.environ.get("LATENCY_TARGET", 0))
+RATE_INTERVAL = float(os.environ.get("RATE_INTERVAL", 1))
+MAX_FREQUENCY = float(os.environ.get("MAX_FREQUENCY", 4 * FREQUENCY))
 MQTT_TOPIC = "kubeedge-image-classification"
 
 # Set how many imgs to send, and how often
 DURATION = 300
-SEC_PER_FRAME = float(1 / FREQUENCY)
 MAX_IMGS = FREQUENCY * DURATION
 
+# With a latency target, frames are sent for DURATION seconds at an adapted rate instead
+if LATENCY_TARGET > 0:
+    MAX_IMGS = int(MAX_FREQUENCY * DURATION)
+
+sent = 0
 received = 0
+out_of_order = 0
+duplicates = 0
+dropped = 0
+last_seq = -1
+seen = bytearray(MAX_IMGS)
+
+# Notified on every reply, so waiting for the last replies does not need polling
+progress = threading.Condition()
+
+sent_metrics = Metrics("sent", ["lateness", "preparation", "preprocess", "size"])
+reply_metrics = Metrics("replies", ["latency"])
+drop_metrics = Metrics("dropped", ["seq"])
 
 
 def on_connect(local_client, userdata, flags, rc):
@@ -34,105 +76,454 @@ def on_log(client, userdata, level, buff):
 
 
 def on_message(client, userdata, msg):
-    t_now = time.time_ns()
+    on_reply(msg.payload)
 
-    t_old_bytes = msg.payload[-25:]
-    t_old = int(t_old_bytes.decode("utf-8"))
 
-    print("Latency (ns): %i" % (t_now - t_old))
-    global received
+def on_reply(payload):
+    t_now = time.time_ns()
+
+    # The worker echoes the header of the frame it processed, or dropped
+    kind, _, seq, t_old, _, _ = frame.unpack_header(payload)
+
+    if kind == frame.DROPPED:
+        drop_metrics.add(seq)
+        if controller is not None:
+            controller.on_drop()
+    else:
+        reply_metrics.add(t_now - t_old)
+        if controller is not None:
+            controller.on_reply(t_now - t_old)
+        if sampled(seq, LOG_SAMPLE):
+            print("Latency (ns): %i" % (t_now - t_old))
+
+    global received, out_of_order, duplicates, dropped, last_seq
+    if seen[seq]:
+        duplicates += 1
+        return
+
+    # Dropped frames are answered as well, so every frame gets exactly one reply
+    seen[seq] = 1
     received += 1
+    if kind == frame.DROPPED:
+        dropped += 1
+
+    if seq < last_seq:
+        out_of_order += 1
+    else:
+        last_seq = seq
+
+    with progress:
+        progress.notify()
 
 
 def on_publish(mqttc, obj, mid):
     print("Published data")
 
 
-def connect():
-    print("Start connecting to the local MQTT broker")
-    print("Broker ip: " + str(MQTT_LOCAL_IP))
-    print("Topic: " + str(MQTT_TOPIC))
+class MqttSender(transport.Sender):
+    """Send frames to the MQTT broker of the worker, replies arrive through the local MQTT broker"""
 
-    local_client = mqtt.Client()
-    local_client.on_connect = on_connect
-    local_client.on_message = on_message
-    local_client.on_subscribe = on_subscribe
+    def __init__(self):
+        """Initialize the object: connect to the local and remote MQTT brokers"""
+        self.port = 1883
 
-    if MQTT_LOGS == "True":
-        local_client.on_log = on_log
+        print("Start connecting to the local MQTT broker")
+        print("Broker ip: " + str(MQTT_LOCAL_IP))
+        print("Topic: " + str(MQTT_TOPIC))
 
-    local_client.connect(MQTT_LOCAL_IP, port=1883, keepalive=300)
-    local_client.loop_start()
+        self.local_client = mqtt.Client()
+        self.local_client.on_connect = on_connect
+        self.local_client.on_message = on_message
+        self.local_client.on_subscribe = on_subscribe
 
+        if MQTT_LOGS == "True":
+            self.local_client.on_log = on_log
 
-def send():
-    # Loop over the dataset of 60 images
-    files = []
-    for file in os.listdir("images"):
+        self.local_client.connect(MQTT_LOCAL_IP, port=1883, keepalive=300)
+        self.local_client.loop_start()
+
+        print("Start connecting to the remote MQTT broker")
+        print("Broker ip: " + str(MQTT_REMOTE_IP))
+        print("Topic: " + str(MQTT_TOPIC))
+
+        self.remote_client = mqtt.Client()
+        if LOG_SAMPLE == 1:
+            self.remote_client.on_publish = on_publish
+
+        self.remote_client.connect(MQTT_REMOTE_IP, port=1883, keepalive=120)
+        print("Connected with the broker")
+
+    def send(self, seq, payload):
+        """Send a frame
+
+        Args:
+            seq (int): Sequence number of the frame
+            payload (bytearray): Frame header and image
+        """
+        self.remote_client.publish(MQTT_TOPIC, payload, qos=0)
+
+    def send_done(self, seq, payload):
+        """Send the finish message, making sure it arrives
+
+        Args:
+            seq (int): Sequence number of the message
+            payload (bytes): Frame header
+        """
+        self.remote_client.loop_start()
+        self.remote_client.publish(MQTT_TOPIC, payload, qos=2)
+        self.remote_client.loop_stop()
+
+    def close(self):
+        self.remote_client.disconnect()
+        self.local_client.loop_stop()
+        self.local_client.disconnect()
+
+
+class TcpSender(transport.Sender):
+    """Send frames over a direct TCP connection to the worker, replies arrive over the same connection"""
+
+    def __init__(self):
+        """Initialize the object: connect to the worker, and start receiving replies"""
+        self.port = TRANSPORT_PORT
+
+        print("Start connecting to the worker over TCP")
+        print("Worker address: %s:%i" % (MQTT_REMOTE_IP, TRANSPORT_PORT))
+
+        self.sock = socket.create_connection((MQTT_REMOTE_IP, TRANSPORT_PORT))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=self.receive, daemon=True).start()
+        print("Connected with the worker")
+
+    def receive(self):
+        """Receive length-prefixed replies until the connection is closed"""
+        stream = self.sock.makefile("rb")
+        while True:
+            prefix = stream.read(transport.LENGTH.size)
+            if len(prefix) < transport.LENGTH.size:
+                return
+
+            (length,) = transport.LENGTH.unpack(prefix)
+            on_reply(stream.read(length))
+
+    def send(self, seq, payload):
+        """Send a frame
+
+        Args:
+            seq (int): Sequence number of the frame
+            payload (bytearray): Frame header and image
+        """
+        self.sock.sendall(transport.LENGTH.pack(len(payload)) + payload)
+
+    def send_done(self, seq, payload):
+        """Send the finish message, TCP makes sure it arrives
+
+        Args:
+            seq (int): Sequence number of the message
+            payload (bytes): Frame header
+        """
+        self.send(seq, payload)
+
+    def close(self):
+        self.sock.close()
+
+
+class UdpSender(transport.Sender):
+    """Send frames to the worker as UDP datagrams, replies arrive as datagrams on the same socket"""
+
+    # Send the finish message multiple times, as datagrams can get lost
+    DONE_REPEAT = 3
+
+    def __init__(self):
+        """Initialize the object: open a socket on a free port, and start receiving replies"""
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("", 0))
+        self.port = self.sock.getsockname()[1]
+        self.remote = (MQTT_REMOTE_IP, TRANSPORT_PORT)
+        threading.Thread(target=self.receive, daemon=True).start()
+
+        print("Send to worker address %s:%i over UDP" % self.remote)
+        print("Receive replies on port %i" % (self.port))
+
+    def receive(self):
+        """Receive replies until the socket is closed"""
+        while True:
+            try:
+                data, _ = self.sock.recvfrom(65535)
+            except OSError:
+                return
+
+            on_reply(data)
+
+    def send(self, seq, payload):
+        """Send a frame
+
+        Args:
+            seq (int): Sequence number of the frame, used as message id
+            payload (bytearray): Frame header and image
+        """
+        for datagram in transport.fragments(seq, payload):
+            self.sock.sendmsg(datagram, [], 0, self.remote)
+
+    def send_done(self, seq, payload):
+        """Send the finish message
+
+        Args:
+            seq (int): Sequence number of the message, used as message id
+            payload (bytes): Frame header
+        """
+        for _ in range(self.DONE_REPEAT):
+            self.send(seq, payload)
+
+    def close(self):
+        self.sock.close()
+
+
+SENDERS = {"mqtt": MqttSender, "tcp": TcpSender, "udp": UdpSender}
+
+
+class RateController:
+    """Adapt the send rate to stay within a reply latency target, using additive increase and
+    multiplicative decrease (AIMD). Every RATE_INTERVAL seconds, the rate is decreased if
+    the worker is overloaded, and increased otherwise. The worker is considered overloaded if:
+    - the 90th percentile reply latency of the interval exceeds the target
+    - more frames are in flight than the target latency allows for (Little's law, with margin)
+    - the worker dropped frames
+    """
+
+    # Multiplicative decrease factor, and additive increase as fraction of the initial rate
+    DECREASE = 0.7
+    INCREASE = 0.1
+
+    # Lowest rate to fall back to
+    MIN_FREQUENCY = 0.1
+
+    def __init__(self, schedule, target):
+        """Initialize the object
+
+        Args:
+            schedule (Schedule): Schedule whose frequency is adapted
+            target (int): Reply latency target in ms
+        """
+        self.schedule = schedule
+        self.target = target * 10**6
+        self.step = schedule.frequency * self.INCREASE
+
+        self.latencies = []
+        self.drops = 0
+        self.next_update = None
+
+        self.metrics = Metrics("rate", ["time", "frequency", "latency", "inflight"])
+
+    def on_reply(self, latency):
+        """Record the latency of a reply, called from the thread receiving replies
+
+        Args:
+            latency (int): End-to-end latency in ns
+        """
+        self.latencies.append(latency)
+
+    def on_drop(self):
+        """Record a frame dropped by the worker, called from the thread receiving replies"""
+        self.drops += 1
+
+    def update(self, t_now, inflight):
+        """Adapt the rate once per RATE_INTERVAL, call after sending each frame
+
+        Args:
+            t_now (int): Current time in ns
+            inflight (int): Number of frames sent without reply
+        """
+        if self.next_update is None:
+            self.next_update = t_now + int(RATE_INTERVAL * 10**9)
+            return
+        elif t_now < self.next_update:
+            return
+
+        self.next_update = t_now + int(RATE_INTERVAL * 10**9)
+        latencies, self.latencies = self.latencies, []
+        drops, self.drops = self.drops, 0
+
+        latency = 0
+        if latencies != []:
+            latencies.sort()
+            latency = latencies[int(len(latencies) * 0.9)]
+
+        frequency = self.schedule.frequency
+        max_inflight = 2 * frequency * self.target / 10**9 + 1
+        if latency > self.target or inflight > max_inflight or drops > 0:
+            frequency = max(frequency * self.DECREASE, self.MIN_FREQUENCY)
+        else:
+            frequency = min(frequency + self.step, MAX_FREQUENCY)
+
+        self.schedule.frequency = frequency
+
+        # Frequency in mHz, as metrics are integers
+        self.metrics.add(t_now, int(frequency * 1000), latency, inflight)
+        if LOG_SAMPLE > 0:
+            print(
+                "Send rate: %.2f Hz (latency %.2f ms, in flight %i)"
+                % (frequency, latency / 10**6, inflight)
+            )
+
+
+controller = None
+
+
+def load_payloads():
+    """Load the dataset into memory once, and build the payload for each image.
+    Each payload starts with an empty frame header, which is filled in per frame.
+
+    Returns:
+        list(bytearray): Payload per image, with an empty header area
+    """
+    payloads = []
+    for file in sorted(os.listdir("images")):
         if file.endswith(".JPEG"):
-            files.append(file)
+            payload = bytearray(frame.HEADER_SIZE)
+            with open("images/" + file, "rb") as f:
+                payload.extend(f.read())
+
+            payloads.append(payload)
+
+    print("Loaded %i images into memory" % (len(payloads)))
+    return payloads
+
+
+def preprocess(preprocessor, payload):
+    """Preprocess an image up to OFFLOAD_SPLIT before sending it.
+    Every frame is preprocessed again, as a camera would produce a new image each time.
+
+    Args:
+        preprocessor (Preprocessor): Decoder for the model input size, without cache
+        payload (bytearray): Payload with an empty header area, followed by the original image
+
+    Returns:
+        bytearray, int, int: Payload with an empty header area followed by the preprocessed
+            image, its frame type, and the time spent preprocessing in ns
+    """
+    start_time = time.time_ns()
+    image, _ = preprocessor(memoryview(payload)[frame.HEADER_SIZE :])
 
-    print("Start connecting to the remote MQTT broker")
-    print("Broker ip: " + str(MQTT_REMOTE_IP))
-    print("Topic: " + str(MQTT_TOPIC))
+    prepared = bytearray(frame.HEADER_SIZE)
+    if OFFLOAD_SPLIT == "resize":
+        prepared.extend(encode(image, JPEG_QUALITY))
+        kind = frame.FRAME
+    else:
+        prepared.extend(image.tobytes())
+        kind = frame.TENSOR
 
-    remote_client = mqtt.Client()
-    remote_client.on_publish = on_publish
+    return prepared, kind, time.time_ns() - start_time
 
-    remote_client.connect(MQTT_REMOTE_IP, port=1883, keepalive=120)
-    print("Connected with the broker")
 
-    # Send all frames over MQTT, one by one
+def send(sender):
+    """Send all frames on schedule, followed by the finish message.
+    With a latency target, frames are sent for DURATION seconds at an adapted rate.
+
+    Args:
+        sender (transport.Sender): Transport to send frames with
+    """
+    # Loop over the dataset of 60 images
+    payloads = load_payloads()
+
+    size = MODELS[MODEL]["size"]
+    preprocessor = Preprocessor(size, size, RESAMPLE)
+    print("Offload split: %s (model input %ix%i)" % (OFFLOAD_SPLIT, size, size))
+
+    # Send all frames, one by one, on a fixed schedule independent of how long sending takes
+    global sent, controller
+    schedule = Schedule(FREQUENCY, ARRIVAL)
+    if LATENCY_TARGET > 0:
+        controller = RateController(schedule, LATENCY_TARGET)
+        print("Adapt the send rate to a latency target of %i ms" % (LATENCY_TARGET))
+
+    end_time = time.time_ns() + DURATION * 10**9
     for i in range(MAX_IMGS):
+        t_intended, lateness = schedule.wait()
         start_time = time.time_ns()
-        file = open("images/" + files[i % len(files)], "rb")
-        byte_arr = bytearray(file.read())
+        log = sampled(i, LOG_SAMPLE)
 
-        # Prepend 0's to the time to get a fixed length string
-        t = time.time_ns()
-        t = (20 - len(str(t))) * "0" + str(t)
-        byte_arr.extend(t.encode("utf-8"))
+        if controller is not None and start_time >= end_time:
+            break
 
-        # Append local IP address so edge or cloud knows who to send a reply to
-        ip_bytes = (15 - len(MQTT_LOCAL_IP)) * "-" + MQTT_LOCAL_IP
-        byte_arr.extend(ip_bytes.encode("utf-8"))
+        sec_per_frame = 1 / schedule.frequency
+        if lateness > sec_per_frame * 10**9:
+            print(
+                "Can't keep up with %f seconds per frame: %f seconds late"
+                % (sec_per_frame, lateness / 10**9)
+            )
 
-        print("Sending data (bytes): %i" % (len(byte_arr)))
-        _ = remote_client.publish(MQTT_TOPIC, byte_arr, qos=0)
+        byte_arr = payloads[i % len(payloads)]
+        kind = frame.FRAME
+        preprocess_time = 0
+        if OFFLOAD_SPLIT != "none":
+            byte_arr, kind, preprocess_time = preprocess(preprocessor, byte_arr)
+
+        # Fill in the header, including the local IP so edge or cloud knows who to send a reply to.
+        # Use the intended send time, so latency includes any time the frame was sent late
+        frame.pack_header_into(
+            byte_arr,
+            kind,
+            ENDPOINT_ID,
+            i,
+            t_intended,
+            MQTT_LOCAL_IP,
+            sender.port,
+        )
+
+        sender.send(i, byte_arr)
 
-        # Try to keep a frame rate of X
         sec_frame = time.time_ns() - start_time
-        print("Preparation and preprocessing (ns): %i" % (sec_frame))
-        sec_frame = float(sec_frame) / 10**9
-
-        if sec_frame < SEC_PER_FRAME:
-            # Wait until next frame should happen
-            frame = 0.1 * (SEC_PER_FRAME - sec_frame)
-            while sec_frame < SEC_PER_FRAME:
-                time.sleep(frame)
-                sec_frame = float(time.time_ns() - start_time) / 10**9
-        else:
-            print(
-                "Can't keep up with %f seconds per frame: Took %f"
-                % (SEC_PER_FRAME, sec_frame)
-            )
+        sent_metrics.add(lateness, sec_frame, preprocess_time, len(byte_arr))
+        sent += 1
 
-    # Make sure the finish message arrives
-    remote_client.loop_start()
-    remote_client.publish(MQTT_TOPIC, "1", qos=2)
-    remote_client.loop_stop()
+        if controller is not None:
+            controller.update(time.time_ns(), sent - received)
+
+        if log:
+            print("Send lateness (ns): %i" % (lateness))
+            print("Preprocess (ns): %i" % (preprocess_time))
+            print("Sending data (bytes): %i" % (len(byte_arr)))
+            print("Preparation and preprocessing (ns): %i" % (sec_frame))
 
-    remote_client.disconnect()
-    print("Finished, sent %i images" % (MAX_IMGS))
+    sent_metrics.flush()
+    if controller is not None:
+        controller.metrics.flush()
+
+    # Make sure the finish message arrives
+    done = frame.pack_header(
+        frame.DONE, ENDPOINT_ID, sent, time.time_ns(), MQTT_LOCAL_IP, sender.port
+    )
+    sender.send_done(sent, done)
+    print("Finished, sent %i images" % (sent))
 
 
 if __name__ == "__main__":
-    connect()
-    send()
+    Sender = transport.select(SENDERS, TRANSPORT)
+    if OFFLOAD_SPLIT not in SPLITS:
+        raise ValueError("Unknown offload split %s" % (OFFLOAD_SPLIT))
 
-    print("Wait for all images to be received back")
-    while received != MAX_IMGS:
-        print("Waiting progress: %i / %i" % (received, MAX_IMGS))
-        time.sleep(10)
+    sender = Sender()
+    send(sender)
 
-    print("All %i images have been received back" % (MAX_IMGS))
+    # Stop waiting if no reply arrived for REPLY_TIMEOUT seconds, replies can get lost over UDP
+    print("Wait for all images to be received back")
+    with progress:
+        while received != sent:
+            print("Waiting progress: %i / %i" % (received, sent))
+            if not progress.wait(timeout=REPLY_TIMEOUT):
+                print("No replies for %i seconds, stop waiting" % (REPLY_TIMEOUT))
+                break
+
+    sender.close()
+    print("%i / %i images have been received back" % (received, sent))
+    reply_metrics.flush()
+    drop_metrics.flush()
+    print("Replies out of order: %i" % (out_of_order))
+    print("Duplicate replies: %i" % (duplicates))
+    print("Frames dropped by the worker: %i" % (dropped))
+    print("Replies lost: %i" % (sent - received))
+
+    # Final counters, so the framework can tell a complete run from a cut-off one
+    done = Metrics("done", ["sent", "received", "dropped", "lost"])
+    done.add(sent, received, dropped, sent - received)
+    done.flush()
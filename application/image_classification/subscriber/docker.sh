@@ -1,4 +1,8 @@
 #!/bin/bash
+cp -r ../images src/
 cp ../model/* ./src/
+cp ../common/* ./src/
 docker buildx build --platform linux/amd64,linux/arm64 -t redplanet00/kubeedge-applications:image_classification_subscriber --push .
-rm src/labels.txt src/model.tflite
+rm -r src/images
+rm src/labels.txt src/*.tflite
+rm src/preprocess.py src/frame.py src/schedule.py src/metrics.py src/model.py src/transport.py src/variants.py src/calibrate.py
@@ -1,27 +1,612 @@
 """\
 This is a subscriber, receiving images through MQTT and processing them using image classification from TFLite.
+Images can also be received directly over TCP or UDP instead of through the local MQTT broker
+(see common/transport.py).
 """
 
 import paho.mqtt.client as mqtt
 
-import PIL.Image as Image
-import io
-
-import tflite_runtime.interpreter as tflite
 import numpy as np
 import os
 import time
+import asyncio
 import multiprocessing
+import socket
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import calibrate
+import frame
+from metrics import AllocationCounter, Metrics, memory_usage, sampled
+import model
+from preprocess import Preprocessor
+import transport
+
+# Start of the container, startup times are reported relative to this
+START_TIME = time.time_ns()
 
 MQTT_LOCAL_IP = os.environ["MQTT_LOCAL_IP"]
 MQTT_LOGS = os.environ["MQTT_LOGS"]
 CPU_THREADS = int(os.environ["CPU_THREADS"])
 ENDPOINT_CONNECTED = int(os.environ["ENDPOINT_CONNECTED"])
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", 1))
+BATCH_WAIT = float(os.environ.get("BATCH_WAIT", 0))
+RESAMPLE = os.environ.get("RESAMPLE", "bicubic")
+PREPROCESS_CACHE = int(os.environ.get("PREPROCESS_CACHE", 0))
+FRAME_SLOTS = int(os.environ.get("FRAME_SLOTS", 64))
+FRAME_SLOT_SIZE = int(os.environ.get("FRAME_SLOT_SIZE", 256 * 1024))
+REPLY_ENDPOINTS = [ip for ip in os.environ.get("REPLY_ENDPOINTS", "").split(",") if ip]
+MAX_INFLIGHT = int(os.environ.get("MAX_INFLIGHT", 0))
+DONE_TIMEOUT = float(os.environ.get("DONE_TIMEOUT", 10))
+QUEUE_SIZE = int(os.environ.get("QUEUE_SIZE", 0))
+QUEUE_POLICY = os.environ.get("QUEUE_POLICY", "drop-oldest")
+QUEUE_SAMPLE = float(os.environ.get("QUEUE_SAMPLE", 100))
+TRANSPORT = os.environ.get("TRANSPORT", "mqtt")
+TRANSPORT_PORT = int(os.environ.get("TRANSPORT_PORT", 5000))
+LOG_SAMPLE = int(os.environ.get("LOG_SAMPLE", 0))
+MODEL = os.environ.get("MODEL", model.REFERENCE)
+WARMUP = int(os.environ.get("WARMUP", 5))
+SHARED_MODEL = os.environ.get("SHARED_MODEL", "False")
+INFER_WORKERS = int(os.environ.get("INFER_WORKERS", CPU_THREADS))
+INFER_THREADS = int(os.environ.get("INFER_THREADS", 1))
+PIN_CPUS = os.environ.get("PIN_CPUS", "False")
+CALIBRATE = os.environ.get("CALIBRATE", "off")
+CALIBRATE_TIME = float(os.environ.get("CALIBRATE_TIME", 2))
+ALLOC_TRACE = os.environ.get("ALLOC_TRACE", "False")
 MQTT_TOPIC = "kubeedge-image-classification"
 
-work_queue = multiprocessing.Queue()
-endpoints_connected = multiprocessing.Value("i", ENDPOINT_CONNECTED)
-images_processed = multiprocessing.Value("i", 0)
+# Backoff in seconds before connecting again to an endpoint broker that could not be reached
+CONNECT_BACKOFF = 1
+CONNECT_BACKOFF_MAX = 30
+
+
+class FrameBuffer:
+    """Ring buffer of fixed-size slots in shared memory, used to pass received payloads
+    from the event loop to the inference processes without pickling them through a pipe.
+    Only a small [receive time, slot, length, payload, header] descriptor is sent to the process,
+    the frame header in it lets the event loop reply to a frame without reading its slot.
+    If no slot is free, or the payload does not fit in a slot, the payload is sent inline instead.
+    """
+
+    def __init__(self, slots, slot_size):
+        """Initialize the object
+
+        Args:
+            slots (int): Number of slots in the ring buffer
+            slot_size (int): Size of each slot in bytes
+        """
+        self.slots = slots
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+
+        # Slot states: 0 = free, 1 = in use. Only the event loop marks slots as used,
+        # and only the process that read the slot marks it as free again.
+        self.states = multiprocessing.RawArray("b", slots)
+        self.head = 0
+
+        self.used = multiprocessing.Value("i", 0)
+        self.used_peak = multiprocessing.Value("i", 0)
+        self.overflows = multiprocessing.Value("i", 0)
+
+    def write(self, t_now, payload):
+        """Write a payload to the next free slot
+
+        Args:
+            t_now (int): Time the payload was received in ns
+            payload (bytes): Received payload
+
+        Returns:
+            list: Descriptor to send to an inference process
+        """
+        header = payload[: frame.HEADER_SIZE]
+        length = len(payload)
+        if length <= self.slot_size:
+            for _ in range(self.slots):
+                slot = self.head
+                self.head = (self.head + 1) % self.slots
+
+                if self.states[slot] == 0:
+                    self.states[slot] = 1
+                    offset = slot * self.slot_size
+                    self.shm.buf[offset : offset + length] = payload
+
+                    with self.used.get_lock():
+                        self.used.value += 1
+                        if self.used.value > self.used_peak.value:
+                            self.used_peak.value = self.used.value
+
+                    return [t_now, slot, length, None, header]
+
+        with self.overflows.get_lock():
+            self.overflows.value += 1
+
+        return [t_now, -1, length, payload, header]
+
+    def read(self, descriptor):
+        """Copy the payload of a descriptor out of the buffer and free its slot
+
+        Args:
+            descriptor (list): Descriptor created by write()
+
+        Returns:
+            int, bytes: Time the payload was received in ns, and the payload itself
+        """
+        t_now, slot, length, payload, _ = descriptor
+        if slot == -1:
+            return t_now, payload
+
+        offset = slot * self.slot_size
+        payload = bytes(self.shm.buf[offset : offset + length])
+        self.free(descriptor)
+        return t_now, payload
+
+    def free(self, descriptor):
+        """Free the slot of a descriptor without reading it
+
+        Args:
+            descriptor (list): Descriptor created by write()
+        """
+        slot = descriptor[1]
+        if slot == -1:
+            return
+
+        self.states[slot] = 0
+        with self.used.get_lock():
+            self.used.value -= 1
+
+    def close(self):
+        """Release the shared memory segment"""
+        self.shm.close()
+        self.shm.unlink()
+
+
+class AsyncioHelper:
+    """Drive a paho MQTT client from the asyncio event loop, instead of from its own network thread"""
+
+    def __init__(self, loop, client):
+        """Initialize the object
+
+        Args:
+            loop (asyncio.AbstractEventLoop): Event loop to run the client in
+            client (mqtt.Client): MQTT client
+        """
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        self.sock = None
+        self.paused = False
+
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    # The socket callbacks can be called from an executor thread while connecting
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.open, sock)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.close, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock)
+
+    def open(self, sock):
+        self.sock = sock
+        if not self.paused:
+            self.loop.add_reader(sock, self.client.loop_read)
+
+        self.misc = self.loop.create_task(self.loop_misc())
+
+    def close(self, sock):
+        self.loop.remove_reader(sock)
+        self.sock = None
+        if self.misc is not None:
+            self.misc.cancel()
+
+    def pause_reading(self):
+        """Stop reading from the broker. Unread messages stay in the socket buffers,
+        so TCP flow control pushes back on the broker instead of queueing them here.
+        """
+        if not self.paused and self.sock is not None:
+            self.loop.remove_reader(self.sock)
+
+        self.paused = True
+
+    def resume_reading(self):
+        """Start reading from the broker again"""
+        if self.paused and self.sock is not None:
+            self.loop.add_reader(self.sock, self.client.loop_read)
+
+        self.paused = False
+
+    async def loop_misc(self):
+        """Handle keepalive pings and retries, like the paho network thread would"""
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+async def connect_client(loop, client, ip, port, keepalive):
+    """Connect an MQTT client that is driven by the event loop, without blocking the event loop
+
+    Args:
+        loop (asyncio.AbstractEventLoop): Event loop to run the client in
+        client (mqtt.Client): MQTT client
+        ip (str): IP of the MQTT broker
+        port (int): Port of the MQTT broker
+        keepalive (int): Keepalive interval in seconds
+
+    Returns:
+        AsyncioHelper: Helper driving the client
+    """
+    helper = AsyncioHelper(loop, client)
+    await loop.run_in_executor(None, client.connect, ip, port, keepalive)
+    return helper
+
+
+class ReplyPublisher:
+    """Send replies back to the endpoints from the event loop.
+    Connects to all known endpoints at startup, so no connection is set up on the inference path.
+    If connecting to an endpoint fails, the next reply to it connects again, with an increasing
+    backoff between attempts. Replies that can't be sent in the meantime are counted as unsent.
+    """
+
+    def __init__(self, loop, endpoints):
+        """Initialize the object
+
+        Args:
+            loop (asyncio.AbstractEventLoop): Event loop to run the clients in
+            endpoints (list(str)): IPs of the endpoints to connect to at startup
+        """
+        self.loop = loop
+        self.clients = {}
+        self.connecting = {}
+        self.metrics = Metrics("connections", ["setup"])
+
+        # Per endpoint that could not be reached: [time of the next attempt, backoff]
+        self.retry = {}
+        self.unsent = 0
+
+        for ip in endpoints:
+            self.connecting[ip] = loop.create_task(self.connect(ip))
+
+    async def connect(self, ip, port=1883):
+        """Connect to the MQTT broker of an endpoint
+
+        Args:
+            ip (str): IP of the endpoint
+            port (int, optional): Port of the MQTT broker. Defaults to 1883.
+        """
+        print("Connect to remote broker on endpoint %s\n" % (ip), end="")
+        start_time = time.time_ns()
+
+        remote_client = mqtt.Client()
+        if LOG_SAMPLE == 1:
+            remote_client.on_publish = on_publish
+
+        try:
+            await connect_client(self.loop, remote_client, ip, port, 120)
+        except OSError as e:
+            backoff = CONNECT_BACKOFF
+            if ip in self.retry:
+                backoff = min(self.retry[ip][1] * 2, CONNECT_BACKOFF_MAX)
+
+            self.retry[ip] = [self.loop.time() + backoff, backoff]
+            print(
+                "Could not connect to remote broker on endpoint %s, "
+                "try again after %i seconds: %s\n" % (ip, backoff, e),
+                end="",
+            )
+            return
+        finally:
+            del self.connecting[ip]
+
+        self.clients[ip] = remote_client
+        self.retry.pop(ip, None)
+        self.metrics.add(time.time_ns() - start_time)
+        print("Connected with the remote broker on endpoint %s\n" % (ip), end="")
+
+    async def publish(self, ip, port, payload):
+        """Send a reply to an endpoint.
+        Endpoints we did not know about at startup are connected to on first use.
+
+        Args:
+            ip (str): IP of the endpoint
+            port (int): Port of the MQTT broker of the endpoint
+            payload (bytes): Reply to send
+        """
+        if ip not in self.clients:
+            if ip not in self.connecting:
+                if ip in self.retry and self.loop.time() < self.retry[ip][0]:
+                    self.unsent += 1
+                    return
+
+                self.connecting[ip] = self.loop.create_task(self.connect(ip, port))
+
+            await self.connecting[ip]
+            if ip not in self.clients:
+                self.unsent += 1
+                return
+
+        _ = self.clients[ip].publish(MQTT_TOPIC, payload, qos=0)
+
+    def close(self):
+        """Disconnect from all endpoints"""
+        for remote_client in self.clients.values():
+            remote_client.disconnect()
+
+        if self.unsent > 0:
+            print(
+                "Replies not sent, endpoint unreachable: %i\n" % (self.unsent), end=""
+            )
+
+
+class MqttTransport(transport.Receiver):
+    """Receive images through the local MQTT broker, and reply through the MQTT broker of
+    each endpoint (see ReplyPublisher)
+    """
+
+    def __init__(self, loop):
+        """Initialize the object, and start connecting to the known endpoints
+
+        Args:
+            loop (asyncio.AbstractEventLoop): Event loop to run in
+        """
+        self.loop = loop
+        self.client = None
+        self.helper = None
+        self.publisher = ReplyPublisher(loop, REPLY_ENDPOINTS)
+        self.metrics = self.publisher.metrics
+        self.paused = False
+
+    async def listen(self, receive):
+        """Connect to the local MQTT broker, and subscribe to images
+
+        Args:
+            receive (function): Called with every received message
+        """
+        print("Start connecting to the local MQTT broker\n", end="")
+        print("Broker ip: %s\n" % (MQTT_LOCAL_IP), end="")
+        print("Topic: %s\n" % (MQTT_TOPIC), end="")
+
+        self.client = mqtt.Client()
+        self.client.on_connect = on_connect
+        self.client.on_message = lambda client, userdata, msg: receive(msg.payload)
+        self.client.on_subscribe = on_subscribe
+
+        if MQTT_LOGS == "True":
+            self.client.on_log = on_log
+
+        self.helper = await connect_client(
+            self.loop, self.client, MQTT_LOCAL_IP, 1883, 300
+        )
+
+    def pause_reading(self):
+        """Stop reading from the local broker, see AsyncioHelper.pause_reading()"""
+        self.helper.pause_reading()
+        self.paused = True
+
+    def resume_reading(self):
+        """Start reading from the local broker again"""
+        self.helper.resume_reading()
+        self.paused = False
+
+    async def publish(self, ip, port, payload):
+        """Send a reply to an endpoint, through its MQTT broker
+
+        Args:
+            ip (str): IP of the endpoint
+            port (int): Port of the MQTT broker of the endpoint
+            payload (bytes): Reply to send
+        """
+        await self.publisher.publish(ip, port, payload)
+
+    def close(self):
+        """Disconnect from the local broker and from all endpoints"""
+        if self.client is not None:
+            self.client.disconnect()
+
+        self.publisher.close()
+
+
+class TcpTransport(transport.Receiver):
+    """Receive images over direct TCP connections from the endpoints, and reply over the same
+    connections
+    """
+
+    def __init__(self, loop):
+        """Initialize the object
+
+        Args:
+            loop (asyncio.AbstractEventLoop): Event loop to run in
+        """
+        self.loop = loop
+        self.server = None
+        self.receive = None
+        self.writers = {}
+        self.metrics = Metrics("connections", ["setup"])
+
+        # Connections wait for this event before reading the next message
+        self.reading = asyncio.Event()
+        self.reading.set()
+        self.paused = False
+
+    async def listen(self, receive):
+        """Start accepting connections from endpoints
+
+        Args:
+            receive (function): Called with every received message
+        """
+        self.receive = receive
+        self.server = await asyncio.start_server(self.handle, "0.0.0.0", TRANSPORT_PORT)
+        print("Listening for TCP connections on port %i\n" % (TRANSPORT_PORT), end="")
+
+    async def handle(self, reader, writer):
+        """Read length-prefixed messages from one endpoint, until it disconnects
+
+        Args:
+            reader (asyncio.StreamReader): Reading side of the connection
+            writer (asyncio.StreamWriter): Writing side of the connection
+        """
+        writer.get_extra_info("socket").setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+        )
+
+        try:
+            while True:
+                await self.reading.wait()
+                prefix = await reader.readexactly(transport.LENGTH.size)
+                (length,) = transport.LENGTH.unpack(prefix)
+                payload = await reader.readexactly(length)
+
+                # Replies are sent to the reply address in the header, map it to this connection
+                try:
+                    _, _, _, _, ip, _ = frame.unpack_header(payload)
+                    self.writers[ip] = writer
+                except ValueError:
+                    pass
+
+                self.receive(payload)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # The endpoint disconnected, or the subscriber is shutting down
+            pass
+
+    def pause_reading(self):
+        """Stop reading from the connections, so TCP flow control pushes back on the endpoints"""
+        self.reading.clear()
+        self.paused = True
+
+    def resume_reading(self):
+        """Start reading from the connections again"""
+        self.reading.set()
+        self.paused = False
+
+    async def publish(self, ip, port, payload):
+        """Send a reply to an endpoint, over the connection its images arrive on
+
+        Args:
+            ip (str): IP of the endpoint
+            port (int): Unused, replies go over the existing connection
+            payload (bytes): Reply to send
+        """
+        writer = self.writers.get(ip)
+        if writer is None:
+            return
+
+        try:
+            writer.write(transport.LENGTH.pack(len(payload)) + payload)
+            await writer.drain()
+        except ConnectionError as e:
+            print("Could not send reply to endpoint %s: %s\n" % (ip, e), end="")
+
+    def close(self):
+        """Stop accepting connections, and close all connections"""
+        self.server.close()
+        for writer in self.writers.values():
+            writer.close()
+
+
+class UdpTransport(transport.Receiver):
+    """Receive images as UDP datagrams from the endpoints, and reply with a datagram to the
+    reply address in the frame header
+    """
+
+    def __init__(self, loop):
+        """Initialize the object
+
+        Args:
+            loop (asyncio.AbstractEventLoop): Event loop to run in
+        """
+        self.loop = loop
+        self.sock = None
+        self.receive = None
+        self.reassembler = transport.Reassembler()
+        self.metrics = Metrics("connections", ["setup"])
+        self.paused = False
+
+    async def listen(self, receive):
+        """Start receiving datagrams
+
+        Args:
+            receive (function): Called with every reassembled message
+        """
+        self.receive = receive
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.sock.bind(("0.0.0.0", TRANSPORT_PORT))
+        self.sock.setblocking(False)
+        self.loop.add_reader(self.sock, self.read)
+        print("Listening for UDP datagrams on port %i\n" % (TRANSPORT_PORT), end="")
+
+    def read(self):
+        """Read all datagrams that are available, and pass on complete messages"""
+        while not self.paused:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except BlockingIOError:
+                return
+
+            try:
+                payload = self.reassembler.add(addr, data)
+            except ValueError as e:
+                print("Skip invalid datagram: %s\n" % (e), end="")
+                continue
+
+            if payload is not None:
+                self.receive(payload)
+
+    def pause_reading(self):
+        """Stop reading datagrams, the socket buffer drops them once it is full"""
+        if not self.paused:
+            self.loop.remove_reader(self.sock)
+
+        self.paused = True
+
+    def resume_reading(self):
+        """Start reading datagrams again"""
+        if self.paused:
+            self.loop.add_reader(self.sock, self.read)
+
+        self.paused = False
+
+    async def publish(self, ip, port, payload):
+        """Send a reply to an endpoint
+
+        Args:
+            ip (str): IP of the endpoint
+            port (int): Port the endpoint receives replies on
+            payload (bytes): Reply to send
+        """
+        try:
+            self.sock.sendto(payload, (ip, port))
+        except OSError as e:
+            print("Could not send reply to endpoint %s: %s\n" % (ip, e), end="")
+
+    def close(self):
+        """Stop receiving datagrams"""
+        if not self.paused:
+            self.loop.remove_reader(self.sock)
+
+        self.sock.close()
+        print("Messages lost in UDP reassembly: %i" % (self.reassembler.lost))
+
+
+TRANSPORTS = {"mqtt": MqttTransport, "tcp": TcpTransport, "udp": UdpTransport}
+
+frame_buffer = FrameBuffer(FRAME_SLOTS, FRAME_SLOT_SIZE)
+# Model read once before the inference processes are forked, so all processes share it
+model_content = model.read(MODEL) if SHARED_MODEL == "True" else None
+
+# Inference processes, interpreter threads per process, and pinning, calibrated by main()
+layout = (INFER_WORKERS, INFER_THREADS, PIN_CPUS == "True")
+startup_barrier = None
+
+# Image classifier of this inference process, set by init_worker
+classifier = None
 
 
 def on_connect(client, userdata, flags, rc):
@@ -37,169 +622,729 @@ def on_log(client, userdata, level, buff):
     print("[ %s ] %s\n" % (str(level), buff), end="")
 
 
-def on_message(client, userdata, msg):
-    work_queue.put([time.time_ns(), msg.payload])
-
-
 def on_publish(mqttc, obj, mid):
     print("Published data")
 
 
-def connect_remote_client(current, ip):
-    # Save IPs from connected endpoints
-    print("[%s] Connect to remote broker on endpoint %s" % (current.name, ip))
-    remote_client = mqtt.Client()
-    remote_client.on_publish = on_publish
+def dropped_reply(header):
+    """Build the reply telling an endpoint that its frame was not processed
+
+    Args:
+        header (bytes): Header of the frame
+
+    Returns:
+        list: [ip, port, payload] of the reply, and None instead of metrics
+    """
+    _, endpoint_id, seq, t_send, ip, port = frame.unpack_header(header)
+    payload = frame.pack_header(frame.DROPPED, endpoint_id, seq, t_send, ip, port)
+    return [ip, port, payload, None]
+
+
+class Classifier:
+    """Image classification with TFLite, running in an inference process.
+    Images that arrive together are classified in one batch of at most BATCH_SIZE images.
+    """
+
+    def __init__(self):
+        """Initialize the object: load the labels and the model"""
+        self.name = multiprocessing.current_process().name
+        print("[%s] Start thread\n" % (self.name), end="")
+
+        # Load the labels and the model
+        self.labels = model.labels(MODEL)
+        self.interpreter = model.load(MODEL, layout[1], model_content)
+        self.loaded = time.time_ns() - START_TIME
+
+        # Run synthetic images through the model, so real images never pay for warm-up
+        model.warm_up(self.interpreter, WARMUP)
+        self.warm = time.time_ns() - START_TIME
+
+        # Get model input details and resize image
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+
+        # Views on the input and output tensors of the interpreter, valid until the next invoke
+        self.input = self.interpreter.tensor(self.input_details[0]["index"])
+        self.output = self.interpreter.tensor(self.output_details[0]["index"])
+
+        self.iw = self.input_details[0]["shape"][2]
+        self.ih = self.input_details[0]["shape"][1]
+        self.batch_size = self.input_details[0]["shape"][0]
+
+        self.preprocessor = Preprocessor(self.iw, self.ih, RESAMPLE, PREPROCESS_CACHE)
+        self.allocations = AllocationCounter(ALLOC_TRACE == "True")
+
+        print("[%s] Preparations finished\n" % (self.name), end="")
+
+    def tensor(self, data):
+        """View the model input image an endpoint prepared, without copying it
+
+        Args:
+            data (bytes): Frame header, followed by the image as raw uint8 RGB pixels
+
+        Raises:
+            ValueError: The image does not have the input size of the model
+
+        Returns:
+            numpy.ndarray: Image as uint8 array with shape (height, width, 3)
+        """
+        size = len(data) - frame.HEADER_SIZE
+        if size != self.ih * self.iw * 3:
+            raise ValueError(
+                "Tensor of %i bytes does not match the model input %ix%i"
+                % (size, self.iw, self.ih)
+            )
+
+        return np.frombuffer(data, dtype=np.uint8, offset=frame.HEADER_SIZE).reshape(
+            self.ih, self.iw, 3
+        )
+
+    def __call__(self, items):
+        """Classify a batch of images
+
+        Args:
+            items (list(list)): Frame buffer descriptors of the images
+
+        Returns:
+            list(list): [ip, port, payload] reply and
+                [start, end, latency, decode, processing, alloc] metrics for each image,
+                or a dropped reply and None for each image if the batch failed
+        """
+        start_time = time.time_ns()
+        self.allocations.start()
+
+        # Copy every payload out of the frame buffer first, so a failing batch keeps no slots
+        received = []
+        try:
+            for item in items:
+                received.append(frame_buffer.read(item))
+        finally:
+            for item in items[len(received) :]:
+                frame_buffer.free(item)
+
+        try:
+            return self.classify(received, start_time)
+        except Exception as e:
+            self.allocations.stop()
+            print(
+                "[%s] Could not classify %i images: %r\n" % (self.name, len(items), e),
+                end="",
+            )
+            return [dropped_reply(item[4]) for item in items]
+
+    def classify(self, received, start_time):
+        """Classify a batch of images copied out of the frame buffer
+
+        Args:
+            received (list(list)): Receive time and payload of each image
+            start_time (int): Time the batch was started in ns
+
+        Returns:
+            list(list): [ip, port, payload] reply and
+                [start, end, latency, decode, processing, alloc] metrics for each image
+        """
+        frames = []
+        for t_now, data in received:
+            # The header contains the sender address (needed to reply back) and the send time
+            kind, _, seq, t_old, ip, port = frame.unpack_header(data)
+            log = sampled(seq, LOG_SAMPLE)
+
+            # Read the image, do ML on it
+            if log:
+                print("[%s] Read image and apply ML\n" % (self.name), end="")
+                print("[%s] Latency (ns): %i\n" % (self.name, t_now - t_old), end="")
+
+            # Get data to process, endpoints may have prepared the model input already
+            if kind == frame.TENSOR:
+                image, decode_time = self.tensor(data), 0
+            else:
+                image, decode_time = self.preprocessor(data[frame.HEADER_SIZE :])
+            if log:
+                print("[%s] Decode (ns): %i\n" % (self.name, decode_time), end="")
+
+            frames.append(
+                [
+                    ip,
+                    port,
+                    data[: frame.HEADER_SIZE],
+                    image,
+                    log,
+                    t_now - t_old,
+                    decode_time,
+                ]
+            )
 
-    remote_client.connect(ip, port=1883, keepalive=120)
-    print("[%s] Connected with the remote broker" % (current.name))
+        # Resize the input tensor if the batch size changed since the previous invoke
+        if len(frames) != self.batch_size:
+            self.batch_size = len(frames)
+            self.interpreter.resize_tensor_input(
+                self.input_details[0]["index"], [self.batch_size, self.ih, self.iw, 3]
+            )
+            self.interpreter.allocate_tensors()
 
-    return remote_client
+        # Write the images straight into the input tensor, without intermediate arrays
+        for i, f in enumerate(frames):
+            model.write_input(f[3], self.input_details[0], self.input()[i])
 
+        self.interpreter.invoke()
 
-def do_tflite(queue):
-    """A Multiprocessing thread
-    Receive images from a queue, and perform image classification on it
+        # View on the output, only the rows of printed frames are read. Views must not
+        # be held across invokes, the interpreter refuses to run while they exist.
+        output_data = self.output()
+
+        # Processing time and allocations are shared equally by all frames in the batch
+        end_time = time.time_ns()
+        sec_frame = int((end_time - start_time) / self.batch_size)
+        alloc = int(self.allocations.stop() / self.batch_size)
+
+        replies = []
+        for (ip, port, header, _, log, latency, decode_time), results in zip(
+            frames, output_data
+        ):
+            if log:
+                scores = model.to_scores(results, self.output_details[0])
+                for i in model.top_k(scores):
+                    print(
+                        "\t{:08.6f} - {}\n".format(float(scores[i]), self.labels[i]),
+                        end="",
+                    )
+
+                print("[%s] Processing (ns): %i\n" % (self.name, sec_frame), end="")
+
+                # Send result back (currently only the frame header, but adding real feedback is trivial and has no impact)
+                print("[%s] Send result to source: %s" % (self.name, ip))
+                print("[%s] Get item\n" % (self.name), end="")
+
+            replies.append(
+                [
+                    ip,
+                    port,
+                    header,
+                    [start_time, end_time, latency, decode_time, sec_frame, alloc],
+                ]
+            )
+
+        return replies
+
+
+def init_worker(cpus):
+    """Initializer of each inference process
 
     Args:
-        data (bytestream): Raw received data
+        cpus (multiprocessing.Queue): CPUs to pin each process to, None to not pin
     """
-    current = multiprocessing.current_process()
-    print("[%s] Start thread\n" % (current.name), end="")
+    calibrate.pin(cpus.get())
 
-    # Load the labels
-    with open("labels.txt", "r") as f:
-        labels = [line.strip() for line in f.readlines()]
+    global classifier
+    classifier = Classifier()
 
-    # Load the model
-    interpreter = tflite.Interpreter(model_path="model.tflite", num_threads=1)
-    interpreter.allocate_tensors()
 
-    # Get model input details and resize image
-    input_details = interpreter.get_input_details()
-    floating_model = input_details[0]["dtype"] == np.float32
+def classify(items):
+    """Classify a batch of images in an inference process
 
-    iw = input_details[0]["shape"][2]
-    ih = input_details[0]["shape"][1]
+    Args:
+        items (list(list)): Frame buffer descriptors of the images
 
-    print("[%s] Preparations finished\n" % (current.name), end="")
+    Returns:
+        list(list): [ip, port, payload] reply and metrics for each image
+    """
+    return classifier(items)
 
-    remote_clients = {}
 
-    while True:
-        print("[%s] Get item\n" % (current.name), end="")
-        item = queue.get(block=True)
+def check_agreement():
+    """Compare the model variant to the reference variant on the bundled images
 
-        start_time = time.time_ns()
-        t_now = item[0]
-        data = item[1]
+    Returns:
+        list(list(int)): Top-1 and top-5 agreement (0 or 1) per image
+    """
+    return model.agreement(MODEL, "images", RESAMPLE)
+
+
+def ready():
+    """Wait until every inference process has loaded and warmed up its model.
+    Each call blocks an inference process until all have been reached, so one call per
+    inference process are spread over all inference processes.
+
+    Returns:
+        list(int): Time in ns after container start the model was loaded and warmed up
+    """
+    startup_barrier.wait()
+    return [classifier.loaded, classifier.warm]
+
+
+def memory():
+    """Get the memory usage of every inference process, like ready() each call
+    blocks an inference process until all have been reached.
+
+    Returns:
+        int, int: RSS and PSS of this inference process in bytes
+    """
+    startup_barrier.wait()
+    return memory_usage()
+
+
+class WorkQueue:
+    """Queue of received images waiting for an inference process, with an overflow policy.
+    With a capacity of 0 the queue is unbounded. Once the queue is full, a new image is handled by:
+    - drop-newest: drop the new image
+    - drop-oldest: drop the oldest queued image
+    - latest-per-endpoint: drop the oldest queued image of the same endpoint, or the oldest
+        queued image if that endpoint has none queued
+    - block: queue the image anyway, the subscriber stops reading from MQTT until there is space
+    """
+
+    POLICIES = ["drop-newest", "drop-oldest", "latest-per-endpoint", "block"]
+
+    def __init__(self, capacity, policy):
+        """Initialize the object
+
+        Args:
+            capacity (int): Maximum number of queued images, 0 for unbounded
+            policy (str): Overflow policy, see POLICIES
+        """
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown queue policy %s" % (policy))
+
+        self.capacity = capacity
+        self.policy = policy
+
+        # Entries are [endpoint id, item, queued], dropped entries are skipped when popped
+        self.entries = deque()
+        self.size = 0
+        self.nonempty = asyncio.Event()
+
+    def qsize(self):
+        """Number of queued images"""
+        return self.size
+
+    def empty(self):
+        """Check if no image is queued"""
+        return self.size == 0
+
+    def full(self):
+        """Check if the queue reached its capacity"""
+        return self.capacity > 0 and self.size >= self.capacity
+
+    def put(self, endpoint_id, item):
+        """Queue an image, applying the overflow policy
+
+        Args:
+            endpoint_id (int): ID of the endpoint that sent the image
+            item (list): Frame buffer descriptor of the image
+
+        Returns:
+            list(list): [endpoint id, item] of each image dropped to make room, or the new image itself
+        """
+        dropped = []
+        if self.full():
+            if self.policy == "drop-newest":
+                return [[endpoint_id, item]]
+            elif self.policy == "latest-per-endpoint":
+                entry = self.oldest_of(endpoint_id)
+                if entry is None:
+                    entry = self.oldest()
+
+                dropped.append(self.remove(entry))
+            elif self.policy != "block":
+                dropped.append(self.remove(self.oldest()))
+
+        self.entries.append([endpoint_id, item, True])
+        self.size += 1
+        self.nonempty.set()
+        return dropped
+
+    def oldest(self):
+        """Get the oldest queued entry, removing dropped entries in front of it"""
+        while not self.entries[0][2]:
+            self.entries.popleft()
+
+        return self.entries[0]
+
+    def oldest_of(self, endpoint_id):
+        """Get the oldest queued entry of one endpoint
+
+        Args:
+            endpoint_id (int): ID of the endpoint
+
+        Returns:
+            list: The entry, None if no image of the endpoint is queued
+        """
+        for entry in self.entries:
+            if entry[2] and entry[0] == endpoint_id:
+                return entry
+
+        return None
+
+    def remove(self, entry):
+        """Drop a queued entry
+
+        Returns:
+            list: [endpoint id, item] of the entry
+        """
+        entry[2] = False
+        self.size -= 1
+
+        return entry[:2]
+
+    def get_nowait(self):
+        """Take the oldest queued image
+
+        Raises:
+            asyncio.QueueEmpty: No image is queued
+
+        Returns:
+            list: Frame buffer descriptor of the image
+        """
+        if self.size == 0:
+            raise asyncio.QueueEmpty()
+
+        entry = self.oldest()
+        self.entries.popleft()
+        return self.remove(entry)[1]
+
+    async def get(self):
+        """Wait for an image, and take the oldest queued image
+
+        Returns:
+            list: Frame buffer descriptor of the image
+        """
+        while self.size == 0:
+            self.nonempty.clear()
+            await self.nonempty.wait()
+
+        return self.get_nowait()
+
+
+class Subscriber:
+    """Receive images over a transport, classify them in a pool of inference processes, and reply back.
+    Receiving, reply publishing and completion tracking all run in one asyncio event loop.
+    """
+
+    def __init__(self, loop, executor):
+        """Initialize the object
+
+        Args:
+            loop (asyncio.AbstractEventLoop): Event loop to run in
+            executor (ProcessPoolExecutor): Pool of inference processes
+        """
+        self.loop = loop
+        self.executor = executor
+
+        # Images arrive and replies go back over the same transport
+        self.transport = transport.select(TRANSPORTS, TRANSPORT)(loop)
+
+        # Received images waiting to be dispatched to an inference process,
+        # and images being processed or answered
+        self.pending = WorkQueue(QUEUE_SIZE, QUEUE_POLICY)
+        self.inflight = 0
+
+        # By default two batches per inference process of the (calibrated) layout, so each
+        # process has its next batch waiting
+        max_inflight = MAX_INFLIGHT
+        if max_inflight == 0:
+            max_inflight = 2 * layout[0] * BATCH_SIZE
+
+        self.batches = asyncio.Semaphore(max(1, max_inflight // BATCH_SIZE))
+
+        # Images received per endpoint, and images sent by endpoints that finished
+        self.received = defaultdict(int)
+        self.expected = {}
+        self.endpoints_done = set()
+        self.images_processed = 0
+        self.images_failed = 0
+        self.dropped = defaultdict(int)
+        self.finished = asyncio.Event()
+
+        self.metrics = Metrics(
+            "frames", ["start", "end", "latency", "decode", "processing", "alloc"]
+        )
+        self.queue_metrics = Metrics("queue", ["time", "depth"])
+
+    def receive(self, payload):
+        """Handle a message received from an endpoint
+
+        Args:
+            payload (bytes): Frame header, followed by the image for FRAME and TENSOR messages
+        """
+        t_now = time.time_ns()
+
+        try:
+            kind, endpoint_id, seq, _, _, _ = frame.unpack_header(payload)
+        except ValueError as e:
+            print("Skip invalid frame: %s\n" % (e), end="")
+            return
+
+        # Stop if a specific message is sent. Images still underway get DONE_TIMEOUT seconds to arrive
+        if kind == frame.DONE:
+            self.expected[endpoint_id] = seq
+            self.loop.call_later(DONE_TIMEOUT, self.endpoint_done, endpoint_id)
+            self.check_endpoint(endpoint_id)
+            return
+
+        self.received[endpoint_id] += 1
+        for dropped_id, item in self.pending.put(
+            endpoint_id, frame_buffer.write(t_now, payload)
+        ):
+            self.inflight += 1
+            self.loop.create_task(self.drop(dropped_id, item))
+
+        if self.pending.full() and QUEUE_POLICY == "block":
+            self.transport.pause_reading()
+
+        self.check_endpoint(endpoint_id)
+
+    async def drop(self, endpoint_id, item):
+        """Drop an image, and tell its endpoint it was dropped
+
+        Args:
+            endpoint_id (int): ID of the endpoint that sent the image
+            item (list): Frame buffer descriptor of the image
+        """
+        self.dropped[endpoint_id] += 1
+        frame_buffer.free(item)
+        ip, port, payload, _ = dropped_reply(item[4])
 
-        # Stop if a specific message is sent
         try:
-            if data.decode() == "1":
-                with endpoints_connected.get_lock():
-                    endpoints_connected.value -= 1
-                    counter = endpoints_connected.value
-
-                print(
-                    "[%s] A client disconnected, %i clients left\n"
-                    % (current.name, counter),
-                    end="",
-                )
+            await self.transport.publish(ip, port, payload)
+        finally:
+            self.inflight -= 1
+
+        self.check_finished()
+
+    def check_endpoint(self, endpoint_id):
+        """Mark an endpoint as done once all images it sent have been received
+
+        Args:
+            endpoint_id (int): ID of the endpoint
+        """
+        if (
+            endpoint_id in self.expected
+            and self.received[endpoint_id] >= self.expected[endpoint_id]
+        ):
+            self.endpoint_done(endpoint_id)
+
+    def endpoint_done(self, endpoint_id):
+        """Mark an endpoint as done
+
+        Args:
+            endpoint_id (int): ID of the endpoint
+        """
+        if endpoint_id in self.endpoints_done:
+            return
+
+        self.endpoints_done.add(endpoint_id)
+        print(
+            "A client disconnected, %i clients left\n"
+            % (ENDPOINT_CONNECTED - len(self.endpoints_done)),
+            end="",
+        )
+        self.check_finished()
+
+    def check_finished(self):
+        """Signal completion once all endpoints are done and all images are processed"""
+        if (
+            len(self.endpoints_done) >= ENDPOINT_CONNECTED
+            and self.pending.empty()
+            and self.inflight == 0
+        ):
+            self.finished.set()
+
+    async def get_batch(self):
+        """Get a batch of received images.
+        Wait until the first image arrives, then take whatever else is pending,
+        waiting at most BATCH_WAIT milliseconds for the batch to reach BATCH_SIZE images.
+        Images count as in flight as soon as they leave the queue, so the run can't be
+        considered finished while a batch is still being gathered.
+
+        Returns:
+            list(list): Up to BATCH_SIZE frame buffer descriptors
+        """
+        items = [await self.pending.get()]
+        self.inflight += 1
+        deadline = self.loop.time() + BATCH_WAIT / 1000.0
+
+        while len(items) < BATCH_SIZE:
+            if not self.pending.empty():
+                items.append(self.pending.get_nowait())
+                self.inflight += 1
                 continue
-        except:
-            print("[%s] Read image and apply ML\n" % (current.name), end="")
 
-        # Read the image, do ML on it
-        with images_processed.get_lock():
-            images_processed.value += 1
+            timeout = deadline - self.loop.time()
+            if timeout <= 0:
+                break
+
+            try:
+                items.append(await asyncio.wait_for(self.pending.get(), timeout))
+                self.inflight += 1
+            except asyncio.TimeoutError:
+                break
 
-        # Get sender IP, needed to reply back
-        ip_bytes = data[-15:]
-        ip = ip_bytes.decode("utf-8")
-        while ip[0] == "-":
-            ip = ip[1:]
+        return items
 
-        # Get timestamp to calculate latency. We prepended 0's to the time to make it a fixed length
-        t_bytes = data[-35:-15]
-        t_old = int(t_bytes.decode("utf-8"))
-        print("[%s] Latency (ns): %s\n" % (current.name, str(t_now - t_old)), end="")
+    async def dispatch(self):
+        """Send batches of images to the inference processes, with a bounded number in flight"""
+        while True:
+            await self.batches.acquire()
+            items = await self.get_batch()
 
-        # Get data to process
-        data = data[:-35]
-        image = Image.open(io.BytesIO(data))
-        image = image.resize((iw, ih)).convert(mode="RGB")
+            if self.transport.paused and not self.pending.full():
+                self.transport.resume_reading()
+            self.loop.create_task(self.process(items))
 
-        input_data = np.expand_dims(image, axis=0)
+    async def process(self, items):
+        """Classify a batch of images in an inference process, and send the replies
 
-        if floating_model:
-            input_data = (np.float32(input_data) - 127.5) / 127.5
+        Args:
+            items (list(list)): Frame buffer descriptors of the images
+        """
+        try:
+            replies = await self.loop.run_in_executor(self.executor, classify, items)
+        except Exception as e:
+            # The inference process is gone, reply to each image instead of losing the batch.
+            # Its slots are not freed here: the process may have freed them already, after
+            # which they can hold newer images. Without a process pool the run ends anyway.
+            print("Could not classify %i images: %r\n" % (len(items), e), end="")
+            replies = [dropped_reply(item[4]) for item in items]
+        finally:
+            self.inflight -= len(items)
+            self.batches.release()
 
-        interpreter.set_tensor(input_details[0]["index"], input_data)
+        try:
+            for ip, port, payload, metrics in replies:
+                if metrics is None:
+                    self.images_failed += 1
+                else:
+                    self.images_processed += 1
+                    self.metrics.add(*metrics)
 
-        interpreter.invoke()
+                await self.transport.publish(ip, port, payload)
+        finally:
+            self.check_finished()
 
-        output_details = interpreter.get_output_details()
-        output_data = interpreter.get_tensor(output_details[0]["index"])
-        results = np.squeeze(output_data)
+    async def monitor(self):
+        """Sample the number of queued images every QUEUE_SAMPLE milliseconds"""
+        while True:
+            self.queue_metrics.add(time.time_ns(), self.pending.qsize())
+            await asyncio.sleep(QUEUE_SAMPLE / 1000.0)
 
-        top_k = results.argsort()[-5:][::-1]
-        for i in top_k:
-            if floating_model:
-                print("\t{:08.6f} - {}\n".format(float(results[i]), labels[i]), end="")
-            else:
-                print(
-                    "\t{:08.6f} - {}\n".format(float(results[i] / 255.0), labels[i]),
-                    end="",
-                )
+    async def run(self):
+        """Run until all connected endpoints are done and all their images are processed"""
+        # Start and warm up all inference processes before subscribing
+        startup = await asyncio.gather(
+            *[self.loop.run_in_executor(self.executor, ready) for _ in range(layout[0])]
+        )
 
-        sec_frame = time.time_ns() - start_time
-        print("[%s] Processing (ns): %i\n" % (current.name, sec_frame), end="")
+        await self.transport.listen(self.receive)
 
-        # Send result back (currently only timestamp, but adding real feedback is trivial and has no impact)
-        print("[%s] Send result to source: %s" % (current.name, ip))
-        if ip not in remote_clients:
-            remote_clients[ip] = connect_remote_client(current, ip)
+        # Startup times of each inference process: model loaded, warmed up, and
+        # the whole subscriber ready to receive images
+        ready_time = time.time_ns() - START_TIME
+        print("Ready to receive images after %.2f seconds" % (ready_time / 10**9))
 
-        _ = remote_clients[ip].publish(MQTT_TOPIC, t_bytes, qos=0)
+        startup_metrics = Metrics("startup", ["loaded", "warm", "ready"])
+        for loaded, warm in startup:
+            startup_metrics.add(loaded, warm, ready_time)
 
+        startup_metrics.flush()
 
-def main():
-    print("Start connecting to the local MQTT broker")
-    print("Broker ip: " + str(MQTT_LOCAL_IP))
-    print("Topic: " + str(MQTT_TOPIC))
+        dispatcher = self.loop.create_task(self.dispatch())
+        monitor = self.loop.create_task(self.monitor())
+        await self.finished.wait()
 
-    pool = multiprocessing.Pool(CPU_THREADS, do_tflite, (work_queue,))
+        dispatcher.cancel()
+        monitor.cancel()
+        self.transport.close()
+        self.metrics.flush()
+        self.transport.metrics.flush()
+        self.queue_metrics.flush()
 
-    local_client = mqtt.Client()
-    local_client.on_connect = on_connect
-    local_client.on_message = on_message
-    local_client.on_subscribe = on_subscribe
+        # Images dropped per endpoint because the queue was full
+        drop_metrics = Metrics("drops", ["endpoint", "dropped"])
+        for endpoint_id, dropped in sorted(self.dropped.items()):
+            drop_metrics.add(endpoint_id, dropped)
 
-    if MQTT_LOGS == "True":
-        local_client.on_log = on_log
+        drop_metrics.flush()
+        print("Images dropped: %i" % (sum(self.dropped.values())))
 
-    local_client.connect(MQTT_LOCAL_IP, port=1883, keepalive=300)
-    local_client.loop_start()
+        # Memory of the main process and each inference process, while models are loaded
+        memory_metrics = Metrics("memory", ["rss", "pss"])
+        memory_metrics.add(*memory_usage())
+        for rss, pss in await asyncio.gather(
+            *[
+                self.loop.run_in_executor(self.executor, memory)
+                for _ in range(layout[0])
+            ]
+        ):
+            memory_metrics.add(rss, pss)
 
-    while True:
-        time.sleep(1)
-        with endpoints_connected.get_lock():
-            if endpoints_connected.value == 0 and work_queue.empty():
-                # Wait for any processing still happening to finish
-                time.sleep(10)
-                break
+        memory_metrics.flush()
+
+        # Report the accuracy cost of the model variant, after all timing-sensitive work
+        if MODEL != model.REFERENCE:
+            agreement = Metrics("agreement", ["top1", "top5"])
+            for top1, top5 in await self.loop.run_in_executor(
+                self.executor, check_agreement
+            ):
+                agreement.add(top1, top5)
+
+            agreement.flush()
+
+
+async def run():
+    loop = asyncio.get_running_loop()
+
+    processes, threads, pinned = layout
+    cpus = multiprocessing.Queue()
+    for cpu_set in (
+        calibrate.cpu_sets(processes, threads) if pinned else [None] * processes
+    ):
+        cpus.put(cpu_set)
+
+    with ProcessPoolExecutor(
+        processes, initializer=init_worker, initargs=(cpus,)
+    ) as executor:
+        subscriber = Subscriber(loop, executor)
+        await subscriber.run()
+
+    print(
+        "Finished, processed images: %i, failed images: %i"
+        % (subscriber.images_processed, subscriber.images_failed)
+    )
+
+    # Final counters, so the framework can tell a complete run from a cut-off one
+    done = Metrics("done", ["received", "processed", "dropped", "failed"])
+    done.add(
+        sum(subscriber.received.values()),
+        subscriber.images_processed,
+        sum(subscriber.dropped.values()),
+        subscriber.images_failed,
+    )
+    done.flush()
+
+
+def main():
+    # Fail on an unknown transport before calibrating
+    transport.select(TRANSPORTS, TRANSPORT)
+    print("Transport: " + TRANSPORT)
 
-    local_client.loop_stop()
+    # Pick the inference layout before any inference process is started
+    global layout, startup_barrier
+    if CALIBRATE != "off":
+        layout = calibrate.calibrate(
+            MODEL, CPU_THREADS, CALIBRATE, CALIBRATE_TIME, model_content
+        )
 
-    work_queue.close()
-    work_queue.join_thread()
+    calibrate.report(*layout)
+    startup_barrier = multiprocessing.Barrier(layout[0])
 
-    pool.close()
-    pool.terminate()
+    asyncio.run(run())
 
-    with images_processed.get_lock():
-        print("Finished, processed images: %i" % images_processed.value)
+    print(
+        "Frame buffer slots used (peak): %i / %i"
+        % (frame_buffer.used_peak.value, frame_buffer.slots)
+    )
+    print("Frame buffer overflows: %i" % (frame_buffer.overflows.value))
+    frame_buffer.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+"""\
+Tests of the subscriber, run with pytest from the subscriber directory.
+The subscriber reads its settings from the environment when imported, so defaults are set here.
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [
+    os.path.join(HERE, "..", "src"),
+    os.path.join(HERE, "..", "..", "common"),
+]
+
+for name, value in {
+    "MQTT_LOCAL_IP": "127.0.0.1",
+    "MQTT_LOGS": "False",
+    "CPU_THREADS": "1",
+    "ENDPOINT_CONNECTED": "1",
+}.items():
+    os.environ.setdefault(name, value)
+
+pytest.importorskip("paho.mqtt.client")
+pytest.importorskip("tflite_runtime.interpreter")
+
+import subscriber  # noqa: E402
+
+
+def test_latest_per_endpoint_not_full():
+    queue = subscriber.WorkQueue(2, "latest-per-endpoint")
+    assert queue.put(1, "a1") == []
+    assert queue.put(1, "a2") == []
+    assert queue.qsize() == 2
+
+
+def test_latest_per_endpoint_unbounded():
+    queue = subscriber.WorkQueue(0, "latest-per-endpoint")
+    for i in range(5):
+        assert queue.put(1, "a%i" % (i)) == []
+
+    assert queue.qsize() == 5
+
+
+def test_latest_per_endpoint_full():
+    queue = subscriber.WorkQueue(2, "latest-per-endpoint")
+    queue.put(1, "a1")
+    queue.put(2, "b1")
+
+    # Replace the queued image of the same endpoint
+    assert queue.put(1, "a2") == [[1, "a1"]]
+
+    # No image of this endpoint is queued, drop the oldest instead
+    assert queue.put(3, "c1") == [[2, "b1"]]
+    assert [queue.get_nowait(), queue.get_nowait()] == ["a2", "c1"]
+    assert queue.empty()
+
+
+def test_latest_per_endpoint_oldest_of_endpoint():
+    queue = subscriber.WorkQueue(3, "latest-per-endpoint")
+    queue.put(1, "a1")
+    queue.put(1, "a2")
+    queue.put(2, "b1")
+
+    assert queue.get_nowait() == "a1"
+    queue.put(2, "b2")
+    assert queue.put(1, "a3") == [[1, "a2"]]
+    assert [queue.get_nowait() for _ in range(3)] == ["b1", "b2", "a3"]
+
+
+class FakeClient:
+    """MQTT client that records what it publishes"""
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, qos=0):
+        self.published.append(payload)
+
+    def disconnect(self):
+        pass
+
+
+def test_reply_publisher_reconnects(monkeypatch):
+    attempts = []
+
+    async def connect_client(loop, client, ip, port, keepalive):
+        attempts.append(ip)
+        if len(attempts) == 1:
+            raise OSError("Connection refused")
+
+    monkeypatch.setattr(subscriber, "connect_client", connect_client)
+    monkeypatch.setattr(subscriber.mqtt, "Client", FakeClient)
+    monkeypatch.setattr(subscriber, "CONNECT_BACKOFF", 0.05)
+
+    async def run():
+        publisher = subscriber.ReplyPublisher(asyncio.get_running_loop(), ["10.0.0.1"])
+
+        # The connection made at startup fails, and the next attempt waits for the backoff
+        await publisher.publish("10.0.0.1", 1883, b"a")
+        await publisher.publish("10.0.0.1", 1883, b"b")
+        assert publisher.connecting == {}
+
+        await asyncio.sleep(0.1)
+        await publisher.publish("10.0.0.1", 1883, b"c")
+        return publisher
+
+    publisher = asyncio.run(run())
+    assert attempts == ["10.0.0.1", "10.0.0.1"]
+    assert publisher.unsent == 2
+    assert publisher.clients["10.0.0.1"].published == [b"c"]
+
+
+def test_transport_select():
+    for name in subscriber.transport.TRANSPORTS:
+        receiver = subscriber.transport.select(subscriber.TRANSPORTS, name)
+        assert issubclass(receiver, subscriber.transport.Receiver)
+
+    with pytest.raises(ValueError):
+        subscriber.transport.select(subscriber.TRANSPORTS, "quic")
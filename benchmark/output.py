@@ -5,11 +5,14 @@ Get output from KubeEdge and Docker, and process it into readable format
 import sys
 import logging
 import copy
+import json
 import numpy as np
 import pandas as pd
 
 from datetime import datetime
 
+from infrastructure import executor
+
 
 def get_endpoint_output(config, machines, container_names):
     """Get the output of endpoint docker containers.
@@ -23,27 +26,41 @@ def get_endpoint_output(config, machines, container_names):
         list(list(str)): Output of each endpoint container
     """
     logging.info("Extract output from endpoint publishers")
+    return get_container_output(machines, config["endpoint_ssh"], container_names)
+
 
-    endpoint_output = []
-    for ssh, cont_name in zip(config["endpoint_ssh"], container_names):
-        logging.info("Get output from endpoint %s on VM %s" % (cont_name, ssh))
+def get_container_output(machines, sshs, container_names):
+    """Get the output of docker containers on VMs, from all VMs in parallel
+
+    Args:
+        machines (list(Machine object)): List of machine objects representing physical machines
+        sshs (list(str)): SSH addresses of the VMs running the containers
+        container_names (list(str)): Names of docker containers launched
+
+    Returns:
+        list(list(str)): Output of each container
+    """
+    jobs = []
+    for ssh, cont_name in zip(sshs, container_names):
+        logging.info("Get output from container %s on VM %s" % (cont_name, ssh))
 
         # Alternatively, use docker logs -t container_name for detailed timestamps
         # Exampel: "2021-10-14T08:55:55.912611917Z Start connecting with the MQTT broker"
         command = ["docker", "logs", "-t", cont_name]
-        output, error = machines[0].process(command, ssh=True, ssh_target=ssh)
+        jobs.append(executor.Job(machines[0], command, ssh=True, ssh_target=ssh))
 
-        if error != []:
-            logging.error("".join(error))
+    container_output = []
+    for job, cont_name in zip(executor.run(jobs, timeout=300), container_names):
+        if job.error != []:
+            logging.error("".join(job.error))
             sys.exit()
-        elif output == []:
+        elif job.output == []:
             logging.error("Container %s output empty" % (cont_name))
             sys.exit()
 
-        output = [line.rstrip() for line in output]
-        endpoint_output.append(output)
+        container_output.append([line.rstrip() for line in job.output])
 
-    return endpoint_output
+    return container_output
 
 
 def get_worker_output(config, machines):
@@ -75,20 +92,27 @@ def get_worker_output(config, machines):
         sys.exit()
 
     # Get output from pods
-    worker_output = []
+    jobs = []
     for line in output[1:]:
         container = line.split(" ")[0]
         command = ["kubectl", "logs", "--timestamps=true", container]
-        output, error = machines[0].process(
-            command, ssh=True, ssh_target=config["cloud_ssh"][0]
+        jobs.append(
+            executor.Job(
+                machines[0],
+                command,
+                name=container,
+                ssh=True,
+                ssh_target=config["cloud_ssh"][0],
+            )
         )
 
-        if error != [] or output == []:
-            logging.error("".join(error))
+    worker_output = []
+    for job in executor.run(jobs, timeout=300):
+        if job.error != [] or job.output == []:
+            logging.error("".join(job.error))
             sys.exit()
 
-        output = [line.rstrip() for line in output]
-        worker_output.append(output)
+        worker_output.append([line.rstrip() for line in job.output])
 
     return worker_output
 
@@ -104,27 +128,7 @@ def get_worker_output_mist(config, machines, container_names):
         list(list(str)): Output of each container ran as a worker in the mist
     """
     logging.info("Gather output from subscribers")
-
-    worker_output = []
-    for ssh, cont_name in zip(config["edge_ssh"], container_names):
-        logging.info("Get output from mist worker %s on VM %s" % (cont_name, ssh))
-
-        # Alternatively, use docker logs -t container_name for detailed timestamps
-        # Exampel: "2021-10-14T08:55:55.912611917Z Start connecting with the MQTT broker"
-        command = ["docker", "logs", "-t", cont_name]
-        output, error = machines[0].process(command, ssh=True, ssh_target=ssh)
-
-        if error != []:
-            logging.error("".join(error))
-            sys.exit()
-        elif output == []:
-            logging.error("Container %s output empty" % (cont_name))
-            sys.exit()
-
-        output = [line.rstrip() for line in output]
-        worker_output.append(output)
-
-    return worker_output
+    return get_container_output(machines, config["edge_ssh"], container_names)
 
 
 def to_datetime(s):
@@ -143,6 +147,134 @@ def to_datetime(s):
     return datetime.strptime(s, "%Y-%m-%d %H:%M:%S.%f")
 
 
+def parse_metrics(out):
+    """Collect the chunked "Metrics <name>: <json>" lines printed by the applications
+
+    Args:
+        out (list(str)): Output of one container
+
+    Returns:
+        dict(dict(list(int))): Values per field, per set of metrics. Empty for old images.
+    """
+    metrics = {}
+    for line in out:
+        if "Metrics " not in line:
+            continue
+
+        try:
+            header, chunk = line.split(": ", 1)
+            name = header.split(" ")[-1]
+            chunk = json.loads(chunk)
+        except Exception as e:
+            logging.warn(
+                "Got an error while parsing line: %s. Exception: %s" % (line, e)
+            )
+            continue
+
+        fields = metrics.setdefault(name, {})
+        for field, values in chunk.items():
+            fields.setdefault(field, []).extend(values)
+
+    return metrics
+
+
+def to_ms(values):
+    """Convert a list of ns values to ms, and skip impossible negative values
+
+    Args:
+        values (list(int)): Values in ns
+
+    Returns:
+        list(float): Values in ms
+    """
+    negatives = [value for value in values if value < 0]
+    if len(negatives) > 0:
+        logging.warn("Got %i negative time values" % (len(negatives)))
+
+    return [round(value / 10**6, 4) for value in values if value >= 0]
+
+
+def startup_times(metrics, entry):
+    """Add the startup times of the application, if reported, to a parsed output entry.
+    Every inference process reports its own startup, the application is ready once all are.
+
+    Args:
+        metrics (dict(dict(list(int)))): Metrics parsed with parse_metrics()
+        entry (dict): Parsed output of a worker or endpoint
+    """
+    if "startup" not in metrics:
+        return
+
+    for key, field in [
+        ("load_time", "loaded"),
+        ("warm_time", "warm"),
+        ("ready_time", "ready"),
+    ]:
+        entry[key] = round(max(metrics["startup"][field]) / 10**9, 2)
+
+
+def model_agreement(metrics, entry):
+    """Add the agreement of the model variant with the reference variant, if reported,
+    to a parsed output entry. Only reported when a variant other than the reference is used.
+
+    Args:
+        metrics (dict(dict(list(int)))): Metrics parsed with parse_metrics()
+        entry (dict): Parsed output of a worker or endpoint
+    """
+    if "agreement" not in metrics:
+        return
+
+    entry["top1_agreement"] = round(np.mean(metrics["agreement"]["top1"]) * 100, 2)
+    entry["top5_agreement"] = round(np.mean(metrics["agreement"]["top5"]) * 100, 2)
+
+
+def memory_totals(metrics, entry):
+    """Add the total memory usage of all processes of the application, if reported,
+    to a parsed output entry. The RSS total counts shared memory once per process,
+    the PSS total counts it once.
+
+    Args:
+        metrics (dict(dict(list(int)))): Metrics parsed with parse_metrics()
+        entry (dict): Parsed output of a worker or endpoint
+    """
+    if "memory" not in metrics:
+        return
+
+    entry["rss_total"] = round(sum(metrics["memory"]["rss"]) / 10**6, 2)
+    entry["pss_total"] = round(sum(metrics["memory"]["pss"]) / 10**6, 2)
+
+
+def allocation_average(metrics, entry):
+    """Add the average memory allocated per frame during inference, if traced,
+    to a parsed output entry. Untraced frames report 0 allocated bytes.
+
+    Args:
+        metrics (dict(dict(list(int)))): Metrics parsed with parse_metrics()
+        entry (dict): Parsed output of a worker or endpoint
+    """
+    alloc = metrics.get("frames", {}).get("alloc", [])
+    if not any(alloc):
+        return
+
+    entry["alloc_avg"] = round(np.mean(alloc) / 10**3, 2)
+
+
+def inference_layout(metrics, entry):
+    """Add the layout of the inference processes, if reported, to a parsed output entry
+
+    Args:
+        metrics (dict(dict(list(int)))): Metrics parsed with parse_metrics()
+        entry (dict): Parsed output of a worker or endpoint
+    """
+    if "layout" not in metrics:
+        return
+
+    layout = metrics["layout"]
+    entry["layout"] = "%ix%i" % (layout["processes"][0], layout["threads"][0])
+    if layout["pinned"][0]:
+        entry["layout"] += " pinned"
+
+
 def gather_worker_metrics(worker_output):
     """Gather metrics from cloud or edge workers
 
@@ -162,6 +294,20 @@ def gather_worker_metrics(worker_output):
         "comm_delay_avg": None,  # Average endpoint -> worker delay
         "comm_delay_stdev": None,  # Stdev of delay
         "proc_avg": None,  # Average time to process 1 data element on worker
+        "decode_avg": None,  # Average time to decode 1 data element on worker
+        "conn_setup_avg": None,  # Average time to connect to an endpoint for replies
+        "load_time": None,  # Time after start until all models were loaded
+        "warm_time": None,  # Time after start until all models were warmed up
+        "ready_time": None,  # Time after start until the worker accepted data
+        "top1_agreement": None,  # Top-1 agreement of the model with the reference model
+        "top5_agreement": None,  # Top-5 agreement of the model with the reference model
+        "dropped": None,  # Number of data elements dropped because the queue was full
+        "queue_avg": None,  # Average number of queued data elements
+        "queue_max": None,  # Max number of queued data elements
+        "rss_total": None,  # Sum of the resident memory of all processes
+        "pss_total": None,  # Sum of the proportional memory of all processes
+        "layout": None,  # Inference processes x interpreter threads, and pinning
+        "alloc_avg": None,  # Average memory allocated per data element during inference
     }
 
     # Use 5th-90th percentile for average
@@ -177,15 +323,49 @@ def gather_worker_metrics(worker_output):
         # Sometimes, the program gets an incorrect line, then skip
         delays = []
         processing = []
+        decoding = []
+        connecting = []
         start_time = 0
         end_time = 0
         negatives = []
+
+        # Use the structured metrics if available, otherwise parse the log lines
+        metrics = parse_metrics(out)
+        if "frames" in metrics:
+            if "done" not in metrics:
+                logging.warn("Worker %i did not report completion" % (i))
+
+            frames = metrics["frames"]
+            delays = to_ms(frames["latency"])
+            processing = to_ms(frames["processing"])
+            decoding = to_ms(frames["decode"])
+            connecting = to_ms(metrics.get("connections", {}).get("setup", []))
+            startup_times(metrics, worker_metrics[-1])
+            model_agreement(metrics, worker_metrics[-1])
+            memory_totals(metrics, worker_metrics[-1])
+            inference_layout(metrics, worker_metrics[-1])
+            allocation_average(metrics, worker_metrics[-1])
+
+            # Drops per endpoint, and the queue depth over time
+            worker_metrics[-1]["dropped"] = sum(
+                metrics.get("drops", {}).get("dropped", [])
+            )
+            if "queue" in metrics:
+                depth = metrics["queue"]["depth"]
+                worker_metrics[-1]["queue_avg"] = round(np.mean(depth), 2)
+                worker_metrics[-1]["queue_max"] = max(depth)
+            total_time = (max(frames["end"]) - min(frames["start"])) / 10**9
+            out = []
+
         for line in out:
             if start_time == 0 and "Read image and apply ML" in line:
                 start_time = to_datetime(line)
             elif "Get item" in line:
                 end_time = to_datetime(line)
-            elif any(word in line for word in ["Latency", "Processing"]):
+            elif any(
+                word in line
+                for word in ["Latency", "Processing", "Decode", "Connection setup"]
+            ):
                 try:
                     unit = line[line.find("(") + 1 : line.find(")")]
                     time = int(line.rstrip().split(":")[-1])
@@ -210,16 +390,22 @@ def gather_worker_metrics(worker_output):
                         delays.append(round(time / 10**6, 4))
                     elif "Processing" in line:
                         processing.append(round(time / 10**6, 4))
+                    elif "Decode" in line:
+                        decoding.append(round(time / 10**6, 4))
+                    elif "Connection setup" in line:
+                        connecting.append(round(time / 10**6, 4))
 
-        worker_metrics[-1]["total_time"] = round(
-            (end_time - start_time).total_seconds(), 2
-        )
+        if "frames" not in metrics:
+            total_time = (end_time - start_time).total_seconds()
+
+        worker_metrics[-1]["total_time"] = round(total_time, 2)
 
         if len(negatives) > 0:
             logging.warn("Got %i negative time values" % (len(negatives)))
 
         delays.sort()
         processing.sort()
+        decoding.sort()
 
         logging.info(
             "Get percentile values between %i - %i"
@@ -237,7 +423,18 @@ def gather_worker_metrics(worker_output):
 
         worker_metrics[-1]["comm_delay_avg"] = round(np.mean(delays_perc), 2)
         worker_metrics[-1]["comm_delay_stdev"] = round(np.std(delays_perc), 2)
+        decoding_perc = decoding[
+            int(len(decoding) * lower_percentile) : int(
+                len(decoding) * upper_percentile
+            )
+        ]
+
         worker_metrics[-1]["proc_avg"] = round(np.mean(processing_perc), 2)
+        worker_metrics[-1]["decode_avg"] = round(np.mean(decoding_perc), 2)
+
+        # Connections are set up once per endpoint, so use all values
+        if connecting != []:
+            worker_metrics[-1]["conn_setup_avg"] = round(np.mean(connecting), 2)
 
     return sorted(worker_metrics, key=lambda x: x["worker_id"])
 
@@ -258,9 +455,23 @@ def gather_endpoint_metrics(config, endpoint_output, container_names):
         "worker_id": None,  # To which worker is this endpoint connected
         "total_time": None,  # Total runtime of the endpoint
         "proc_avg": None,  # Average procesing time per data element
+        "decode_avg": None,  # Average decoding time per data element (endpoint-only)
+        "preprocess_avg": None,  # Average preprocessing time before offloading (cloud/edge)
         "data_avg": None,  # Average generated data size
         "latency_avg": None,  # Average end-to-end latency
         "latency_stdev": None,  # Stdev latency
+        "lateness_avg": None,  # Average time a data element was generated later than scheduled
+        "load_time": None,  # Time after start until all models were loaded (endpoint-only)
+        "warm_time": None,  # Time after start until all models were warmed up (endpoint-only)
+        "ready_time": None,  # Time after start until data was accepted (endpoint-only)
+        "top1_agreement": None,  # Top-1 agreement with the reference model (endpoint-only)
+        "top5_agreement": None,  # Top-5 agreement with the reference model (endpoint-only)
+        "dropped": None,  # Number of data elements dropped by the worker (cloud/edge)
+        "rate_sustained": None,  # Send rate adapted to the latency target (cloud/edge)
+        "rss_total": None,  # Sum of the resident memory of all processes (endpoint-only)
+        "pss_total": None,  # Sum of the proportional memory of all processes (endpoint-only)
+        "layout": None,  # Inference processes x interpreter threads (endpoint-only)
+        "alloc_avg": None,  # Average memory allocated per data element (endpoint-only)
     }
 
     # Use 5th-90th percentile for average
@@ -291,8 +502,49 @@ def gather_endpoint_metrics(config, endpoint_output, container_names):
 
         # Parse line by line to get preparation, preprocessing and processing times
         processing = []
+        decoding = []
         latency = []
+        lateness = []
         data_size = []
+        preprocessing = []
+
+        # Use the structured metrics if available, otherwise parse the log lines
+        # Endpoint-only runs report "generated" and "frames", publishers "sent" and "replies"
+        metrics = parse_metrics(out)
+        if metrics != {}:
+            if "done" not in metrics:
+                logging.warn("Endpoint %s did not report completion" % (container_name))
+
+            generated = metrics.get("sent", metrics.get("generated", {}))
+            lateness = to_ms(generated.get("lateness", []))
+            data_size = [round(size / 10**3, 4) for size in generated.get("size", [])]
+
+            if "frames" in metrics:
+                processing = to_ms(metrics["frames"]["processing"])
+                decoding = to_ms(metrics["frames"]["decode"])
+                latency = to_ms(metrics["frames"]["latency"])
+                startup_times(metrics, endpoint_metrics[-1])
+                model_agreement(metrics, endpoint_metrics[-1])
+                memory_totals(metrics, endpoint_metrics[-1])
+                inference_layout(metrics, endpoint_metrics[-1])
+                allocation_average(metrics, endpoint_metrics[-1])
+            else:
+                processing = to_ms(generated.get("preparation", []))
+                preprocessing = to_ms(generated.get("preprocess", []))
+                latency = to_ms(metrics.get("replies", {}).get("latency", []))
+                endpoint_metrics[-1]["dropped"] = len(
+                    metrics.get("dropped", {}).get("seq", [])
+                )
+
+                # The rate controller needs time to settle, so use the second half of the run
+                if "rate" in metrics:
+                    rates = metrics["rate"]["frequency"]
+                    endpoint_metrics[-1]["rate_sustained"] = round(
+                        np.mean(rates[len(rates) // 2 :]) / 1000, 2
+                    )
+
+            out = []
+
         for line in out:
             if any(
                 word in line
@@ -301,6 +553,8 @@ def gather_endpoint_metrics(config, endpoint_output, container_names):
                     "Preparation, preprocessing and processing",
                     "Sending data",
                     "Latency",
+                    "Decode",
+                    "Send lateness",
                 ]
             ):
                 try:
@@ -326,6 +580,10 @@ def gather_endpoint_metrics(config, endpoint_output, container_names):
                     processing.append(round(number / 10**6, 4))
                 elif "Preparation and preprocessing" in line:
                     processing.append(round(number / 10**6, 4))
+                elif "Decode" in line:
+                    decoding.append(round(number / 10**6, 4))
+                elif "Send lateness" in line:
+                    lateness.append(round(number / 10**6, 4))
                 elif "Latency" in line:
                     latency.append(round(number / 10**6, 4))
                 elif "Sending data" in line:
@@ -355,6 +613,30 @@ def gather_endpoint_metrics(config, endpoint_output, container_names):
         if data_size != []:
             endpoint_metrics[-1]["data_avg"] = round(np.mean(data_size), 2)
 
+        if lateness != []:
+            endpoint_metrics[-1]["lateness_avg"] = round(np.mean(lateness), 2)
+
+        # Only report preprocessing if endpoints did any before offloading
+        if any(preprocessing):
+            preprocessing.sort()
+            preprocessing_perc = preprocessing[
+                int(len(preprocessing) * lower_percentile) : int(
+                    len(preprocessing) * upper_percentile
+                )
+            ]
+            endpoint_metrics[-1]["preprocess_avg"] = round(
+                np.mean(preprocessing_perc), 2
+            )
+
+        if decoding != []:
+            decoding.sort()
+            decoding_perc = decoding[
+                int(len(decoding) * lower_percentile) : int(
+                    len(decoding) * upper_percentile
+                )
+            ]
+            endpoint_metrics[-1]["decode_avg"] = round(np.mean(decoding_perc), 2)
+
     endpoint_metrics = sorted(endpoint_metrics, key=lambda x: x["worker_id"])
 
     return endpoint_metrics
@@ -411,12 +693,31 @@ def format_output(config, worker_metrics, endpoint_metrics):
         logging.info("%s OUTPUT" % (config["mode"].upper()))
         logging.info("------------------------------------")
         df1 = pd.DataFrame(worker_metrics)
+        if df1["top1_agreement"].isnull().all():
+            df1.drop(columns=["top1_agreement", "top5_agreement"], inplace=True)
+        if df1["rss_total"].isnull().all():
+            df1.drop(columns=["rss_total", "pss_total"], inplace=True)
+        if df1["layout"].isnull().all():
+            df1.drop(columns=["layout"], inplace=True)
+        if df1["alloc_avg"].isnull().all():
+            df1.drop(columns=["alloc_avg"], inplace=True)
+
         df1.rename(
             columns={
                 "total_time": "total_time (s)",
                 "comm_delay_avg": "delay_avg (ms)",
                 "comm_delay_stdev": "delay_stdev (ms)",
                 "proc_avg": "proc_time/data (ms)",
+                "decode_avg": "decode_time/data (ms)",
+                "conn_setup_avg": "conn_setup_avg (ms)",
+                "load_time": "model_load (s)",
+                "warm_time": "model_warm (s)",
+                "ready_time": "ready (s)",
+                "top1_agreement": "top1_agreement (%)",
+                "top5_agreement": "top5_agreement (%)",
+                "rss_total": "rss_total (MB)",
+                "pss_total": "pss_total (MB)",
+                "alloc_avg": "alloc/data (kB)",
             },
             inplace=True,
         )
@@ -428,14 +729,38 @@ def format_output(config, worker_metrics, endpoint_metrics):
     logging.info("------------------------------------")
     if config["mode"] == "cloud" or config["mode"] == "edge":
         df2 = pd.DataFrame(endpoint_metrics)
+        df2.drop(
+            columns=[
+                "load_time",
+                "warm_time",
+                "ready_time",
+                "top1_agreement",
+                "top5_agreement",
+                "rss_total",
+                "pss_total",
+                "layout",
+                "alloc_avg",
+            ],
+            inplace=True,
+        )
+        if df2["decode_avg"].isnull().all():
+            df2.drop(columns=["decode_avg"], inplace=True)
+        if df2["preprocess_avg"].isnull().all():
+            df2.drop(columns=["preprocess_avg"], inplace=True)
+        if df2["rate_sustained"].isnull().all():
+            df2.drop(columns=["rate_sustained"], inplace=True)
+
         df2.rename(
             columns={
                 "worker_id": "connected_to",
                 "total_time": "total_time (s)",
                 "proc_avg": "preproc_time/data (ms)",
+                "preprocess_avg": "split_preproc_time/data (ms)",
                 "data_avg": "data_size_avg (kb)",
                 "latency_avg": "latency_avg (ms)",
                 "latency_stdev": "latency_stdev (ms)",
+                "lateness_avg": "send_lateness_avg (ms)",
+                "rate_sustained": "sustained_rate (Hz)",
             },
             inplace=True,
         )
@@ -446,17 +771,47 @@ def format_output(config, worker_metrics, endpoint_metrics):
                 "worker_id",
                 "total_time",
                 "proc_avg",
+                "decode_avg",
                 "latency_avg",
                 "latency_stdev",
+                "lateness_avg",
+                "load_time",
+                "warm_time",
+                "ready_time",
+                "top1_agreement",
+                "top5_agreement",
+                "rss_total",
+                "pss_total",
+                "layout",
+                "alloc_avg",
             ],
         )
+        if df2["top1_agreement"].isnull().all():
+            df2.drop(columns=["top1_agreement", "top5_agreement"], inplace=True)
+        if df2["rss_total"].isnull().all():
+            df2.drop(columns=["rss_total", "pss_total"], inplace=True)
+        if df2["layout"].isnull().all():
+            df2.drop(columns=["layout"], inplace=True)
+        if df2["alloc_avg"].isnull().all():
+            df2.drop(columns=["alloc_avg"], inplace=True)
+
         df2.rename(
             columns={
                 "worker_id": "endpoint_id",
                 "total_time": "total_time (s)",
                 "proc_avg": "proc_time/data (ms)",
+                "decode_avg": "decode_time/data (ms)",
                 "latency_avg": "latency_avg (ms)",
                 "latency_stdev": "latency_stdev (ms)",
+                "lateness_avg": "send_lateness_avg (ms)",
+                "load_time": "model_load (s)",
+                "warm_time": "model_warm (s)",
+                "ready_time": "ready (s)",
+                "top1_agreement": "top1_agreement (%)",
+                "top5_agreement": "top5_agreement (%)",
+                "rss_total": "rss_total (MB)",
+                "pss_total": "pss_total (MB)",
+                "alloc_avg": "alloc/data (kB)",
             },
             inplace=True,
         )
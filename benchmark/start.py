@@ -4,17 +4,66 @@ Execute the benchmark and get raw output
 
 import logging
 import sys
-import time
 import os
 import sys
 
 sys.path.append(os.path.abspath(".."))
 
 import main
+from infrastructure import executor
 
 from . import output
 
 
+def watch_pods(config, machines, workers, phase):
+    """Follow the phase of the benchmark pods on the cloud controller until all pods reached a phase.
+    Kubectl prints a line for every change in pod status, so no polling is needed.
+
+    Args:
+        config (dict): Parsed configuration
+        machines (list(Machine object)): List of machine objects representing physical machines
+        workers (int): Number of pods to wait for
+        phase (str): Phase to wait for, "Running" or "Succeeded"
+    """
+    # A pod that already finished has been running as well
+    reached = {"Running": ["Running", "Succeeded"], "Succeeded": ["Succeeded"]}[phase]
+
+    command = [
+        "kubectl",
+        "get",
+        "pods",
+        "--watch",
+        "--no-headers",
+        "-o=custom-columns=NAME:.metadata.name,STATUS:.status.phase",
+    ]
+    process = machines[0].process(
+        command, output=False, ssh=True, ssh_target=config["cloud_ssh"][0]
+    )
+
+    phases = {}
+    for line in process.stdout:
+        app_name, app_status = line.decode("utf-8").split()
+        phases[app_name] = app_status
+
+        if app_status not in reached + ["Pending", "Running"]:
+            process.kill()
+            logging.error(
+                'Container on cloud/edge %s has status %s, expected "%s"'
+                % (app_name, app_status, phase)
+            )
+            sys.exit()
+
+        if len(phases) >= workers and all(p in reached for p in phases.values()):
+            process.kill()
+            return
+
+    error = [line.decode("utf-8") for line in process.stderr.readlines()]
+    logging.error(
+        "Stopped watching pods before all were %s: %s" % (phase, "".join(error))
+    )
+    sys.exit()
+
+
 def start_worker(config, machines):
     """Start the MQTT subscriber application on cloud / edge workers.
     Submit the job request to the cloud controller, which will automatically start it on the cluster.
@@ -48,6 +97,19 @@ def start_worker(config, machines):
         "cpu_lim": cores,
         "replicas": workers - 1,  # In cloud mode, this includes controller
         "cpu_threads": cores,
+        "batch_size": config["benchmark"]["batch_size"],
+        "batch_wait": config["benchmark"]["batch_wait"],
+        "resample": config["benchmark"]["resample"],
+        "preprocess_cache": config["benchmark"]["preprocess_cache"],
+        "reply_endpoints": ",".join(config["endpoint_ips"]),
+        "log_sample": config["benchmark"]["log_sample"],
+        "warmup": config["benchmark"]["warmup"],
+        "model": config["benchmark"]["model"],
+        "queue_size": config["benchmark"]["queue_size"],
+        "queue_policy": config["benchmark"]["queue_policy"],
+        "transport": config["benchmark"]["transport"],
+        "shared_model": config["benchmark"]["shared_model"],
+        "calibrate": config["benchmark"]["calibrate"],
     }
 
     vars_str = ""
@@ -65,55 +127,27 @@ def start_worker(config, machines):
     ]
     main.ansible_check_output(machines[0].process(command))
 
-    # Waiting for the applications to fully initialize (includes scheduling)
-    time.sleep(10)
     logging.info("Deployed %i %s applications" % (workers, config["mode"]))
     logging.info("Wait for subscriber applications to be scheduled and running")
+    watch_pods(config, machines, workers, "Running")
 
-    pending = True
-    i = 0
-
-    while i < workers:
-        # Get the list of deployed pods
-        if pending:
-            command = [
-                "kubectl",
-                "get",
-                "pods",
-                "-o=custom-columns=NAME:.metadata.name,STATUS:.status.phase",
-                "--sort-by=.spec.nodeName",
-            ]
-            output, error = machines[0].process(
-                command, ssh=True, ssh_target=config["cloud_ssh"][0]
-            )
 
-            if error != [] and any(
-                "couldn't find any field with path" in line for line in error
-            ):
-                logging.debug("Retry getting list of kubernetes pods")
-                time.sleep(5)
-                pending = True
-                continue
-            elif error != [] or output == []:
-                logging.error("".join(error))
-                sys.exit()
-
-        line = output[i + 1].rstrip().split(" ")
-        app_name = line[0]
-        app_status = line[-1]
-
-        # Check status of app
-        if app_status == "Pending":
-            time.sleep(5)
-            pending = True
-        elif app_status == "Running":
-            i += 1
-            pending = False
-        else:
-            logging.error(
-                'Container on cloud/edge %s has status %s, expected "Pending" or "Running"'
-                % (app_name, app_status)
-            )
+def check_container_run(jobs):
+    """Check the output of docker container run commands, and exit on failure
+
+    Args:
+        jobs (list(executor.Job)): Jobs that ran docker container run --detach
+    """
+    for job in jobs:
+        if (
+            job.error != []
+            and "Your kernel does not support swap limit capabilities"
+            not in job.error[0]
+        ):
+            logging.error("%s: %s" % (job.name, "".join(job.error)))
+            sys.exit()
+        elif job.output == []:
+            logging.error("No output from docker container on %s" % (job.name))
             sys.exit()
 
 
@@ -132,25 +166,42 @@ def start_worker_mist(config, machines):
     """
     logging.info("Deploy Docker containers on endpoints with publisher application")
 
-    processes = []
+    jobs = []
     container_names = []
 
-    for worker_ssh in config["edge_ssh"]:
+    end_per_work = int(
+        config["infrastructure"]["endpoint_nodes"]
+        / config["infrastructure"]["edge_nodes"]
+    )
+
+    for worker_i, worker_ssh in enumerate(config["edge_ssh"]):
         cont_name = worker_ssh.split("@")[0]
         worker_ip = worker_ssh.split("@")[1]
 
+        # Endpoints connected to this worker, used to set up reply connections at startup
+        endpoint_ips = config["endpoint_ips"][
+            worker_i * end_per_work : (worker_i + 1) * end_per_work
+        ]
+
         # Set variables for the application
         env = [
             "MQTT_LOCAL_IP=%s" % (worker_ip),
             "MQTT_LOGS=True",
             "CPU_THREADS=%i" % (config["infrastructure"]["edge_cores"]),
-            "ENDPOINT_CONNECTED=%i"
-            % (
-                int(
-                    config["infrastructure"]["endpoint_nodes"]
-                    / config["infrastructure"]["edge_nodes"]
-                )
-            ),
+            "ENDPOINT_CONNECTED=%i" % (end_per_work),
+            "BATCH_SIZE=%i" % (config["benchmark"]["batch_size"]),
+            "BATCH_WAIT=%s" % (config["benchmark"]["batch_wait"]),
+            "RESAMPLE=%s" % (config["benchmark"]["resample"]),
+            "PREPROCESS_CACHE=%i" % (config["benchmark"]["preprocess_cache"]),
+            "REPLY_ENDPOINTS=%s" % (",".join(endpoint_ips)),
+            "LOG_SAMPLE=%i" % (config["benchmark"]["log_sample"]),
+            "WARMUP=%i" % (config["benchmark"]["warmup"]),
+            "MODEL=%s" % (config["benchmark"]["model"]),
+            "QUEUE_SIZE=%i" % (config["benchmark"]["queue_size"]),
+            "QUEUE_POLICY=%s" % (config["benchmark"]["queue_policy"]),
+            "TRANSPORT=%s" % (config["benchmark"]["transport"]),
+            "SHARED_MODEL=%s" % (config["benchmark"]["shared_model"]),
+            "CALIBRATE=%s" % (config["benchmark"]["calibrate"]),
         ]
 
         logging.info("Launch %s" % (cont_name))
@@ -173,72 +224,41 @@ def start_worker_mist(config, machines):
             ]
         )
 
-        processes.append(
-            machines[0].process(command, output=False, ssh=True, ssh_target=worker_ssh)
-        )
+        jobs.append(executor.Job(machines[0], command, ssh=True, ssh_target=worker_ssh))
         container_names.append(cont_name)
 
     # Checkout process output
-    for process in processes:
-        logging.debug("Check output of command [%s]" % (" ".join(process.args)))
-        output = [line.decode("utf-8") for line in process.stdout.readlines()]
-        error = [line.decode("utf-8") for line in process.stderr.readlines()]
+    check_container_run(executor.run(jobs, timeout=300))
+
+    # Detached containers have been started once docker returns, so check their state once
+    jobs = []
+    for worker_ssh, cont_name in zip(config["edge_ssh"], container_names):
+        command = [
+            "docker",
+            "container",
+            "inspect",
+            "--format",
+            '"{{.State.Status}}"',
+            cont_name,
+        ]
+        jobs.append(executor.Job(machines[0], command, ssh=True, ssh_target=worker_ssh))
 
-        if (
-            error != []
-            and "Your kernel does not support swap limit capabilities" not in error[0]
-        ):
-            logging.error("".join(error))
+    for job, cont_name in zip(executor.run(jobs, timeout=60), container_names):
+        if job.error != []:
+            logging.error("".join(job.error))
             sys.exit()
-        elif output == []:
+        elif job.output == []:
             logging.error("No output from docker container")
             sys.exit()
 
-    # Wait for containers to be succesfully deployed
-    for worker_ssh in config["edge_ssh"]:
-        cont_name = worker_ssh.split("@")[0]
-        deployed = False
-
-        while not deployed:
-            command = [
-                "docker",
-                "container",
-                "ls",
-                "-a",
-                "--format",
-                '"{{.ID}}: {{.Status}} {{.Names}}"',
-            ]
-            output, error = machines[0].process(
-                command, ssh=True, ssh_target=worker_ssh
+        # A short run may have finished already, its exit code is checked later on
+        status = job.output[0].strip()
+        if status not in ["running", "exited"]:
+            logging.error(
+                "ERROR: Container %s in VM %s has status %s"
+                % (cont_name, job.name, status)
             )
-
-            if error != []:
-                logging.error("".join(error))
-                sys.exit()
-            elif output == []:
-                logging.error("No output from docker container")
-                sys.exit()
-
-            # Get status of docker container
-            status_line = None
-            for line in output:
-                if cont_name in line:
-                    status_line = line
-
-            if status_line == None:
-                logging.error(
-                    "ERROR: Could not find status of container %s running in VM %s: %s"
-                    % (cont_name, worker_ssh.split("@")[0], "".join(output))
-                )
-                sys.exit()
-
-            parsed = line.rstrip().split(" ")
-
-            # If not yet up, wait
-            if parsed[1] == "Up":
-                deployed = True
-            else:
-                time.sleep(5)
+            sys.exit()
 
     return container_names
 
@@ -255,7 +275,7 @@ def start_endpoint(config, machines):
     """
     logging.info("Deploy Docker containers on endpoints with publisher application")
 
-    processes = []
+    jobs = []
     container_names = []
 
     # Calc endpoints per worker
@@ -283,18 +303,43 @@ def start_endpoint(config, machines):
             ]
         ):
             # Docker container name and variables depends on deployment mode
-            cont_name = "endpoint%i" % (worker_i * end_per_work + endpoint_i)
-            env = ["FREQUENCY=%i" % (config["benchmark"]["frequency"])]
+            endpoint_id = worker_i * end_per_work + endpoint_i
+            cont_name = "endpoint%i" % (endpoint_id)
+            env = [
+                "FREQUENCY=%i" % (config["benchmark"]["frequency"]),
+                "ARRIVAL=%s" % (config["benchmark"]["arrival"]),
+                "LOG_SAMPLE=%i" % (config["benchmark"]["log_sample"]),
+            ]
 
             if config["mode"] == "cloud" or config["mode"] == "edge":
                 cont_name = "%s%i_" % (config["mode"], worker_i) + cont_name
                 env.append("MQTT_LOCAL_IP=%s" % (endpoint_ssh.split("@")[1]))
                 env.append("MQTT_REMOTE_IP=%s" % (worker_ip))
                 env.append("MQTT_LOGS=True")
+                env.append("ENDPOINT_ID=%i" % (endpoint_id))
+                env.append("TRANSPORT=%s" % (config["benchmark"]["transport"]))
+                env.append("OFFLOAD_SPLIT=%s" % (config["benchmark"]["offload_split"]))
+                env.append("RESAMPLE=%s" % (config["benchmark"]["resample"]))
+                env.append("MODEL=%s" % (config["benchmark"]["model"]))
+                env.append(
+                    "LATENCY_TARGET=%i" % (config["benchmark"]["latency_target"])
+                )
             else:
                 env.append(
                     "CPU_THREADS=%i" % (config["infrastructure"]["endpoint_cores"])
                 )
+                env.append("RESAMPLE=%s" % (config["benchmark"]["resample"]))
+                env.append(
+                    "PREPROCESS_CACHE=%i" % (config["benchmark"]["preprocess_cache"])
+                )
+                env.append(
+                    "DECODE_WORKERS=%i" % (config["benchmark"]["decode_workers"])
+                )
+                env.append("INFER_WORKERS=%i" % (config["benchmark"]["infer_workers"]))
+                env.append("WARMUP=%i" % (config["benchmark"]["warmup"]))
+                env.append("MODEL=%s" % (config["benchmark"]["model"]))
+                env.append("SHARED_MODEL=%s" % (config["benchmark"]["shared_model"]))
+                env.append("CALIBRATE=%s" % (config["benchmark"]["calibrate"]))
 
             logging.info("Launch %s" % (cont_name))
 
@@ -320,28 +365,13 @@ def start_endpoint(config, machines):
                 ]
             )
 
-            processes.append(
-                machines[0].process(
-                    command, output=False, ssh=True, ssh_target=endpoint_ssh
-                )
+            jobs.append(
+                executor.Job(machines[0], command, ssh=True, ssh_target=endpoint_ssh)
             )
             container_names.append(cont_name)
 
     # Checkout process output
-    for process in processes:
-        logging.debug("Check output of command [%s]" % (" ".join(process.args)))
-        output = [line.decode("utf-8") for line in process.stdout.readlines()]
-        error = [line.decode("utf-8") for line in process.stderr.readlines()]
-
-        if (
-            error != []
-            and "Your kernel does not support swap limit capabilities" not in error[0]
-        ):
-            logging.error("".join(error))
-            sys.exit()
-        elif output == []:
-            logging.error("No output from docker container")
-            sys.exit()
+    check_container_run(executor.run(jobs, timeout=300))
 
     return container_names
 
@@ -356,59 +386,33 @@ def wait_endpoint_completion(machines, sshs, container_names):
         container_names (list(str)): Names of docker containers launched
     """
     logging.info("Wait on all endpoint or mist containers to finish")
-    time.sleep(10)
 
+    # Docker returns as soon as a container exits, or at once if it exited already, so waiting
+    # with a bounded number of connections still ends when the last container does.
+    # Waiting takes as long as the benchmark runs, so don't limit the time.
+    jobs = []
     for ssh, cont_name in zip(sshs, container_names):
         logging.info(
             "Wait for container to finish: %s on VM %s" % (cont_name, ssh.split("@")[0])
         )
-        finished = False
-
-        while not finished:
-            # Get list of docker containers
-            command = [
-                "docker",
-                "container",
-                "ls",
-                "-a",
-                "--format",
-                '"{{.ID}}: {{.Status}} {{.Names}}"',
-            ]
-            output, error = machines[0].process(command, ssh=True, ssh_target=ssh)
-
-            if error != []:
-                logging.error("".join(error))
-                sys.exit()
-            elif output == []:
-                logging.error("No output from docker container")
-                sys.exit()
-
-            # Get status of docker container
-            status_line = None
-            for line in output:
-                if cont_name in line:
-                    status_line = line
-
-            if status_line == None:
-                logging.error(
-                    "ERROR: Could not find status of container %s running in VM %s: %s"
-                    % (cont_name, ssh.split("@")[0], "".join(output))
-                )
-                sys.exit()
+        command = ["docker", "container", "wait", cont_name]
+        jobs.append(executor.Job(machines[0], command, ssh=True, ssh_target=ssh))
 
-            parsed = line.rstrip().split(" ")
+    for job, cont_name in zip(executor.run(jobs), container_names):
+        if job.error != []:
+            logging.error("".join(job.error))
+            sys.exit()
+        elif job.output == []:
+            logging.error("No output from docker container wait")
+            sys.exit()
 
-            # Check status
-            if parsed[1] == "Up":
-                time.sleep(5)
-            elif parsed[1] == "Exited" and parsed[2] == "(0)":
-                finished = True
-            else:
-                logging.error(
-                    'ERROR: Container %s failed in VM %s with status "%s"'
-                    % (cont_name, ssh.split("@")[0], status_line)
-                )
-                sys.exit()
+        # Docker prints the exit code of the container
+        if job.output[0].strip() != "0":
+            logging.error(
+                "ERROR: Container %s failed in VM %s with exit code %s"
+                % (cont_name, job.name, job.output[0].strip())
+            )
+            sys.exit()
 
     logging.info("All endpoint or mist containers have finished")
 
@@ -421,8 +425,6 @@ def wait_worker_completion(config, machines):
         machines (list(Machine object)): List of machine objects representing physical machines
     """
     logging.info("Wait for pods on cloud/edge workers to finish")
-    get_list = True
-    i = 0
 
     workers = (
         config["infrastructure"]["cloud_nodes"] + config["infrastructure"]["edge_nodes"]
@@ -430,45 +432,7 @@ def wait_worker_completion(config, machines):
     if config["mode"] == "cloud" or config["mode"] == "edge":
         workers -= 1
 
-    # On the cloud controller, check the status of each pod, and wait until finished
-    while i < workers:
-        # Get the list of deployed pods
-        if get_list:
-            command = [
-                "kubectl",
-                "get",
-                "pods",
-                "-o=custom-columns=NAME:.metadata.name,STATUS:.status.phase",
-                "--sort-by=.spec.nodeName",
-            ]
-            output, error = machines[0].process(
-                command, ssh=True, ssh_target=config["cloud_ssh"][0]
-            )
-
-            if error != [] or output == []:
-                logging.error("".join(error))
-                sys.exit()
-
-        # Parse list, get status of app i
-        line = output[i + 1].rstrip().split(" ")
-        app_name = line[0]
-        app_status = line[-1]
-
-        # Check status of app i
-        if app_status == "Running":
-            time.sleep(5)
-            get_list = True
-        elif app_status == "Succeeded":
-            i += 1
-            get_list = False
-        else:
-            logging.error(
-                (
-                    'ERROR: Container on cloud/edge %s has status %s, expected "Running" or "Succeeded"'
-                    % (app_name, app_status)
-                )
-            )
-            sys.exit()
+    watch_pods(config, machines, workers, "Succeeded")
 
 
 def start(config, machines):
@@ -0,0 +1,360 @@
+"""\
+Persistent command agents on VMs and physical machines.
+Starting an SSH connection for every command makes the framework spend much of its time on SSH
+handshakes once there are many VMs. Instead, an agent (agent_server.py) is started once per target
+over a single SSH connection, and Machine.process sends commands to it. Commands run concurrently
+on the target, and their output and exit code are streamed back over the same connection.
+Locally, each command is an AgentProcess, which can be used like the subprocess.Popen object
+Machine.process returns otherwise.
+"""
+
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+# The agent source is sent as the first line over the connection, and executed by python3
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agent_server.py")
+BOOTSTRAP = "'import json, sys; exec(json.loads(sys.stdin.readline()))'"
+
+
+class Stream:
+    """Output stream of an agent command, filled by the agent and read like a pipe.
+    Lines are buffered in memory, so a command never blocks the connection shared
+    with other commands, even if its output is read later on.
+    """
+
+    def __init__(self):
+        """Initialize the object"""
+        self.lines = []
+        self.eof = False
+        self.condition = threading.Condition()
+
+    def put(self, line):
+        """Add a line of output
+
+        Args:
+            line (bytes): Output line
+        """
+        with self.condition:
+            self.lines.append(line)
+            self.condition.notify_all()
+
+    def close(self):
+        """Mark the end of the output"""
+        with self.condition:
+            self.eof = True
+            self.condition.notify_all()
+
+    def readline(self):
+        """Read the next line, block until it is available
+
+        Returns:
+            bytes: Next line, or b"" at the end of the output
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.lines != [] or self.eof)
+            if self.lines == []:
+                return b""
+
+            return self.lines.pop(0)
+
+    def readlines(self):
+        """Read all remaining lines, block until the end of the output
+
+        Returns:
+            list(bytes): Remaining lines
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.eof)
+            lines = self.lines
+            self.lines = []
+            return lines
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+
+class AgentProcess:
+    """A command running through an agent, used like a subprocess.Popen object"""
+
+    def __init__(self, agent, i, args):
+        """Initialize the object
+
+        Args:
+            agent (Agent): Agent running the command
+            i (int): ID of the command on the agent
+            args (list(str)): Command
+        """
+        self.agent = agent
+        self.id = i
+        self.args = args
+        self.pid = None
+        self.returncode = None
+        self.stdout = Stream()
+        self.stderr = Stream()
+        self.start_time = time.time()
+        self.exited = threading.Event()
+
+    def finish(self, code):
+        """Mark the command as finished, called by the agent
+
+        Args:
+            code (int): Exit code of the command
+        """
+        self.returncode = code
+        self.stdout.close()
+        self.stderr.close()
+        self.exited.set()
+
+    def poll(self):
+        """Check if the command has finished
+
+        Returns:
+            int: Exit code, None if the command is still running
+        """
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """Wait for the command to finish
+
+        Args:
+            timeout (float, optional): Max time to wait in seconds. Defaults to None.
+
+        Raises:
+            subprocess.TimeoutExpired: The command did not finish in time
+
+        Returns:
+            int: Exit code
+        """
+        if not self.exited.wait(timeout):
+            raise subprocess.TimeoutExpired(self.args, timeout)
+
+        return self.returncode
+
+    def communicate(self, timeout=None):
+        """Wait for the command to finish, and read all of its output
+
+        Args:
+            timeout (float, optional): Max time to wait in seconds. Defaults to None.
+
+        Raises:
+            subprocess.TimeoutExpired: The command did not finish in time
+
+        Returns:
+            bytes, bytes: Output and error of the command
+        """
+        self.wait(timeout)
+        return b"".join(self.stdout.readlines()), b"".join(self.stderr.readlines())
+
+    def kill(self):
+        """Kill the command on the target"""
+        self.agent.kill(self.id)
+
+
+class Agent:
+    """Connection to the command agent on one SSH target"""
+
+    def __init__(self, target, ssh):
+        """Initialize the object
+
+        Args:
+            target (str): Name of the target, used for logging
+            ssh (list(str)): SSH command to reach the target, without the remote command
+        """
+        self.target = target
+        self.ssh = ssh
+        self.process = None
+        self.available = False
+        self.ready = threading.Event()
+
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.next_id = 0
+
+        # Time between sending a command and receiving its exit code, in seconds
+        self.latencies = []
+
+    def start(self):
+        """Start the agent over SSH, without waiting for it to be ready"""
+        with open(SERVER, "r") as f:
+            source = f.read()
+
+        command = self.ssh + ["python3", "-u", "-c", BOOTSTRAP]
+        logging.debug("Start command agent: %s" % (" ".join(command)))
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        try:
+            self.process.stdin.write((json.dumps(source) + "\n").encode("utf-8"))
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            # SSH exited already, the receiver notices this as well
+            pass
+
+        threading.Thread(target=self.receive, daemon=True).start()
+        threading.Thread(target=self.log_errors, daemon=True).start()
+
+    def wait_ready(self, timeout):
+        """Wait for the agent to be ready. If it isn't, commands use their own SSH connection.
+
+        Args:
+            timeout (float): Max time to wait in seconds
+
+        Returns:
+            bool: The agent is available
+        """
+        if not self.ready.wait(timeout) or not self.available:
+            logging.warn(
+                "Command agent on %s did not start, use an SSH connection per command"
+                % (self.target)
+            )
+            self.process.kill()
+            return False
+
+        return True
+
+    def log_errors(self):
+        """Log the output of SSH itself, such as connection errors"""
+        for line in self.process.stderr:
+            logging.debug(
+                "Command agent on %s: %s" % (self.target, line.decode("utf-8").rstrip())
+            )
+
+    def receive(self):
+        """Pass the events of the agent to the commands they belong to"""
+        try:
+            for line in self.process.stdout:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    event = None
+
+                if not isinstance(event, dict):
+                    # Not from the agent, for example printed by a shell rc file on login
+                    logging.debug(
+                        "Command agent on %s, not an event: %s"
+                        % (self.target, line.decode("utf-8", "replace").rstrip())
+                    )
+                    continue
+
+                self.handle(event)
+        finally:
+            # The connection is gone: fail the running commands like a dropped SSH
+            # connection would
+            self.available = False
+            self.ready.set()
+            with self.lock:
+                pending = list(self.commands.values())
+                self.commands = {}
+
+            for process in pending:
+                process.stderr.put(
+                    b"Connection to the command agent on %s lost\n"
+                    % (self.target.encode("utf-8"))
+                )
+                process.finish(255)
+
+    def handle(self, event):
+        """Pass one event of the agent to the command it belongs to
+
+        Args:
+            event (dict): Event sent by the agent
+        """
+        if "ready" in event:
+            self.available = True
+            self.ready.set()
+            return
+
+        process = self.commands.get(event["id"])
+        if process is None:
+            return
+
+        if "started" in event:
+            process.pid = event["started"]
+        elif "stream" in event:
+            stream = process.stdout if event["stream"] == "stdout" else process.stderr
+            stream.put(event["line"].encode("utf-8"))
+        elif "exit" in event:
+            with self.lock:
+                del self.commands[event["id"]]
+
+            self.latencies.append(time.time() - process.start_time)
+            process.finish(event["exit"])
+
+    def send(self, request):
+        """Send a request to the agent, call while holding the lock
+
+        Args:
+            request (dict): Request to send
+
+        Returns:
+            bool: The request was sent
+        """
+        try:
+            self.process.stdin.write((json.dumps(request) + "\n").encode("utf-8"))
+            self.process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            self.available = False
+            return False
+
+        return True
+
+    def run(self, command):
+        """Run a command on the target
+
+        Args:
+            command (list(str)): Command, run by the shell of the target like SSH does:
+                with its arguments joined by spaces
+
+        Returns:
+            AgentProcess: The running command
+        """
+        with self.lock:
+            i = self.next_id
+            self.next_id += 1
+
+            process = AgentProcess(self, i, command)
+            self.commands[i] = process
+            if not self.send({"id": i, "command": " ".join(command)}):
+                del self.commands[i]
+                process.stderr.put(
+                    b"Command agent on %s is not available\n"
+                    % (self.target.encode("utf-8"))
+                )
+                process.finish(255)
+
+        return process
+
+    def kill(self, i):
+        """Kill a running command
+
+        Args:
+            i (int): ID of the command
+        """
+        with self.lock:
+            if i in self.commands:
+                self.send({"id": i, "kill": True})
+
+    def stop(self):
+        """Stop the agent, killing all commands still running on the target"""
+        if self.process is None:
+            return
+
+        with self.lock:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+        self.available = False
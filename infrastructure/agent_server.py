@@ -0,0 +1,125 @@
+"""\
+Command agent running on a VM or physical machine, started by agent.py over a single SSH connection.
+This file is sent over that connection and run by python3 on the target, so it only uses the
+standard library and does not import anything from the framework.
+
+Requests are read from stdin, one JSON object per line:
+- {"id": i, "command": str}: Run a command with bash, like ssh would
+- {"id": i, "kill": true}: Kill a running command
+
+Events are written to stdout, one JSON object per line:
+- {"ready": true}: The agent is running and accepts requests
+- {"id": i, "started": pid}: Command i has been started
+- {"id": i, "stream": "stdout" or "stderr", "line": str}: Output line of command i
+- {"id": i, "exit": code}: Command i has exited, sent after all of its output
+"""
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+lock = threading.Lock()
+processes = {}
+
+
+def send(event):
+    """Write an event to the orchestrator
+
+    Args:
+        event (dict): Event to send
+    """
+    with lock:
+        sys.stdout.write(json.dumps(event) + "\n")
+        sys.stdout.flush()
+
+
+def forward(i, name, stream):
+    """Send each line a command writes to one of its output streams
+
+    Args:
+        i (int): ID of the command
+        name (str): Name of the stream, stdout or stderr
+        stream (file): Output stream of the command
+    """
+    for line in iter(stream.readline, b""):
+        send({"id": i, "stream": name, "line": line.decode("utf-8", "replace")})
+
+    stream.close()
+
+
+def kill(process):
+    """Kill a command and everything it started, which runs in its own process group
+
+    Args:
+        process (subprocess.Popen): Process of the command
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run(i, command):
+    """Run a command, stream its output, and report its exit code
+
+    Args:
+        i (int): ID of the command
+        command (str): Command to run with bash
+    """
+    try:
+        process = subprocess.Popen(
+            command,
+            shell=True,
+            executable="/bin/bash",
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+    except OSError as e:
+        send({"id": i, "stream": "stderr", "line": "%s\n" % (e)})
+        send({"id": i, "exit": 127})
+        return
+
+    processes[i] = process
+    send({"id": i, "started": process.pid})
+
+    readers = [
+        threading.Thread(target=forward, args=(i, name, stream))
+        for name, stream in [("stdout", process.stdout), ("stderr", process.stderr)]
+    ]
+    for reader in readers:
+        reader.start()
+
+    for reader in readers:
+        reader.join()
+
+    code = process.wait()
+    del processes[i]
+    send({"id": i, "exit": code})
+
+
+def main():
+    send({"ready": True})
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        if request.get("kill"):
+            process = processes.get(request["id"])
+            if process is not None:
+                kill(process)
+        else:
+            threading.Thread(
+                target=run, args=(request["id"], request["command"]), daemon=True
+            ).start()
+
+    # The orchestrator closed the connection, so nobody is waiting for the output anymore
+    for process in list(processes.values()):
+        kill(process)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""\
+Receive boot-completion reports from VMs, as a fast path next to probing them over SSH.
+The cloud-init user data of each VM (see qemu/generate.py) ends by sending its name and uptime
+to an HTTP listener on the main machine. While the framework probes the VMs over SSH, a VM is
+ready as soon as either its report arrives or its SSH server answers, so VMs whose report never
+arrives, for example because a firewall blocks the listener, cost no extra time.
+"""
+
+import asyncio
+import http.server
+import logging
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+# Default port of the listener on the main machine (infrastructure->boot_port)
+PORT = 8099
+
+# Warn about VMs that did not report their boot within this many seconds
+TIMEOUT = 60
+
+# Interval in seconds between checks for a report while waiting
+POLL = 0.2
+
+# Listener of this run, None if VMs can't report their boot
+listener = None
+
+
+class Listener(http.server.ThreadingHTTPServer):
+    """HTTP server storing the boot reports of VMs"""
+
+    def __init__(self, port):
+        """Initialize the object
+
+        Args:
+            port (int): Port to listen on, on all interfaces
+        """
+        super().__init__(("", port), Handler)
+        self.booted = {}
+        self.condition = threading.Condition()
+
+    def report(self, name, uptime):
+        """Store the boot report of a VM
+
+        Args:
+            name (str): Name of the VM
+            uptime (float): Seconds since the VM started booting
+        """
+        with self.condition:
+            self.booted[name] = uptime
+            self.condition.notify_all()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Handle a boot report: a POST with the name of the VM and the content of /proc/uptime"""
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        fields = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"))
+
+        try:
+            name = fields["name"][0]
+            uptime = float(fields["uptime"][0].split()[0])
+        except (KeyError, IndexError, ValueError):
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        self.server.report(name, uptime)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug(
+            "Boot report from %s: %s" % (self.client_address[0], format % args)
+        )
+
+
+def start(port=PORT):
+    """Start listening for boot reports in the background
+
+    Args:
+        port (int, optional): Port to listen on. Defaults to PORT.
+    """
+    global listener
+
+    if listener is not None:
+        return
+
+    try:
+        listener = Listener(port)
+    except OSError as e:
+        logging.warn(
+            "Can't listen for VM boot reports on port %i, wait for SSH only: %s"
+            % (port, e)
+        )
+        listener = None
+        return
+
+    threading.Thread(target=listener.serve_forever, daemon=True).start()
+
+
+def reported(name):
+    """Get the boot report of a VM
+
+    Args:
+        name (str): Name of the VM
+
+    Returns:
+        float: Uptime of the VM when it reported its boot, None if it did not report (yet)
+    """
+    if listener is None:
+        return None
+
+    with listener.condition:
+        return listener.booted.get(name)
+
+
+async def sleep(name, delay):
+    """Sleep, but return early once a VM reports its boot
+
+    Args:
+        name (str): Name of the VM
+        delay (float): Max time to sleep in seconds
+    """
+    end_time = time.time() + delay
+    while reported(name) is None and time.time() < end_time:
+        await asyncio.sleep(min(POLL, max(0, end_time - time.time())))
+
+
+async def watch(names, timeout=TIMEOUT):
+    """Warn once about VMs that did not report their boot in time, so they rely on SSH only
+
+    Args:
+        names (list(str)): Names of the VMs
+        timeout (float, optional): Time in seconds to wait for reports. Defaults to TIMEOUT.
+    """
+    if listener is None:
+        return
+
+    await asyncio.sleep(timeout)
+    missing = [name for name in names if reported(name) is None]
+    if missing != []:
+        logging.warn(
+            "No boot report from VMs after %i seconds, wait for SSH instead: %s"
+            % (timeout, ", ".join(missing))
+        )
+
+
+def summary(names):
+    """Log the boot durations the VMs reported
+
+    Args:
+        names (list(str)): Names of the VMs
+    """
+    booted = {name: reported(name) for name in names}
+    booted = {name: uptime for name, uptime in booted.items() if uptime is not None}
+    if booted == {}:
+        return
+
+    for name, uptime in booted.items():
+        logging.info("VM %s booted in %.1f seconds" % (name, uptime))
+
+    durations = list(booted.values())
+    logging.info(
+        "Boot duration of %i VMs: avg %.1f, min %.1f, max %.1f seconds"
+        % (len(durations), np.mean(durations), min(durations), max(durations))
+    )
+
+
+def stop():
+    """Stop listening for boot reports"""
+    global listener
+
+    if listener is not None:
+        listener.shutdown()
+        listener.server_close()
+        listener = None
@@ -0,0 +1,168 @@
+"""\
+Run a command on many targets concurrently.
+At most a fixed number of commands run at once, so a burst of SSH connections does not exceed
+the MaxStartups limit of sshd on the physical machines. Each command can have a timeout, and
+commands failing on a transient SSH error before they started are retried with exponential
+backoff.
+All output is read while the commands run, and the results are returned per job, so a slow
+target does not hide behind the targets that are checked before it.
+"""
+
+import concurrent.futures
+import logging
+import subprocess
+import time
+
+# Max number of commands running at once, below the default MaxStartups of sshd (10:30:100)
+PARALLEL = 10
+
+# Retries after a transient error, and the backoff before the first retry in seconds
+RETRIES = 2
+BACKOFF = 1
+
+# SSH errors that are solved by trying again, for example when sshd drops connections because
+# too many are starting at once. SSH itself exits with code 255 on these errors. Only errors
+# before authentication are retried: the remote command has not started yet at that point,
+# while retrying after a dropped connection could run a command such as docker run twice.
+TRANSIENT = [
+    "kex_exchange_identification",
+    "ssh_exchange_identification",
+]
+
+
+class Job:
+    """A command to run on one target with Machine.process, and its result once it has run"""
+
+    def __init__(
+        self, machine, command, name=None, shell=False, ssh=False, ssh_target=None
+    ):
+        """Initialize the object
+
+        Args:
+            machine (Machine object): Machine to run the command with
+            command (str or list(str)): Command, see Machine.process
+            name (str, optional): Name of the target for logging. Defaults to the VM
+                name of ssh_target, or the machine name.
+            shell (bool, optional): Use the shell, see Machine.process. Defaults to False.
+            ssh (bool, optional): Prepend SSH command, see Machine.process. Defaults to False.
+            ssh_target (str, optional): VM to SSH into, see Machine.process. Defaults to None.
+        """
+        self.machine = machine
+        self.command = command
+        self.shell = shell
+        self.ssh = ssh
+        self.ssh_target = ssh_target
+
+        if name is not None:
+            self.name = name
+        elif ssh_target is not None:
+            self.name = ssh_target.split("@")[0]
+        else:
+            self.name = machine.name
+
+        # Result of the last attempt
+        self.output = []
+        self.error = []
+        self.returncode = None
+        self.timed_out = False
+        self.attempts = 0
+        self.duration = None
+
+    def transient(self):
+        """Check if the last attempt failed on an error that may be solved by trying again
+
+        Returns:
+            bool: The command failed on a transient SSH error
+        """
+        return self.returncode == 255 and any(
+            pattern in line for line in self.error for pattern in TRANSIENT
+        )
+
+    def attempt(self, timeout):
+        """Run the command once, and store its result
+
+        Args:
+            timeout (float): Max time in seconds for the command, None for no limit
+        """
+        self.attempts += 1
+        start_time = time.time()
+        process = self.machine.process(
+            self.command,
+            shell=self.shell,
+            output=False,
+            ssh=self.ssh,
+            ssh_target=self.ssh_target,
+        )
+
+        self.timed_out = False
+        try:
+            output, error = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            output, error = process.communicate()
+            self.timed_out = True
+
+        self.duration = time.time() - start_time
+        self.returncode = process.returncode
+        self.output = output.decode("utf-8").splitlines(keepends=True)
+        self.error = error.decode("utf-8").splitlines(keepends=True)
+
+        if self.timed_out:
+            self.error.append(
+                "Command on %s timed out after %i seconds: %s\n"
+                % (self.name, timeout, self.command)
+            )
+
+        logging.debug(
+            "Command on %s finished in %.2f seconds with exit code %s"
+            % (self.name, self.duration, self.returncode)
+        )
+
+
+def execute(job, timeout, retries):
+    """Run a job, and retry it on transient errors
+
+    Args:
+        job (Job): Job to run
+        timeout (float): Max time in seconds per attempt, None for no limit
+        retries (int): Max number of retries
+    """
+    for i in range(retries + 1):
+        job.attempt(timeout)
+        if i == retries or not job.transient():
+            return
+
+        logging.warn(
+            "Transient error on %s, try again (%i/%i): %s"
+            % (job.name, i + 1, retries, job.error[0].strip())
+        )
+        time.sleep(BACKOFF * 2**i)
+
+
+def run(jobs, parallel=PARALLEL, timeout=None, retries=RETRIES):
+    """Run jobs concurrently, with at most parallel jobs running at once
+
+    Args:
+        jobs (list(Job)): Jobs to run
+        parallel (int, optional): Max number of jobs running at once. Defaults to PARALLEL.
+        timeout (float, optional): Max time in seconds per attempt of a job. Defaults to None.
+        retries (int, optional): Max number of retries per job after a transient error.
+            Defaults to RETRIES.
+
+    Returns:
+        list(Job): The given jobs with their results, in the same order
+    """
+    if jobs == []:
+        return jobs
+
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as pool:
+        # Consume the results, so exceptions in a job are raised here
+        list(pool.map(lambda job: execute(job, timeout, retries), jobs))
+
+    slowest = max(jobs, key=lambda job: job.duration)
+    logging.debug(
+        "Ran %i commands in %.2f seconds, slowest on %s: %.2f seconds"
+        % (len(jobs), time.time() - start_time, slowest.name, slowest.duration)
+    )
+    return jobs
@@ -9,6 +9,9 @@ import os
 import subprocess
 import re
 import getpass
+import time
+
+from .agent import Agent
 
 
 class Machine:
@@ -55,6 +58,13 @@ class Machine:
         self.endpoint_names = []
         self.base_names = []
 
+        # Command agents per SSH target (user@ip of a VM, None for this machine itself)
+        self.agents = {}
+
+        # SSH connections started per target, and the latency of commands whose output was read
+        self.connections = {}
+        self.latencies = {}
+
     def __repr__(self):
         """Returns this string when called as print(machine_object)"""
         return """
@@ -124,8 +134,32 @@ BASE_NAMES              %s""" % (
         if shell == True:
             executable = "/bin/bash"
 
+        # Send the command to the agent of the target if it has one. Commands given as a string
+        # are partly interpreted by the local shell, so only commands given as a list are sent.
+        agent = self.agents.get(ssh_target) if ssh else None
+        if (
+            agent is not None
+            and agent.available
+            and type(command) == list
+            and not shell
+            and env is None
+        ):
+            logging.debug("Send command to agent on %s: %s" % (agent.target, command))
+            process = agent.run(command)
+
+            if output:
+                output = [line.decode("utf-8") for line in process.stdout.readlines()]
+                error = [line.decode("utf-8") for line in process.stderr.readlines()]
+                return output, error
+            else:
+                return process
+
+        target = None
         if ssh:
             if not (self.is_local and ssh_target == None):
+                target = self.name if ssh_target == None else ssh_target
+                self.connections[target] = self.connections.get(target, 0) + 1
+
                 if ssh_target == None:
                     add = ["ssh", self.name]
                 else:
@@ -148,6 +182,7 @@ BASE_NAMES              %s""" % (
                     sys.exit()
 
         logging.debug("Start subprocess: %s" % (command))
+        start_time = time.time()
         process = subprocess.Popen(
             command,
             shell=shell,
@@ -160,10 +195,55 @@ BASE_NAMES              %s""" % (
         if output:
             output = [line.decode("utf-8") for line in process.stdout.readlines()]
             error = [line.decode("utf-8") for line in process.stderr.readlines()]
+
+            if target != None:
+                self.latencies.setdefault(target, []).append(time.time() - start_time)
+
             return output, error
         else:
             return process
 
+    def start_agents(self, targets, timeout=60):
+        """Start a command agent on each SSH target, so all commands sent to a target with
+        process() share a single SSH connection. Agents are started in parallel.
+        Targets without a running agent keep using an SSH connection per command.
+
+        Args:
+            targets (list(str)): VMs to start an agent on (user@ip), None for this machine itself
+            timeout (int, optional): Max time in seconds for all agents to start. Defaults to 60.
+        """
+        agents = []
+        for target in targets:
+            if target == None:
+                if self.is_local:
+                    continue
+
+                agent = Agent(self.name, ["ssh", self.name])
+            else:
+                agent = Agent(
+                    target,
+                    [
+                        "ssh",
+                        target,
+                        "-i",
+                        str(os.getenv("HOME")) + "/.ssh/id_rsa_benchmark",
+                    ],
+                )
+
+            agent.start()
+            self.agents[target] = agent
+            self.connections[agent.target] = self.connections.get(agent.target, 0) + 1
+            agents.append(agent)
+
+        end_time = time.time() + timeout
+        for agent in agents:
+            agent.wait_ready(max(0, end_time - time.time()))
+
+    def stop_agents(self):
+        """Stop all command agents of this machine"""
+        for agent in self.agents.values():
+            agent.stop()
+
     def check_hardware(self):
         """Get the amount of physical cores for this machine.
         This automatically functions as reachability check for this machine.
@@ -476,6 +556,49 @@ def set_ip_names(config, machines, nodes_per_machine):
                 base_index += 1
 
 
+def print_commands(machines):
+    """Print the number of SSH connections and commands per target, and their average latency.
+    Commands sent to an agent share the single connection the agent was started with.
+    This is printed after the benchmark results, so it is logged at debug level to keep the
+    results at the end of the regular output.
+
+    Args:
+        machines (list(Machine object)): List of machine objects representing physical machines
+    """
+    logging.debug("-" * 78)
+    logging.debug("SSH connections and commands per target")
+    logging.debug("-" * 78)
+
+    logging.debug(
+        "%-30s %-11s %-11s %-11s %-11s"
+        % ("Target", "SSH conns", "SSH (ms)", "Agent cmds", "Agent (ms)")
+    )
+
+    def average(latencies):
+        if latencies == []:
+            return "-"
+
+        return "%.2f" % (sum(latencies) / len(latencies) * 1000)
+
+    for machine in machines:
+        agents = {agent.target: agent for agent in machine.agents.values()}
+        for target in sorted(set(machine.connections) | set(agents)):
+            agent_latencies = agents[target].latencies if target in agents else []
+
+            logging.debug(
+                "%-30s %-11i %-11s %-11i %-11s"
+                % (
+                    target,
+                    machine.connections.get(target, 0),
+                    average(machine.latencies.get(target, [])),
+                    len(agent_latencies),
+                    average(agent_latencies),
+                )
+            )
+
+    logging.debug("-" * 78)
+
+
 def print_schedule(machines):
     """Print the VM to physical machine scheduling
 
@@ -5,6 +5,8 @@ Use TC to control latency / throughput between VMs, and perform network benchmar
 import logging
 import sys
 
+from . import executor
+
 
 def generate_tc_commands(values, overhead, ips, disk, arch):
     """Generate TC commands
@@ -263,12 +265,11 @@ def start(config, machines):
         commands.append(command)
 
     # Execute TC command in parallel
-    processes = []
+    jobs = []
     for ssh, command in zip(
         config["cloud_ssh"] + config["edge_ssh"] + config["endpoint_ssh"], commands
     ):
         if command == []:
-            processes.append(False)
             continue
 
         c = [" ".join(com) for com in command]
@@ -277,24 +278,16 @@ def start(config, machines):
         c = ";".join(c)
         c = '"' + c + '"'
 
-        processes.append(
-            machines[0].process(c, shell=True, output=False, ssh=True, ssh_target=ssh)
-        )
+        jobs.append(executor.Job(machines[0], c, shell=True, ssh=True, ssh_target=ssh))
 
     # Check output of TC commands
     logging.info("Check output from TC operations")
-    for process in processes:
-        if process == False:
-            continue
-
-        output = [line.decode("utf-8") for line in process.stdout.readlines()]
-        error = [line.decode("utf-8") for line in process.stderr.readlines()]
-
-        if error != []:
-            logging.error("".join(error))
+    for job in executor.run(jobs, timeout=120):
+        if job.error != []:
+            logging.error("%s: %s" % (job.name, "".join(job.error)))
             sys.exit()
-        elif output != []:
-            logging.error("".join(output))
+        elif job.output != []:
+            logging.error("%s: %s" % (job.name, "".join(job.output)))
             sys.exit()
 
 
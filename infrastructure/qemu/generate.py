@@ -92,11 +92,17 @@ runcmd:
  - rm /etc/netplan/50-cloud-init.yaml
  - netplan generate
  - netplan apply
-# written to /var/log/cloud-init-output.log
+%s# written to /var/log/cloud-init-output.log
 final_message: "The system is finally up, after $UPTIME seconds"
 """
 
 
+# Report to the framework that the VM has booted, see infrastructure/boot.py
+BOOT_REPORT = """\
+ - curl -s -m 5 --retry 5 --retry-connrefused -d name=%s --data-urlencode uptime@/proc/uptime http://%s:%i/
+"""
+
+
 def find_bridge(machine, bridge):
     """Check if bridge <bridge> is available on the system.
 
@@ -117,6 +123,45 @@ def find_bridge(machine, bridge):
     return int(output[0].rstrip())
 
 
+def find_host_ip(machine, bridge):
+    """Find the IP of the physical machine on bridge <bridge>, which VMs use to reach it.
+
+    Args:
+        machine (Machine object): Object representing the physical machine we currently use
+        bridge (str): Bridge name
+
+    Returns:
+        str: IP of the machine on the bridge, None if it has none
+    """
+    output, error = machine.process(["ip", "-4", "-o", "addr", "show", "dev", bridge])
+    for line in output:
+        if "inet " in line:
+            return line.split("inet ")[1].split("/")[0]
+
+    logging.warn(
+        "Could not find the IP of this machine on bridge %s, "
+        "VMs won't report their boot: %s" % (bridge, "".join(error).strip())
+    )
+    return None
+
+
+def boot_report(name, host_ip, port):
+    """Get the user data command with which a VM reports that it has booted
+
+    Args:
+        name (str): Name of the VM
+        host_ip (str): IP of this machine on the bridge, None to not report
+        port (int): Port of the boot report listener on this machine
+
+    Returns:
+        str: runcmd entry for the user data, empty if the VM can't report
+    """
+    if host_ip is None:
+        return ""
+
+    return BOOT_REPORT % (name, host_ip, port)
+
+
 def start(config, machines):
     """Create QEMU config files for each machine
 
@@ -175,6 +220,10 @@ def start(config, machines):
                 gateway = gatewaylist[1].rstrip()
     # ------------------------------------------------------------------------------------------------
 
+    # VMs report their boot to the listener on this machine
+    host_ip = find_host_ip(machines[0], bridge_name)
+    boot_port = config["infrastructure"]["boot_port"]
+
     cc = config["infrastructure"]["cloud_cores"]
     ec = config["infrastructure"]["edge_cores"]
     pc = config["infrastructure"]["endpoint_cores"]
@@ -239,7 +288,7 @@ def start(config, machines):
             f = open(".tmp/user_data_%s.yml" % (name), "w")
             hostname = name.replace("_", "")
             f.write(
-                USER_DATA % (hostname, hostname, name, name, ssh_key, name, interface, ip, gateway)
+                USER_DATA % (hostname, hostname, name, name, ssh_key, name, interface, ip, gateway, boot_report(name, host_ip, boot_port))
             )
             f.close()
 
@@ -276,7 +325,7 @@ def start(config, machines):
             f.close()
 
             f = open(".tmp/user_data_%s.yml" % (name), "w")
-            f.write(USER_DATA % (name, name, name, name, ssh_key, name, interface, ip, gateway))
+            f.write(USER_DATA % (name, name, name, name, ssh_key, name, interface, ip, gateway, boot_report(name, host_ip, boot_port)))
             f.close()
 
         # Endpoints
@@ -312,7 +361,7 @@ def start(config, machines):
             f.close()
 
             f = open(".tmp/user_data_%s.yml" % (name), "w")
-            f.write(USER_DATA % (name, name, name, name, ssh_key, name, interface, ip, gateway))
+            f.write(USER_DATA % (name, name, name, name, ssh_key, name, interface, ip, gateway, boot_report(name, host_ip, boot_port)))
             f.close()
 
         # Base image(s)
@@ -323,5 +372,5 @@ def start(config, machines):
             f.close()
 
             f = open(".tmp/user_data_%s.yml" % (name), "w")
-            f.write(USER_DATA % (name, name, name, name, ssh_key, name, interface, ip, gateway))
+            f.write(USER_DATA % (name, name, name, name, ssh_key, name, interface, ip, gateway, boot_report(name, host_ip, boot_port)))
             f.close()
@@ -9,6 +9,7 @@ import string
 import os
 import sys
 
+from .. import executor
 from .. import start as infrastructure
 
 sys.path.append(os.path.abspath("../.."))
@@ -16,6 +17,26 @@ sys.path.append(os.path.abspath("../.."))
 import main
 
 
+def check_domain(job, message):
+    """Check the output of a virsh command on a domain, and exit on failure.
+    For commands on other physical machines, SSH reports closing the connection as error.
+
+    Args:
+        job (executor.Job): Job that ran the virsh command
+        message (str): Expected output after the domain name
+    """
+    if job.error != [] and not any("Connection to " in e for e in job.error):
+        logging.error("ERROR on %s: %s" % (job.name, "".join(job.error)))
+        sys.exit()
+    elif (
+        job.output == []
+        or "Domain " not in job.output[0]
+        or message not in job.output[0]
+    ):
+        logging.error("ERROR on %s: %s" % (job.name, "".join(job.output)))
+        sys.exit()
+
+
 def os_image(config, machines):
     """Check if the os image with Ubuntu 20.04 already exists, and if not create the image (on all machines)
 
@@ -106,7 +127,7 @@ def base_image(config, machines):
         main.ansible_check_output(machines[0].process(command))
 
     # Launch the base VMs concurrently
-    processes = []
+    jobs = []
     base_ips = []
     for machine in machines:
         for base_name, base_ip in zip(machine.base_names, machine.base_ips):
@@ -123,26 +144,19 @@ def base_image(config, machines):
                         % (machine.name, config["home"], base_name)
                     )
 
-                processes.append(machines[0].process(command, shell=True, output=False))
+                jobs.append(
+                    executor.Job(machines[0], command, name=base_name, shell=True)
+                )
                 base_ips.append(base_ip)
 
-    for process in processes:
-        logging.debug("Check output for command [%s]" % ("".join(process.args)))
-        output = [line.decode("utf-8") for line in process.stdout.readlines()]
-        error = [line.decode("utf-8") for line in process.stderr.readlines()]
-
-        if error != [] and "Connection to " not in error[0]:
-            logging.error("ERROR: %s" % ("".join(error)))
-            sys.exit()
-        elif "Domain " not in output[0] or " created from " not in output[0]:
-            logging.error("ERROR: %s" % ("".join(output)))
-            sys.exit()
+    for job in executor.run(jobs, timeout=300):
+        check_domain(job, " created from ")
 
     # Fix SSH keys for each base image
     infrastructure.add_ssh(config, machines, base=base_ips)
 
     # Install software concurrently (ignore infra_only)
-    processes = []
+    jobs = []
     for base_name in base_names:
         command = []
         if "base_cloud" in base_name:
@@ -168,13 +182,10 @@ def base_image(config, machines):
             ]
 
         if command != []:
-            processes.append(machines[0].process(command, output=False))
+            jobs.append(executor.Job(machines[0], command, name=base_name))
 
-    for process in processes:
-        logging.debug("Check output for command [%s]" % ("".join(process.args)))
-        output = [line.decode("utf-8") for line in process.stdout.readlines()]
-        error = [line.decode("utf-8") for line in process.stderr.readlines()]
-        main.ansible_check_output((output, error))
+    for job in executor.run(jobs, timeout=3600):
+        main.ansible_check_output((job.output, job.error))
 
     # Install netperf (always, because base images aren't updated)
     command = [
@@ -190,7 +201,7 @@ def base_image(config, machines):
         infrastructure.docker_pull(config, machines, base_names)
 
     # Clean the VM
-    processes = []
+    jobs = []
     for machine in machines:
         for base_name, ip in zip(machine.base_names, machine.base_ips):
             base_name_r = base_name.rstrip(string.digits)
@@ -199,16 +210,15 @@ def base_image(config, machines):
                     "ssh %s@%s -i %s/.ssh/id_rsa_benchmark sudo cloud-init clean"
                     % (base_name, ip, config["home"])
                 )
-                processes.append(machines[0].process(command, shell=True, output=False))
+                jobs.append(
+                    executor.Job(machines[0], command, name=base_name, shell=True)
+                )
 
-    for process in processes:
-        logging.info("Check output for command [%s]" % ("".join(process.args)))
-        output = [line.decode("utf-8") for line in process.stdout.readlines()]
-        error = [line.decode("utf-8") for line in process.stderr.readlines()]
-        main.ansible_check_output((output, error))
+    for job in executor.run(jobs, timeout=120):
+        main.ansible_check_output((job.output, job.error))
 
     # Shutdown VMs
-    processes = []
+    jobs = []
     for machine in machines:
         for base_name in machine.base_names:
             base_name_r = base_name.rstrip(string.digits)
@@ -221,86 +231,50 @@ def base_image(config, machines):
                         % (machine.name, base_name)
                     )
 
-                processes.append(machines[0].process(command, shell=True, output=False))
-
-    for process in processes:
-        logging.debug("Check output for command [%s]" % ("".join(process.args)))
-        output = [line.decode("utf-8") for line in process.stdout.readlines()]
-        error = [line.decode("utf-8") for line in process.stderr.readlines()]
+                jobs.append(
+                    executor.Job(machines[0], command, name=base_name, shell=True)
+                )
 
-        if error != [] and not (
-            process.args.split(" ")[0] == "ssh"
-            and any(["Connection to " in e for e in error])
-        ):
-            logging.error("".join(error))
-            sys.exit()
-        elif "Domain " not in output[0] or " is being shutdown" not in output[0]:
-            logging.error("".join(output))
-            sys.exit()
+    for job in executor.run(jobs, timeout=120):
+        check_domain(job, " is being shutdown")
 
     # Wait for the shutdown to be completed
     time.sleep(5)
 
 
-def launch_vms(config, machines, repeat=[]):
-    """Launch VMs concurrently
-    Moved into a function so it can be re-executed when a VM didn't start for some reason
+def launch_vms(config, machines):
+    """Launch VMs concurrently. Launches failing on a transient SSH error are retried.
 
     Args:
         config (dict): Parsed configuration
         machines (list(Machine object)): List of machine objects representing physical machines
-        repeat (list, optional): Repeat specific execution. If empty, start all VMs. Defaults to [].
-
-    Returns:
-        list: Commands to execute again
     """
     # Launch the VMs concurrently
     logging.info("Start VMs")
 
-    processes = []
-    if repeat == []:
-        for machine in machines:
-            for name in (
-                machine.cloud_controller_names
-                + machine.cloud_names
-                + machine.edge_names
-                + machine.endpoint_names
-            ):
-                if machine.is_local:
-                    command = (
-                        "virsh --connect qemu:///system create %s/.continuum/domain_%s.xml"
-                        % (config["home"], name)
-                    )
-                else:
-                    command = (
-                        "ssh %s -t 'bash -l -c \"virsh --connect qemu:///system create %s/.continuum/domain_%s.xml\"'"
-                        % (machine.name, config["home"], name)
-                    )
-
-                processes.append(machines[0].process(command, shell=True, output=False))
-    else:
-        # Only execute specific commands on repeat until VMs are launched succesfully
-        for rep in repeat:
-            processes.append(machines[0].process(rep, shell=True, output=False))
-
-    repeat = []
-    for process in processes:
-        logging.debug("Check output for command [%s]" % ("".join(process.args)))
-        output = [line.decode("utf-8") for line in process.stdout.readlines()]
-        error = [line.decode("utf-8") for line in process.stderr.readlines()]
+    jobs = []
+    for machine in machines:
+        for name in (
+            machine.cloud_controller_names
+            + machine.cloud_names
+            + machine.edge_names
+            + machine.endpoint_names
+        ):
+            if machine.is_local:
+                command = (
+                    "virsh --connect qemu:///system create %s/.continuum/domain_%s.xml"
+                    % (config["home"], name)
+                )
+            else:
+                command = (
+                    "ssh %s -t 'bash -l -c \"virsh --connect qemu:///system create %s/.continuum/domain_%s.xml\"'"
+                    % (machine.name, config["home"], name)
+                )
 
-        if error != [] and "kex_exchange_identification" in error[0]:
-            # Repeat execution if key exchange error, can be solved by executing again
-            logging.error("ERROR, REPEAT EXECUTION: %s" % ("".join(error)))
-            repeat.append("".join(process.args))
-        elif error != [] and "Connection to " not in error[0]:
-            logging.error("ERROR: %s" % ("".join(error)))
-            sys.exit()
-        elif "Domain " not in output[0] or " created from " not in output[0]:
-            logging.error("ERROR: %s" % ("".join(output)))
-            sys.exit()
+            jobs.append(executor.Job(machines[0], command, name=name, shell=True))
 
-    return repeat
+    for job in executor.run(jobs, timeout=300):
+        check_domain(job, " created from ")
 
 
 def start(config, machines):
@@ -356,14 +330,4 @@ def start(config, machines):
         main.ansible_check_output(machines[0].process(command))
 
     # Start VMs
-    repeat = []
-    i = 0
-    while True:
-        repeat = launch_vms(config, machines, repeat)
-        if repeat == []:
-            break
-        elif i == 1:
-            logging.error("ERROR AFTER %i REPS: %s" % (i + 1, " | ".join(repeat)))
-            sys.exit()
-
-        i += 1
+    launch_vms(config, machines)
@@ -6,12 +6,28 @@ import sys
 import time
 import json
 import string
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import tarfile
 import numpy as np
 
 from . import machine as m
 from . import ansible
+from . import boot
+from . import executor
 from . import network
 
+# Wait at most this long for all VMs to accept SSH, probing each VM with exponential backoff
+SSH_TIMEOUT = 900
+SSH_BACKOFF = 0.5
+SSH_BACKOFF_MAX = 8
+SSH_CONNECT_TIMEOUT = 5
+SSH_KEYSCAN_RETRIES = 5
+
+
 def schedule_custom(config,machines):
     logging.info("Schedule VMs on machine: As specified in the config file")
     machines_per_node = [
@@ -172,7 +188,7 @@ def delete_vms(machines):
         machines (list(Machine object)): List of machine objects representing physical machines
     """
     logging.info("Start deleting VMs after benchmark has completed")
-    processes = []
+    jobs = []
     for machine in machines:
         if machine.is_local:
             command = 'virsh list --all | grep -o -E "(cloud\w*|edge\w*|endpoint\w*|base\w*)" | xargs -I % sh -c "virsh destroy %"'
@@ -180,20 +196,13 @@ def delete_vms(machines):
             comm = 'virsh list --all | grep -o -E \\"(cloud\w*|edge\w*|endpoint\w*|base\w*)\\" | xargs -I % sh -c \\"virsh destroy %\\"'
             command = "ssh %s -t 'bash -l -c \"%s\"'" % (machine.name, comm)
 
-        processes.append(machine.process(command, shell=True, output=False))
+        jobs.append(executor.Job(machine, command, shell=True))
 
         command = ["rm", "-f", "/tmp/join-command.txt"]
-        processes.append(machine.process(command, ssh=True, output=False))
+        jobs.append(executor.Job(machine, command, ssh=True))
 
-    # Wait for process to finish. Outcome of destroy command does not matter
-    for process in processes:
-        args = process.args
-        if isinstance(args, list):
-            args = " ".join(args)
-
-        logging.debug("Check output for command [%s]" % (args))
-        _ = [line.decode("utf-8") for line in process.stdout.readlines()]
-        _ = [line.decode("utf-8") for line in process.stderr.readlines()]
+    # Wait for the commands to finish. Outcome of destroy command does not matter
+    executor.run(jobs, timeout=300)
 
 
 def create_keypair(config, machines):
@@ -250,8 +259,79 @@ def create_dir(config, machines):
         sys.exit()
 
 
+def machine_files(config, machine):
+    """List the Infrastructure and Ansible files a machine needs in ${HOME}/.continuum
+
+    Args:
+        config (dict): Parsed configuration
+        machine (Machine object): Object representing the physical machine
+
+    Returns:
+        list(str): Local files and directories, which are placed in ${HOME}/.continuum
+            under their own name
+    """
+    paths = []
+
+    # For the local machine, copy the ansible inventory file and benchmark launch
+    if machine.is_local:
+        paths.append(config["base"] + "/.tmp/inventory")
+        paths.append(config["base"] + "/.tmp/inventory_vms")
+
+        if (
+            not config["infrastructure"]["infra_only"]
+            and (config["mode"] == "cloud" or config["mode"] == "edge")
+            and config["benchmark"]["resource_manager"] != "mist"
+        ):
+            path = (
+                config["base"]
+                + "/resource_manager/"
+                + config["benchmark"]["resource_manager"]
+                + "/launch_benchmark.yml"
+            )
+            paths.append(path)
+
+    # VM creation files
+    for name in (
+        machine.cloud_controller_names
+        + machine.cloud_names
+        + machine.edge_names
+        + machine.endpoint_names
+        + machine.base_names
+    ):
+        paths.append(config["base"] + "/.tmp/domain_" + name + ".xml")
+        paths.append(config["base"] + "/.tmp/user_data_" + name + ".yml")
+
+    # Ansible files for infrastructure
+    paths.append(
+        config["base"]
+        + "/infrastructure/"
+        + config["infrastructure"]["provider"]
+        + "/infrastructure"
+    )
+
+    # For cloud/edge/endpoint specific
+    if not config["infrastructure"]["infra_only"]:
+        if config["mode"] == "cloud" or config["mode"] == "edge":
+            # Use Kubeedge setup code for mist computing
+            rm = config["benchmark"]["resource_manager"]
+            if config["benchmark"]["resource_manager"] == "mist":
+                rm = "kubeedge"
+
+            paths.append(config["base"] + "/resource_manager/" + rm + "/cloud")
+
+            if config["mode"] == "edge":
+                paths.append(config["base"] + "/resource_manager/" + rm + "/edge")
+
+        paths.append(config["base"] + "/resource_manager/endpoint")
+
+    return paths
+
+
 def copy_files(config, machines):
     """Copy Infrastructure and Ansible files to all machines with directory ${HOME}/.continuum
+    The files of each machine are packed into one compressed archive, which is streamed to the
+    machine over a single connection, for all machines in parallel. The archive is unpacked
+    next to ${HOME}/.continuum, which is only replaced once everything has been unpacked.
 
     Args:
         config (dict): Parsed configuration
@@ -259,110 +339,165 @@ def copy_files(config, machines):
     """
     logging.info("Start copying files to all nodes")
 
+    jobs = []
     for machine in machines:
-        # Create a source directory on each machiine
+        archive = "%s/.tmp/continuum_%s.tar.gz" % (config["base"], machine.name)
+        with tarfile.open(archive, "w:gz", compresslevel=6) as tar:
+            for path in machine_files(config, machine):
+                tar.add(path, arcname=os.path.basename(path))
+
+        # Don't restore modification times, the clocks of the machines may differ
+        unpack = (
+            "cd && rm -rf .continuum.new .continuum.old && mkdir .continuum.new && "
+            "tar -xzmf - -C .continuum.new && "
+            "{ [ ! -e .continuum ] || mv .continuum .continuum.old; } && "
+            "mv .continuum.new .continuum && rm -rf .continuum.old"
+        )
         if machine.is_local:
-            command = "rm -rf %s/.continuum && mkdir %s/.continuum" % (
-                config["home"],
-                config["home"],
-            )
-            output, error = machine.process(command, shell=True)
-
-            dest = config["home"] + "/.continuum/"
+            command = "bash -c '%s' < %s" % (unpack, archive)
         else:
-            command = 'ssh %s "rm -rf ./.continuum && mkdir ./.continuum"' % (
-                machine.name
-            )
-            output, error = machine.process(command, shell=True)
+            command = "ssh %s '%s' < %s" % (machine.name, unpack, archive)
 
-            dest = machine.name + ":./.continuum/"
+        jobs.append(executor.Job(machine, command, shell=True))
 
-        if error != []:
-            logging.error("".join(error))
+    for job in executor.run(jobs, timeout=600):
+        if job.returncode != 0 or job.error != []:
+            logging.error(
+                "Could not copy files to %s: %s" % (job.name, "".join(job.error))
+            )
             sys.exit()
-        elif output != []:
-            logging.error("".join(output))
+        elif job.output != []:
+            logging.error("".join(job.output))
             sys.exit()
 
-        out = []
 
-        # For the local machine, copy the ansible inventory file and benchmark launch
-        if machine.is_local:
-            out.append(machine.copy_files(config["base"] + "/.tmp/inventory", dest))
-            out.append(machine.copy_files(config["base"] + "/.tmp/inventory_vms", dest))
-
-            if (
-                not config["infrastructure"]["infra_only"]
-                and (config["mode"] == "cloud" or config["mode"] == "edge")
-                and config["benchmark"]["resource_manager"] != "mist"
-            ):
-                path = (
-                    config["base"]
-                    + "/resource_manager/"
-                    + config["benchmark"]["resource_manager"]
-                    + "/launch_benchmark.yml"
-                )
-                out.append(machine.copy_files(path, dest))
+async def probe_ssh(ip, name, start_time, timeout):
+    """Wait for the SSH server of a VM to answer, with exponential backoff between attempts.
+    The server is up once it sends its version banner, an open port alone is not enough.
+    A boot report of the VM (see boot.py) ends the wait as well, even during the backoff.
 
-        # Copy VM creation files
-        for name in (
-            machine.cloud_controller_names
-            + machine.cloud_names
-            + machine.edge_names
-            + machine.endpoint_names
-            + machine.base_names
-        ):
-            out.append(
-                machine.copy_files(
-                    config["base"] + "/.tmp/domain_" + name + ".xml", dest
-                )
+    Args:
+        ip (str): IP of the VM
+        name (str): Name of the VM
+        start_time (float): Time the probing started
+        timeout (float): Max time in seconds since the start to wait
+
+    Returns:
+        float: Time in seconds since the start until the VM answered, None on timeout
+    """
+    delay = SSH_BACKOFF
+    while True:
+        if boot.reported(name) is not None:
+            return time.time() - start_time
+
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(ip, 22), timeout=SSH_CONNECT_TIMEOUT
             )
-            out.append(
-                machine.copy_files(
-                    config["base"] + "/.tmp/user_data_" + name + ".yml", dest
+            try:
+                banner = await asyncio.wait_for(
+                    reader.readline(), timeout=SSH_CONNECT_TIMEOUT
                 )
-            )
+            finally:
+                writer.close()
+
+            if banner.startswith(b"SSH-"):
+                return time.time() - start_time
+        except (OSError, asyncio.TimeoutError):
+            pass
+
+        if time.time() - start_time + delay > timeout:
+            return None
+
+        await boot.sleep(name, delay)
+        delay = min(delay * 2, SSH_BACKOFF_MAX)
+
+
+async def probe_all_ssh(ips, names, timeout):
+    """Wait for the SSH servers of multiple VMs to answer, probing all VMs concurrently
+
+    Args:
+        ips (list(str)): IPs of the VMs
+        names (list(str)): Names of the VMs
+        timeout (float): Max time in seconds to wait
+
+    Returns:
+        list(float): Time in seconds until each VM answered, None on timeout
+    """
+    start_time = time.time()
+    watch = asyncio.ensure_future(boot.watch(names))
+    ready = await asyncio.gather(
+        *[probe_ssh(ip, name, start_time, timeout) for ip, name in zip(ips, names)]
+    )
+    watch.cancel()
+    return ready
+
+
+def known_host_matches(host, ips):
+    """Check if the host field of a known_hosts line refers to one of the given IPs.
+    Host fields can be a comma-separated list of names, and can be hashed (HashKnownHosts).
 
-        # Copy Ansible files for infrastructure
-        path = (
-            config["base"]
-            + "/infrastructure/"
-            + config["infrastructure"]["provider"]
-            + "/infrastructure/"
+    Args:
+        host (str): Host field of a known_hosts line
+        ips (set(str)): IPs to look for
+
+    Returns:
+        bool: The line is about one of the IPs
+    """
+    if host.startswith("|1|"):
+        salt, hashed = [base64.b64decode(part) for part in host[3:].split("|")]
+        return any(
+            hmac.new(salt, ip.encode("utf-8"), hashlib.sha1).digest() == hashed
+            for ip in ips
         )
-        out.append(machine.copy_files(path, dest, recursive=True))
 
-        # For cloud/edge/endpoint specific
-        if not config["infrastructure"]["infra_only"]:
-            if config["mode"] == "cloud" or config["mode"] == "edge":
-                # Use Kubeedge setup code for mist computing
-                rm = config["benchmark"]["resource_manager"]
-                if config["benchmark"]["resource_manager"] == "mist":
-                    rm = "kubeedge"
+    return any(name in ips for name in host.split(","))
 
-                path = config["base"] + "/resource_manager/" + rm + "/cloud/"
-                out.append(machine.copy_files(path, dest, recursive=True))
 
-                if config["mode"] == "edge":
-                    path = config["base"] + "/resource_manager/" + rm + "/edge/"
-                    out.append(machine.copy_files(path, dest, recursive=True))
+def update_known_hosts(path, ips, keys):
+    """Replace the keys of the given IPs in a known_hosts file, writing the file once.
+    The file is replaced atomically, so SSH never sees a partially written file.
 
-            path = config["base"] + "/resource_manager/endpoint/"
-            out.append(machine.copy_files(path, dest, recursive=True))
+    Args:
+        path (str): Path of the known_hosts file
+        ips (list(str)): IPs whose old keys should be removed
+        keys (list(str)): New known_hosts lines
+    """
+    lines = []
+    mode = 0o600
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode & 0o777
+        with open(path, "r") as f:
+            lines = f.readlines()
+
+    ips = set(ips)
+    kept = [
+        line
+        for line in lines
+        if line.strip() == ""
+        or line.startswith("#")
+        or not known_host_matches(line.split()[0], ips)
+    ]
 
-        for output, error in out:
-            if error != []:
-                logging.error("".join(error))
-                sys.exit()
-            elif output != []:
-                logging.error("".join(output))
-                sys.exit()
+    logging.debug(
+        "Replace %i old keys by %i new keys in %s"
+        % (len(lines) - len(kept), len(keys), path)
+    )
+
+    temp = path + ".tmp"
+    with open(temp, "w") as f:
+        f.writelines(kept + [key + "\n" for key in keys])
+
+    os.chmod(temp, mode)
+    os.replace(temp, path)
 
 
 def add_ssh(config, machines, base=[]):
     """Add SSH keys for generated VMs to known_hosts file
     Since all VMs are connected via a network bridge,
-    only touch the known_hosts file of the main physical machine
+    only touch the known_hosts file of the main physical machine.
+    All VMs are probed concurrently until their SSH server answers, after which
+    their keys are scanned in one go and the known_hosts file is rewritten once.
 
     Args:
         config (dict): Parsed configuration
@@ -385,26 +520,99 @@ def add_ssh(config, machines, base=[]):
             + config["endpoint_ips"]
         )
 
-    # Check if old keys are still in the known hosts file
-    for ip in ips:
-        command = ["ssh-keygen", "-f", config["home"] + "/.ssh/known_hosts", "-R", ip]
-        _, error = machines[0].process(command)
+    if ips == []:
+        return
 
-        if error != [] and not any("not found in" in err for err in error):
-            logging.error("".join(error))
+    # Names of the VMs, for logging
+    names = {}
+    for machine in machines:
+        for name, ip in zip(
+            machine.cloud_controller_names
+            + machine.cloud_names
+            + machine.edge_names
+            + machine.endpoint_names
+            + machine.base_names,
+            machine.cloud_controller_ips
+            + machine.cloud_ips
+            + machine.edge_ips
+            + machine.endpoint_ips
+            + machine.base_ips,
+        ):
+            names[ip] = name
+
+    # A VM is ready once it reports its boot or its SSH server answers, whichever comes first
+    logging.info("Wait for %i VMs to have started up" % (len(ips)))
+    ready = asyncio.run(
+        probe_all_ssh(ips, [names.get(ip, ip) for ip in ips], SSH_TIMEOUT)
+    )
+
+    for ip, seconds in zip(ips, ready):
+        if seconds is None:
+            logging.error(
+                "VM %s (%s) did not accept SSH within %i seconds"
+                % (names.get(ip, ip), ip, SSH_TIMEOUT)
+            )
             sys.exit()
 
-    # Once the known_hosts file has been cleaned up, add all new keys
-    for ip in ips:
-        logging.info("Wait for VM to have started up")
-        while True:
-            command = "ssh-keyscan %s >> %s/.ssh/known_hosts" % (ip, config["home"])
-            _, error = machines[0].process(command, shell=True)
+        logging.info(
+            "VM %s (%s) is up after %.1f seconds" % (names.get(ip, ip), ip, seconds)
+        )
 
-            if any("# " + str(ip) + ":" in err for err in error):
-                break
+    boot.summary([names.get(ip, ip) for ip in ips])
+
+    # Scan the keys of all VMs at once. Try again for VMs that didn't give their keys yet,
+    # an SSH server can answer shortly before its host keys are available.
+    keys = []
+    missing = ips
+    for i in range(SSH_KEYSCAN_RETRIES):
+        command = ["ssh-keyscan", "-T", str(SSH_CONNECT_TIMEOUT)] + missing
+        output, _ = machines[0].process(command)
+
+        scanned = [line.strip() for line in output if line.strip() != ""]
+        scanned = [line for line in scanned if not line.startswith("#")]
+        keys += scanned
 
-            time.sleep(5)
+        found = set(line.split()[0] for line in scanned)
+        missing = [ip for ip in missing if ip not in found]
+        if missing == []:
+            break
+
+        time.sleep(SSH_BACKOFF * 2**i)
+
+    if missing != []:
+        logging.error("Could not scan the SSH keys of VMs: %s" % (", ".join(missing)))
+        sys.exit()
+
+    update_known_hosts(config["home"] + "/.ssh/known_hosts", ips, keys)
+
+
+def start_agents(config, machines):
+    """Start a command agent on each VM and external physical machine, so the commands
+    the framework sends to them share one SSH connection per target
+
+    Args:
+        config (dict): Parsed configuration
+        machines (list(Machine object)): List of machine objects representing physical machines
+    """
+    logging.info("Start command agents on all VMs and physical machines")
+    for machine in machines:
+        targets = [None]
+        if machine == machines[0]:
+            targets += config["cloud_ssh"] + config["edge_ssh"] + config["endpoint_ssh"]
+
+        machine.start_agents(targets)
+
+
+def stop_agents(machines):
+    """Stop all command agents, and report the SSH connections and commands per target
+
+    Args:
+        machines (list(Machine object)): List of machine objects representing physical machines
+    """
+    for machine in machines:
+        machine.stop_agents()
+
+    m.print_commands(machines)
 
 
 def docker_registry(config, machines):
@@ -496,7 +704,7 @@ def docker_pull(config, machines, base_names):
     logging.info("Pull docker containers into base images")
 
     # Pull the images
-    processes = []
+    jobs = []
     for machine in machines:
         for name, ip in zip(machine.base_names, machine.base_ips):
             name_r = name.rstrip(string.digits)
@@ -534,28 +742,16 @@ def docker_pull(config, machines, base_names):
 
                 for image in images:
                     command = ["docker", "pull", image]
-
-                    processes.append(
-                        [
-                            name,
-                            machines[0].process(
-                                command,
-                                output=False,
-                                ssh=True,
-                                ssh_target=name + "@" + ip,
-                            ),
-                        ]
+                    jobs.append(
+                        executor.Job(
+                            machines[0], command, ssh=True, ssh_target=name + "@" + ip
+                        )
                     )
 
-
     # Checkout process output
-    for name, process in processes:
-        logging.debug("Check output of command [%s]" % (" ".join(process.args)))
-        output = [line.decode("utf-8") for line in process.stdout.readlines()]
-        error = [line.decode("utf-8") for line in process.stderr.readlines()]
-
-        if error != [] and any(
-            "server gave HTTP response to HTTPS client" in line for line in error
+    for job in executor.run(jobs, timeout=1800):
+        if job.error != [] and any(
+            "server gave HTTP response to HTTPS client" in line for line in job.error
         ):
             logging.warn(
                 """\
@@ -564,12 +760,12 @@ This will most likely prevent the machine from pulling endpoint docker images
 from the private Docker registry running on the main machine %s.
 Please create this file on machine %s with content: { "insecure-registries":["%s"] }
 Followed by a restart of Docker: systemctl restart docker"""
-                % (name, machines[0].name, name, config["registry"])
+                % (job.name, machines[0].name, job.name, config["registry"])
             )
-        if error != []:
-            logging.error("".join(error))
+        if job.error != []:
+            logging.error("".join(job.error))
             sys.exit()
-        elif output == []:
+        elif job.output == []:
             logging.error("No output from command docker pull")
             sys.exit()
 
@@ -625,8 +821,13 @@ def start(config):
     if not config["infrastructure"]["infra_only"]:
         docker_registry(config, machines)
 
+    boot.start(config["infrastructure"]["boot_port"])
     start.start(config, machines)
     add_ssh(config, machines)
+    boot.stop()
+
+    if config["infrastructure"]["command_agent"]:
+        start_agents(config, machines)
 
     if config["infrastructure"]["network_emulation"]:
         network.start(config, machines)
@@ -13,12 +13,33 @@ import os
 import time
 import configparser
 import socket
+import importlib.util
 
 import infrastructure.start as infrastructure
 import resource_manager.start as resource_manager
 import benchmark.start as benchmark
 
 
+def model_variants():
+    """Load the registry of model variants from the image classification application,
+    so the models accepted here are the models the application can load
+
+    Returns:
+        module: variants module of the application, with MODELS and REFERENCE
+    """
+    path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "application",
+        "image_classification",
+        "common",
+        "variants.py",
+    )
+    spec = importlib.util.spec_from_file_location("variants", path)
+    variants = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(variants)
+    return variants
+
+
 def ansible_check_output(out):
     """Check if an Ansible Playbook succeeded or failed
     Shared by all files launching Ansible playbooks
@@ -408,6 +429,28 @@ def parse_config(parser, arg):
         option_check(
             parser, config, new, sec, "netperf", bool, lambda x: x in [True, False]
         )
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "command_agent",
+            bool,
+            lambda x: x in [True, False],
+            mandatory=False,
+        )
+        new[sec].setdefault("command_agent", True)
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "boot_port",
+            int,
+            lambda x: 1 <= x <= 65535,
+            mandatory=False,
+        )
+        new[sec].setdefault("boot_port", 8099)
     else:
         parser.error("Config: infrastructure section missing")
 
@@ -476,6 +519,225 @@ def parse_config(parser, arg):
         )
         option_check(parser, config, new, sec, "frequency", int, lambda x: x >= 1)
 
+        # Optional batching of inference on cloud/edge workers, default is no batching
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "batch_size",
+            int,
+            lambda x: x >= 1,
+            mandatory=False,
+        )
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "batch_wait",
+            float,
+            lambda x: x >= 0.0,
+            mandatory=False,
+        )
+        new[sec].setdefault("batch_size", 1)
+        new[sec].setdefault("batch_wait", 0.0)
+
+        # Optional image preprocessing settings, defaults to no caching
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "resample",
+            str,
+            lambda x: x
+            in ["nearest", "box", "bilinear", "hamming", "bicubic", "lanczos"],
+            mandatory=False,
+        )
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "preprocess_cache",
+            int,
+            lambda x: x >= 0,
+            mandatory=False,
+        )
+        new[sec].setdefault("resample", "bicubic")
+        new[sec].setdefault("preprocess_cache", 0)
+
+        # Optional inter-arrival distribution of generated data, defaults to a constant rate
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "arrival",
+            str,
+            lambda x: x in ["constant", "poisson"],
+            mandatory=False,
+        )
+        new[sec].setdefault("arrival", "constant")
+
+        # Optional human-readable logging of every n-th frame, metrics are always recorded
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "log_sample",
+            int,
+            lambda x: x >= 0,
+            mandatory=False,
+        )
+        new[sec].setdefault("log_sample", 0)
+
+        # Optional number of synthetic inferences to warm up each model before processing data
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "warmup",
+            int,
+            lambda x: x >= 0,
+            mandatory=False,
+        )
+        new[sec].setdefault("warmup", 5)
+
+        # Optional model variant used for image classification, defaults to the float model
+        variants = model_variants()
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "model",
+            str,
+            lambda x: x in variants.MODELS,
+            mandatory=False,
+        )
+        new[sec].setdefault("model", variants.REFERENCE)
+
+        # Optional bound on the images queued on a cloud/edge worker, and what to do when it is full
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "queue_size",
+            int,
+            lambda x: x >= 0,
+            mandatory=False,
+        )
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "queue_policy",
+            str,
+            lambda x: x
+            in ["drop-newest", "drop-oldest", "latest-per-endpoint", "block"],
+            mandatory=False,
+        )
+        new[sec].setdefault("queue_size", 0)
+        new[sec].setdefault("queue_policy", "drop-oldest")
+
+        # Optional transport between image generators and processors, defaults to MQTT
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "transport",
+            str,
+            lambda x: x in ["mqtt", "tcp", "udp"],
+            mandatory=False,
+        )
+        new[sec].setdefault("transport", "mqtt")
+
+        # Optional stage up to which endpoints preprocess images before offloading them
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "offload_split",
+            str,
+            lambda x: x in ["none", "resize", "tensor"],
+            mandatory=False,
+        )
+        new[sec].setdefault("offload_split", "none")
+
+        # Optional reply latency target in ms, endpoints adapt their send rate to it
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "latency_target",
+            int,
+            lambda x: x >= 0,
+            mandatory=False,
+        )
+        new[sec].setdefault("latency_target", 0)
+
+        # Optional sharing of one in-memory model by all inference processes
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "shared_model",
+            bool,
+            lambda x: x in [True, False],
+            mandatory=False,
+        )
+        new[sec].setdefault("shared_model", False)
+
+        # Optional calibration of the inference processes and threads at startup
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "calibrate",
+            str,
+            lambda x: x in ["off", "throughput", "latency"],
+            mandatory=False,
+        )
+        new[sec].setdefault("calibrate", "off")
+
+        # Optional number of decode and inference processes in endpoint-only mode,
+        # defaults to 1 decode process and 1 single-threaded inference process per core
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "decode_workers",
+            int,
+            lambda x: x >= 1,
+            mandatory=False,
+        )
+        option_check(
+            parser,
+            config,
+            new,
+            sec,
+            "infer_workers",
+            int,
+            lambda x: x >= 1,
+            mandatory=False,
+        )
+        new[sec].setdefault("decode_workers", 1)
+        new[sec].setdefault(
+            "infer_workers", max(1, new["infrastructure"]["endpoint_cores"])
+        )
+
         # Set mode
         mode = "endpoint"
         if edge:
@@ -654,9 +916,15 @@ def main(args):
         resource_manager.start(args.config, machines)
         benchmark.start(args.config, machines)
 
-        if args.config["benchmark"]["delete"]:
-            infrastructure.delete_vms(machines)
-            print_ssh = False
+    # Stop the command agents before their VMs may be deleted
+    infrastructure.stop_agents(machines)
+
+    if (
+        not args.config["infrastructure"]["infra_only"]
+        and args.config["benchmark"]["delete"]
+    ):
+        infrastructure.delete_vms(machines)
+        print_ssh = False
 
     if print_ssh:
         s = []
@@ -123,6 +123,23 @@ class Model:
         self.resume_index += 1
         return [], []
 
+    def csv_output(self, output):
+        """Find the csv tables in the output of a benchmark run.
+        The tables follow the "Output in csv format" line, anything may be logged after them.
+
+        Args:
+            output (list(str)): Output lines of the benchmark run
+
+        Returns:
+            list(str): Csv strings, the worker table first for cloud/edge runs
+        """
+        for i in range(len(output) - 1, -1, -1):
+            if "Output in csv format" in output[i]:
+                return [line[1:-2] for line in output[i + 1 : i + 3]]
+
+        logging.error("ERROR: No csv output found in the benchmark output")
+        sys.exit()
+
     def str_to_df(self, input):
         """Parse a csv as string to a Pandas DataFrame
 
@@ -190,7 +207,7 @@ T_proc      norm. processing time   %.2f sec
             output, _ = self.execute(command)
 
         # Parse output to dataframe
-        df = self.str_to_df(output[-6][1:-2])
+        df = self.str_to_df(self.csv_output(output)[0])
         logging.debug("\n" + df.to_string(index=False))
 
         # Extract the required data
@@ -240,7 +257,7 @@ To satisfy: (T_proc / (C_e * Q_e)) < P
             output, _ = self.execute(command)
 
         # Parse output of endpoint to dataframe
-        df = self.str_to_df(output[-6][1:-2])
+        df = self.str_to_df(self.csv_output(output)[0])
         logging.info("\n" + df.to_string(index=False))
 
 
@@ -252,6 +269,12 @@ class ModelOffload(Model):
         config = cont_main.parse_config(parser, "configuration/model/offload.cfg")
         Model.__init__(self, args, config)
 
+        # Stage up to which endpoints preprocess data before offloading, the decoding time
+        # on the worker, and the preprocessing time this split moves to the endpoints
+        self.split = config["benchmark"]["offload_split"]
+        self.T_dec = 0.0
+        self.T_split = 0.0
+
     def __repr__(self):
         return """
 --------------------------------------------------
@@ -265,13 +288,16 @@ Q_e         endp. CPU core quota    %.2f
 B           bandwidth               %.2f Mbit
 f           Frequency               %i Hz
 p           Period (1/f)            %.2f
+split       Offload split           %s
 --------------------------------------------------
 Acquired data
 --------------------------------------------------
 d           Size of 1 data entity   %.2f MB
 D           Generated data / sec    %.2f Mbit
 T_proc      norm. proc time         %.2f sec
+T_dec       of which decoding       %.2f sec
 T_pre       norm. preproc time      %.2f sec
+T_split     est. split preproc      %.2f sec
 --------------------------------------------------""" % (
             self.E,
             self.C_w,
@@ -281,10 +307,13 @@ T_pre       norm. preproc time      %.2f sec
             self.B,
             self.f,
             self.p,
+            self.split,
             self.d,
             self.D,
             self.T_proc,
+            self.T_dec,
             self.T_pre,
+            self.T_split,
         )
 
     def benchmark_normalize(self):
@@ -303,7 +332,7 @@ T_pre       norm. preproc time      %.2f sec
             output, _ = self.execute(command)
 
         # Parse output of worker to dataframe, and extract required data
-        df_worker = self.str_to_df(output[-7][1:-2])
+        df_worker = self.str_to_df(self.csv_output(output)[0])
         logging.debug("\n" + df_worker.to_string(index=False))
 
         df_worker["proc/data (ms)"] = pd.to_numeric(
@@ -311,8 +340,20 @@ T_pre       norm. preproc time      %.2f sec
         )
         self.T_proc = df_worker["proc/data (ms)"].mean() / 1000.0
 
+        # Decoding is part of the processing time. The normalization run offloads the
+        # original images, so this is the decoding and resizing of the full images
+        if "decode_time/data (ms)" in df_worker:
+            df_worker["decode_time/data (ms)"] = pd.to_numeric(
+                df_worker["decode_time/data (ms)"], downcast="float"
+            )
+            self.T_dec = df_worker["decode_time/data (ms)"].mean() / 1000.0
+
+        # With an offload split, endpoints take over that decoding and resizing
+        if self.split != "none":
+            self.T_split = self.T_dec
+
         # Parse output of endpoint to dataframe, and extract required data
-        df_endpoint = self.str_to_df(output[-6][1:-2])
+        df_endpoint = self.str_to_df(self.csv_output(output)[1])
         logging.debug("\n" + df_endpoint.to_string(index=False))
 
         df_endpoint["preproc/data (ms)"] = pd.to_numeric(
@@ -327,19 +368,24 @@ T_pre       norm. preproc time      %.2f sec
         self.D = self.d * 8 * self.f
 
     def condition_processing(self):
-        """Model worker data processing when offloading"""
-        result = (self.T_proc * self.E) / (self.C_w * self.Q_w)
+        """Model worker data processing when offloading.
+        Workers receiving tensors skip decoding. With the resize split they still decode
+        the smaller images, which is counted as the full decoding time to stay on the safe side.
+        """
+        T_skip = self.T_dec if self.split == "tensor" else 0.0
+        result = ((self.T_proc - T_skip) * self.E) / (self.C_w * self.Q_w)
         condition = self.p
         satisfy = result < condition
 
         logging.info(
             """
-To satisfy: ((T_proc * E) / (C_w * Q_w)) < P
-            ((%.2f * %i) / (%i * %.2f)) < %.2f 
+To satisfy: (((T_proc - T_skip) * E) / (C_w * Q_w)) < P
+            (((%.2f - %.2f) * %i) / (%i * %.2f)) < %.2f
             %.2f < %.2f
             %s"""
             % (
                 self.T_proc,
+                T_skip,
                 self.E,
                 self.C_w,
                 self.Q_w,
@@ -353,18 +399,29 @@ To satisfy: ((T_proc * E) / (C_w * Q_w)) < P
         self.condition_proc = [result, condition, satisfy]
 
     def condition_preprocessing(self):
-        """Model endpoint preparation/preprocessing when offloading"""
-        result = self.T_pre / (self.C_e * self.Q_e)
+        """Model endpoint preparation/preprocessing when offloading, including the
+        preprocessing the offload split moves to the endpoints
+        """
+        result = (self.T_pre + self.T_split) / (self.C_e * self.Q_e)
         condition = self.p
         satisfy = result < condition
 
         logging.info(
             """
-To satisfy: (T_pre / (C_e * Q_e)) < P
-            (%.2f / (%i * %.2f)) < %.2f
+To satisfy: ((T_pre + T_split) / (C_e * Q_e)) < P
+            ((%.2f + %.2f) / (%i * %.2f)) < %.2f
             %.2f < %.2f
             %s"""
-            % (self.T_pre, self.C_e, self.Q_e, self.p, result, condition, satisfy)
+            % (
+                self.T_pre,
+                self.T_split,
+                self.C_e,
+                self.Q_e,
+                self.p,
+                result,
+                condition,
+                satisfy,
+            )
         )
 
         self.condition_pre = [result, condition, satisfy]
@@ -415,11 +472,11 @@ To satisfy: D < B
             output, _ = self.execute(command)
 
         # Parse output of worker to dataframe
-        df_worker = self.str_to_df(output[-7][1:-2])
+        df_worker = self.str_to_df(self.csv_output(output)[0])
         logging.info("\n" + df_worker.to_string(index=False))
 
         # Parse output of endpoint to dataframe
-        df_endpoint = self.str_to_df(output[-6][1:-2])
+        df_endpoint = self.str_to_df(self.csv_output(output)[1])
         logging.info("\n" + df_endpoint.to_string(index=False))
 
 